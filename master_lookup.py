@@ -1,7 +1,29 @@
+import os
+import sys
 import json
-import requests
+import zlib
+import codecs
+import shutil
+import hashlib
+import argparse
+import tempfile
+import http.client
+import urllib.parse
+from io import BytesIO
 from collections import OrderedDict
-from lxml import html
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lxml import html, etree
+from PIL import Image
+
+from src.http_pool import CONNECTION_POOL
+from src.json_stream import MgJsonFieldScanner
+from src.constants import BASE_URL, MASTER_JSON, MASTER_META
+
+CRAWL_WORKERS = 4  # Number of sets crawled in parallel
+CHECKPOINT_DIR = 'master_checkpoints'  # Sets crawled by an unfinished run
+ALL_SETS_URL = 'http://mtgjson.com/json/AllSets.json'
+READ_CHUNK = 64 * 1024  # Bytes of AllSets.json read at a time
+GZIP_MAGIC = b'\x1f\x8b'
 
 
 def urlHtmlToJpg(url_list):
@@ -21,8 +43,14 @@ def urlHtmlToJpg(url_list):
 def getSetInfo(set_name):
     set_request = '++e:{}/en'.format(set_name)
     param = {'q': set_request, 'v': 'list', 's': 'issue'}
-    page = requests.get('http://magiccards.info/query', params=param)
-    tree = html.fromstring(page.text)
+    address = 'http://magiccards.info/query?' + urllib.parse.urlencode(param)
+    with CONNECTION_POOL.urlopen(address) as response:
+        # An error page would be parsed as a set without cards
+        if response.status != 200:
+            raise http.client.HTTPException(
+                'Unexpected HTTP status %d for %s' % (response.status, address)
+            )
+        tree = html.fromstring(response.read())
 
     name = tree.xpath('//table[3]//tr/td[2]/a//text()')
     url = tree.xpath('//table[3]//tr/td[2]/a/@href')
@@ -31,27 +59,67 @@ def getSetInfo(set_name):
     return tuple(zip(name, url))
 
 
-def getSetConversion():
-    j_get = requests.get('http://mtgjson.com/json/AllSets.json')
-    j_text = j_get.content
-    j_text = j_text.decode('utf-8')
-    j_info = json.loads(j_text, object_pairs_hook=OrderedDict)
+def readChunks(stream, gzipped):
+    # Yields the text of a (possibly gzip compressed) stream in chunks,
+    # never holding more than one chunk of it in memory
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else None
+    decoder = codecs.getincrementaldecoder('utf-8')()
+
+    while True:
+        data = stream.read(READ_CHUNK)
+        if not data:
+            break
+        if decompressor is not None:
+            data = decompressor.decompress(data)
+        yield decoder.decode(data)
+
+    if decompressor is not None:
+        yield decoder.decode(decompressor.flush(), final=True)
+    else:
+        yield decoder.decode(b'', final=True)
+
+
+def getSetConversion(release_dates=None, source=ALL_SETS_URL):
+    # Only the set codes and a few fields of every set are needed, so
+    # AllSets.json is scanned as it arrives instead of being parsed whole.
+    # Source is a URL or a local (optionally gzip compressed) copy.
+    scanner = MgJsonFieldScanner(('magicCardsInfoCode', 'releaseDate'))
+
+    if os.path.exists(source):
+        with open(source, 'rb') as f:
+            gzipped = f.read(2) == GZIP_MAGIC
+            f.seek(0)
+            for text in readChunks(f, gzipped):
+                scanner.feed(text)
+    else:
+        headers = {'Accept-Encoding': 'gzip'}
+        with CONNECTION_POOL.urlopen(source, headers=headers) as response:
+            gzipped = response.getheader('Content-Encoding') == 'gzip'
+            for text in readChunks(response, gzipped):
+                scanner.feed(text)
 
     result = OrderedDict()
 
-    for code, mgset in j_info.items():
-        if 'magicCardsInfoCode' in mgset:
-            result[code] = mgset['magicCardsInfoCode']
+    for code, fields in scanner.results.items():
+        if 'magicCardsInfoCode' in fields:
+            result[code] = fields['magicCardsInfoCode']
+
+            if release_dates is not None and 'releaseDate' in fields:
+                release_dates[code] = fields['releaseDate']
 
     return result
 
 
-def cardMaster():
+def cardMaster(set_conversion, set_cards):
     card_master = OrderedDict()
-    set_conversion = getSetConversion()
 
-    for code in set_conversion:
-        card_info = getSetInfo(set_conversion[code])
+    # Sets are merged in release order, followed by sets that have been
+    # kept from an earlier master.json but are no longer listed
+    codes = [code for code in set_conversion if code in set_cards]
+    codes += [code for code in set_cards if code not in set_conversion]
+
+    for code in codes:
+        card_info = set_cards[code]
 
         for info in card_info:
             card_name = info[0]
@@ -70,6 +138,242 @@ def cardMaster():
     return card_master
 
 
+def splitCardMaster(card_master):
+    # The inverse of cardMaster: the (name, url) pairs of every set
+    set_cards = OrderedDict()
+
+    for card_name, printings in card_master.items():
+        for code, urls in printings.items():
+            for url in urls:
+                set_cards.setdefault(code, []).append((card_name, url))
+
+    return set_cards
+
+
+def checkpointPath(checkpoint_dir, code):
+    return os.path.join(checkpoint_dir, code + '.json')
+
+
+def crawlStamp(set_conversion):
+    # Identifies the sets a crawl is based on. Checkpoints of a crawl based
+    # on another version of AllSets.json are not resumed.
+    text = json.dumps(list(set_conversion.items()))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def loadCheckpoint(checkpoint_dir, code, stamp):
+    # Returns the checkpointed cards of a set, or None if there are none or
+    # they have been crawled for another stamp
+    try:
+        with open(checkpointPath(checkpoint_dir, code), 'r') as f:
+            checkpoint = json.load(f)
+        if checkpoint['stamp'] != stamp:
+            return None
+        return tuple(tuple(info) for info in checkpoint['cards'])
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def writeAtomic(path, text):
+    # Readers never see a half written file, even if the crawl is killed
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        f.write(text)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+def crawlSets(set_conversion, set_cards, checkpoint_dir, workers):
+    # Crawls every set missing from set_cards, with up to workers requests
+    # in flight. Every crawled set is checkpointed, so a crawl that has been
+    # interrupted or failed resumes where it stopped. Checkpoints are
+    # stamped (see crawlStamp), stale ones are crawled again.
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    stamp = crawlStamp(set_conversion)
+    failed = []
+    todo = []
+
+    for code in set_conversion:
+        if code in set_cards:
+            continue
+
+        card_info = loadCheckpoint(checkpoint_dir, code, stamp)
+        if card_info is None:
+            todo.append(code)
+        else:
+            set_cards[code] = card_info
+
+    with ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(getSetInfo, set_conversion[code]): code
+            for code in todo
+        }
+
+        for future in as_completed(futures):
+            code = futures[future]
+            try:
+                card_info = future.result()
+            except (
+                OSError, http.client.HTTPException, etree.ParserError,
+                etree.XMLSyntaxError
+            ) as e:
+                sys.stderr.write('Could not crawl set %s: %s\n' % (code, e))
+                failed.append(code)
+                continue
+
+            writeAtomic(
+                checkpointPath(checkpoint_dir, code),
+                json.dumps({'stamp': stamp, 'cards': card_info})
+            )
+            set_cards[code] = card_info
+            sys.stdout.write('Crawled set %s (%d cards)\n' % (
+                code, len(card_info)
+            ))
+
+    return failed
+
+
+def probeScanSize(url):
+    address = BASE_URL + url
+    with CONNECTION_POOL.urlopen(address) as response:
+        data = response.read()
+        if response.status != 200:
+            raise http.client.HTTPException(
+                'Unexpected HTTP status %d for %s' % (response.status, address)
+            )
+    # Opening an image only reads its header
+    return list(Image.open(BytesIO(data)).size)
+
+
+def probeScanSizes(card_master, scan_sizes, workers):
+    # Adds the size of every scan missing from scan_sizes. Scans that could
+    # not be probed are left out, so a later run probes them again. Returns
+    # the urls of these scans.
+    urls = OrderedDict()
+    for printings in card_master.values():
+        for card_urls in printings.values():
+            for url in card_urls:
+                if url not in scan_sizes:
+                    urls[url] = None
+
+    failed = []
+    with ThreadPoolExecutor(workers) as executor:
+        futures = [(url, executor.submit(probeScanSize, url)) for url in urls]
+
+        # Sizes are added in the order of card_master
+        for url, future in futures:
+            try:
+                scan_sizes[url] = future.result()
+            except (OSError, http.client.HTTPException) as e:
+                # Pillow raises OSError for data that is not an image
+                sys.stderr.write('Could not probe scan %s: %s\n' % (url, e))
+                failed.append(url)
+
+    return failed
+
+
+def loadJson(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return OrderedDict()
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Recreate the card lookup (master.json) and its metadata')
+
+arg_parser.add_argument(
+    '--probe_scans',
+    help=(
+        'Record the size of every scan for --select resolution. Every scan ' +
+        'is downloaded in full, one request per printing (over 28000 for ' +
+        'the current master.json), so this takes far longer than the ' +
+        'crawl itself. Sizes already in master_meta.json are not probed ' +
+        'again'
+    ),
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    '--incremental',
+    help=(
+        'Only crawl sets missing from the existing master.json, such as ' +
+        'newly released sets'
+    ),
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    '--workers',
+    help='Number of sets crawled in parallel. Default: %d' % CRAWL_WORKERS,
+    type=int,
+    default=CRAWL_WORKERS
+)
+
+arg_parser.add_argument(
+    '--all_sets',
+    help=(
+        'URL or local copy (optionally gzip compressed) of AllSets.json. ' +
+        'Default: %s' % ALL_SETS_URL
+    ),
+    default=ALL_SETS_URL
+)
+
+arg_parser.add_argument(
+    '--checkpoints',
+    help=(
+        'Directory holding the sets crawled so far. Rerunning after an ' +
+        'interrupted crawl resumes from it. Default: %s' % CHECKPOINT_DIR
+    ),
+    default=CHECKPOINT_DIR
+)
+
+
+def main(argv=None):
+    # Returns the exit status, 1 if sets or scans are left for a rerun
+    args = arg_parser.parse_args(argv)
+    release_dates = OrderedDict()
+    set_conversion = getSetConversion(release_dates, args.all_sets)
+
+    if args.incremental:
+        set_cards = splitCardMaster(loadJson(MASTER_JSON))
+        meta = loadJson(MASTER_META)
+    else:
+        set_cards = OrderedDict()
+        meta = OrderedDict()
+
+    failed = crawlSets(
+        set_conversion, set_cards, args.checkpoints, args.workers
+    )
+    if failed:
+        sys.stderr.write(
+            'Rerun to resume the crawl of %d failed set(s)\n' % len(failed)
+        )
+        return 1
+
+    card_master = cardMaster(set_conversion, set_cards)
+    writeAtomic(MASTER_JSON, json.dumps(card_master))
+
+    meta['release_dates'] = release_dates
+    failed = []
+    if args.probe_scans:
+        scan_sizes = meta.setdefault('scan_sizes', OrderedDict())
+        failed = probeScanSizes(card_master, scan_sizes, args.workers)
+    writeAtomic(MASTER_META, json.dumps(meta))
+
+    # The crawl is complete, so the checkpoints are no longer needed
+    shutil.rmtree(args.checkpoints)
+
+    if failed:
+        sys.stderr.write(
+            'Rerun with --incremental --probe_scans to probe the %d failed '
+            'scan(s)\n' % len(failed)
+        )
+        return 1
+    return 0
+
+
 if __name__ == "__main__":
-    to_write = open('master.json', 'w')
-    to_write.write(json.dumps(cardMaster()))
+    sys.exit(main())
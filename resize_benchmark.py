@@ -0,0 +1,101 @@
+'''Measures how many card images per second every resize tier creates.
+
+A card scan is synthesized and encoded as a JPEG, then decoded and resized
+the way the page thread does (see resizeImage) at every dpi. Run with
+--scan 312x445 for the size of the magiccards.info scans, which are
+enlarged rather than reduced at these dpi.
+'''
+
+import time
+import argparse
+from io import BytesIO
+
+from PIL import Image, ImageFilter
+
+from src.constants import WIDTH, HIGHT, RESIZE_TIERS
+from src.get_image import openAndValidateImage
+from src.image_manip import resizeImage, tileSize
+
+
+def createScan(size):
+    '''Returns the JPEG data of a noisy, blurred image of the given size.
+
+    Noise keeps the JPEG from being unrealistically cheap to decode.
+    '''
+    bands = [Image.effect_noise(size, sigma) for sigma in (32, 48, 64)]
+    image = Image.merge('RGB', bands).filter(ImageFilter.GaussianBlur(1))
+
+    data = BytesIO()
+    image.save(data, 'JPEG', quality=90)
+    return data.getvalue()
+
+
+def cardsPerSecond(scan, dpi, tier, seconds, decode=True):
+    '''Decodes and resizes scan for about seconds, returns cards per second.
+
+    If decode is false, the scan is decoded once and only resized.
+    '''
+    size = tileSize(dpi, (WIDTH, HIGHT))
+    decoded = None if decode else openAndValidateImage(BytesIO(scan), size)
+    cards = 0
+    start = time.perf_counter()
+    while True:
+        image = decoded or openAndValidateImage(BytesIO(scan), size)
+        resizeImage(image, dpi, (WIDTH, HIGHT), tier).close()
+        if decode:
+            image.close()
+        cards += 1
+
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return cards / elapsed
+
+
+arg_parser = argparse.ArgumentParser(
+    description='Benchmark the resize tiers of card images')
+
+arg_parser.add_argument(
+    '--scan',
+    help='Size of the scanned card images. Default: 1488x2079',
+    default='1488x2079'
+)
+
+arg_parser.add_argument(
+    '--dpi',
+    help='Dpi of the pages. Default: 150 300 600',
+    type=int,
+    nargs='+',
+    default=[150, 300, 600]
+)
+
+arg_parser.add_argument(
+    '--seconds',
+    help='Time spent on every tier and dpi. Default: 2',
+    type=float,
+    default=2
+)
+
+arg_parser.add_argument(
+    '--resize_only',
+    help='Leave the time spent decoding the scans out',
+    action='store_true'
+)
+
+
+if __name__ == "__main__":
+    args = arg_parser.parse_args()
+    scan_size = tuple(int(n) for n in args.scan.split('x'))
+    scan = createScan(scan_size)
+
+    work = 'resizing' if args.resize_only else 'decoding and resizing'
+    print('Cards per second, %s %dx%d scans' % ((work,) + scan_size))
+    print('%-10s' % 'tier' + ''.join(
+        '%10s' % ('%d dpi' % dpi) for dpi in args.dpi
+    ))
+    for tier in RESIZE_TIERS:
+        print('%-10s' % tier + ''.join(
+            '%10.1f' % cardsPerSecond(
+                scan, dpi, tier, args.seconds, not args.resize_only
+            )
+            for dpi in args.dpi
+        ))
@@ -1,5 +1,11 @@
 import argparse
-from src.constants import DPI, WIDTH, HIGHT, PAGE_X, PAGE_Y, ARG_CONST
+from src.constants import (DPI, WIDTH, HIGHT, PAGE_X, PAGE_Y, CACHE_SIZE,
+                           FETCH_BACKENDS, ASYNC_FETCH_LIMIT, DECODE_WORKERS,
+                           SELECT_POLICIES, FRAME_ERAS, OUTPUT_FORMATS,
+                           PAGE_ENCODERS, JPEG_SUBSAMPLING, RETRIES,
+                           BASE_URL, TILE_CACHE_SIZE, FUZZY_THRESHOLD,
+                           SET_CACHE_DIR, BOOSTER_NAME, PACK_LIST_EXT,
+                           RESIZE_TIERS, ARG_CONST)
 
 
 def addFlag(name):
@@ -12,15 +18,18 @@ def addFlag(name):
 
 arg_parser = argparse.ArgumentParser(
     description=('Create printer friendly constructed decks or random ' +
-                 'boosters (not implemented yet) for Magic the Gathering'),
+                 'boosters for Magic the Gathering'),
     epilog='The Pillow module is required for this program to work')
 
 # Required file name
 arg_parser.add_argument(
     ARG_CONST['input_file'],
     help=('File path containing cards in the following format: ' +
-          '[SB:] card_number [set] card_name'),
+          '[SB:] card_number [set] card_name. Several files, or ' +
+          'directories of them, are created as a batch. - reads a deck ' +
+          'from stdin'),
     metavar='input file',
+    nargs='*',
     type=str
     )
 
@@ -85,3 +94,301 @@ arg_parser.add_argument(
     type=str,
     metavar='optional_file_path'
 )
+
+arg_parser.add_argument(
+    '-c', addFlag(ARG_CONST['cache']),
+    help=(
+        'Directory in which downloaded images are cached between runs.' +
+        ' By default, no cache is used.'
+    ),
+    type=str,
+    metavar='cache_directory'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['cache_size']),
+    help=(
+        'Maximum size of the image cache in megabytes. Least recently used' +
+        ' images are removed first. Default: %d.' % (CACHE_SIZE // 1024 ** 2)
+    ),
+    type=int,
+    default=CACHE_SIZE // 1024 ** 2,
+    metavar='megabytes'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['backend']),
+    help=(
+        'How images are fetched: a few blocking threads or an asyncio event' +
+        ' loop running many concurrent fetches. Default: %s.' %
+        FETCH_BACKENDS[0]
+    ),
+    choices=FETCH_BACKENDS,
+    default=FETCH_BACKENDS[0]
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['fetch_limit']),
+    help=(
+        'Max number of concurrent fetches of the async backend. Default: %d.'
+        % ASYNC_FETCH_LIMIT
+    ),
+    type=int,
+    default=ASYNC_FETCH_LIMIT,
+    metavar='fetches'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['workers']),
+    help=(
+        'Number of processes decoding and resizing images. With 0, images' +
+        ' are resized by the single page creating thread. Default: %d.' %
+        DECODE_WORKERS
+    ),
+    type=int,
+    default=DECODE_WORKERS,
+    metavar='processes'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['select']),
+    help=(
+        'Which printing of a card is used if several exist: from the newest' +
+        ' or oldest set, the highest resolution scan, the newest printing' +
+        ' with the frame given by --%s, or random (repeatable with --%s).' %
+        (ARG_CONST['era'], ARG_CONST['seed']) +
+        ' Scan sizes are only known if master_lookup.py was run with' +
+        ' --probe_scans, otherwise resolution is the same as newest.' +
+        ' Default: %s.' % SELECT_POLICIES[0]
+    ),
+    choices=SELECT_POLICIES,
+    default=SELECT_POLICIES[0]
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['seed']),
+    help='Seed of the random printing selection.',
+    type=str
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['era']),
+    help='Frame era used by the era printing selection. Default: %s.' %
+    FRAME_ERAS[-1][0],
+    choices=[era for era, _ in FRAME_ERAS],
+    default=FRAME_ERAS[-1][0]
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['output']),
+    help=(
+        'Save every page as its own jpg file, or all pages in a single pdf' +
+        ' file named after the input file. Default: %s.' % OUTPUT_FORMATS[0]
+    ),
+    choices=OUTPUT_FORMATS,
+    default=OUTPUT_FORMATS[0]
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['encoder']),
+    help=(
+        'Image format of the saved pages. Pages of a pdf file are always' +
+        ' jpeg. Default: %s.' % PAGE_ENCODERS[0]
+    ),
+    choices=PAGE_ENCODERS,
+    default=PAGE_ENCODERS[0]
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['quality']),
+    help='Quality (1-100) of jpeg and webp pages. Default: Pillow default.',
+    type=int,
+    metavar='1-100'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['optimize']),
+    help='Spend extra time finding smaller jpeg or png encodings.',
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['progressive']),
+    help='Save progressive jpeg pages.',
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['subsampling']),
+    help='Chroma subsampling of jpeg pages. Default: Pillow default.',
+    choices=JPEG_SUBSAMPLING
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['compress_level']),
+    help=(
+        'Compress level of png pages, from 0 (fastest) to 9 (smallest).' +
+        ' Default: Pillow default.'
+    ),
+    type=int,
+    choices=range(10),
+    metavar='0-9'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['webp_method']),
+    help=(
+        'Encoding method of webp pages, from 0 (fastest) to 6 (smallest).' +
+        ' Default: Pillow default.'
+    ),
+    type=int,
+    choices=range(7),
+    metavar='0-6'
+)
+
+arg_parser.add_argument(
+    '-v', addFlag(ARG_CONST['verbose']),
+    help='Report the encoder, and the encode time and size of every page.',
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['memory_budget']),
+    help=(
+        'Megabytes of decoded images and pages held between fetching,' +
+        ' pasting and saving. Fetching and pasting pause while it is used' +
+        ' up. By default, the number of held images and pages is limited' +
+        ' instead.'
+    ),
+    type=int,
+    metavar='megabytes'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['retries']),
+    help=(
+        'Number of times a download is retried after a timeout, network' +
+        ' or server error. Default: %d.' % RETRIES
+    ),
+    type=int,
+    default=RETRIES,
+    metavar='retries'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['hedge']),
+    help=(
+        'Send a second request for downloads slower than 95%% of recent' +
+        ' downloads, using whichever answers first.'
+    ),
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['mirror']),
+    help=(
+        'An image mirror with the layout of %s: an http(s) or file:// URL,' +
+        ' or a directory. Can be given several times. Images are' +
+        ' downloaded from the fastest working mirror, with %s as fallback.'
+    ) % (BASE_URL, BASE_URL),
+    action='append',
+    metavar='mirror'
+)
+
+# Mutually exclusive ways of serving decks
+server = arg_parser.add_mutually_exclusive_group()
+
+server.add_argument(
+    addFlag(ARG_CONST['serve']),
+    help=(
+        'Instead of creating the input files, keep running and create the' +
+        ' decks POSTed to http://localhost:port/render.'
+    ),
+    type=int,
+    metavar='port'
+)
+
+server.add_argument(
+    addFlag(ARG_CONST['socket']),
+    help='Like --serve, but serves decks at a Unix socket.',
+    type=str,
+    metavar='path'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['tile_cache']),
+    help=(
+        'Megabytes of decoded and resized card images kept in memory.' +
+        ' Default: %d when serving decks, none otherwise.' % (
+            TILE_CACHE_SIZE // 1024 ** 2
+        )
+    ),
+    type=int,
+    metavar='megabytes'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['incremental']),
+    help=(
+        'Place the cards in the order of the input file, and only create' +
+        ' the pages that changed since the last incremental run. A' +
+        ' manifest of the pages is saved next to them.'
+    ),
+    action='store_true'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['fuzzy']),
+    help=(
+        'Replace the names of unknown cards by the closest card name that' +
+        ' is at least threshold (0-1) similar. Default threshold: %s.' %
+        FUZZY_THRESHOLD
+    ),
+    type=float,
+    nargs='?',
+    const=FUZZY_THRESHOLD,
+    metavar='threshold'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['booster']),
+    help=(
+        'Create random booster packs of the given sets (mtgjson set codes)' +
+        ' instead of decks. The pages are saved as %s, and the cards of' %
+        BOOSTER_NAME + ' every pack are listed in %s%s.' % (
+            BOOSTER_NAME, PACK_LIST_EXT
+        )
+    ),
+    nargs='+',
+    metavar='set'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['packs']),
+    help='Number of booster packs created of every set. Default: 1.',
+    type=int,
+    default=1,
+    metavar='number'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['set_cache']),
+    help=(
+        'Directory the set files of boosters are downloaded to, and read' +
+        ' from later. Default: %s.' % SET_CACHE_DIR
+    ),
+    type=str,
+    default=SET_CACHE_DIR,
+    metavar='directory'
+)
+
+arg_parser.add_argument(
+    addFlag(ARG_CONST['resize']),
+    help=(
+        'How card images are resized: print (Lanczos, sharpest), balanced' +
+        ' (bicubic) or draft (integer reduction, then bilinear; fastest,' +
+        ' for proofs). Default: %s.' % RESIZE_TIERS[0]
+    ),
+    choices=RESIZE_TIERS,
+    default=RESIZE_TIERS[0]
+)
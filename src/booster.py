@@ -0,0 +1,102 @@
+'''Samples booster packs of a set from its cards grouped by rarity.
+
+The slots of a pack are taken from the booster list of the set JSON, or
+BOOSTER_TEMPLATE if it has none. Identical slots are grouped, and all packs
+are drawn at once, a group at a time: the rarity of every pack is chosen in
+a single call, and the cards are dealt from shuffled copies of the cards of
+that rarity, like the print sheets of real packs. The cards of a pack are
+taken from a single shuffle, so no pack holds the same card twice unless a
+rarity has fewer cards than its slots.
+'''
+
+import random
+from collections import OrderedDict
+
+from src.constants import BOOSTER_TEMPLATE, BOOSTER_RARITIES, BOOSTER_WEIGHTS
+
+
+def boosterSlots(set_dict):
+    '''Returns the slots of a pack of the set, each a tupple of rarities.
+
+    Slots are given by booster names (see BOOSTER_RARITIES), a slot of
+    several names draws from one of them.
+    '''
+    template = set_dict.get('booster') or BOOSTER_TEMPLATE
+    return [
+        tuple(slot) if isinstance(slot, (list, tuple)) else (slot,)
+        for slot in template
+    ]
+
+
+class MgBoosterSampler(object):
+
+    '''Draws booster packs of a set.
+
+    Rarities is the dict returned by parseLocalSetForRarity and slots the
+    list returned by boosterSlots. Slots without cards of any of their
+    rarities are left out of the packs. Packs are repeatable with a seed.
+    '''
+
+    def __init__(self, rarities, slots, seed=None):
+        # Cards listed several times (basic lands) are drawn as one card
+        self.pools = dict(
+            (rarity, sorted(set(names))) for rarity, names in rarities.items()
+        )
+        self.random = random.Random(seed)
+
+        # Identical slots (key) and their number (value)
+        groups = OrderedDict()
+        for slot in slots:
+            names = tuple(
+                name.lower() for name in slot
+                if self.pools.get(BOOSTER_RARITIES.get(name.lower()))
+            )
+            if names:
+                groups[names] = groups.get(names, 0) + 1
+        self.groups = list(groups.items())
+
+    def sample(self, packs):
+        '''Returns packs booster packs, each a list of card names.'''
+        result = [[] for _ in range(packs)]
+        for names, count in self.groups:
+            if len(names) > 1:
+                weights = [BOOSTER_WEIGHTS.get(name, 1) for name in names]
+                chosen = self.random.choices(names, weights, k=packs)
+            else:
+                chosen = names * packs
+
+            for name in names:
+                pack_numbers = [
+                    number for number, choice in enumerate(chosen)
+                    if choice == name
+                ]
+                cards = self.deal(
+                    self.pools[BOOSTER_RARITIES[name]], count,
+                    len(pack_numbers)
+                )
+                for index, number in enumerate(pack_numbers):
+                    result[number].extend(
+                        cards[index * count:(index + 1) * count]
+                    )
+
+        return result
+
+    def deal(self, pool, count, packs):
+        '''Returns count cards for each of packs packs, drawn from pool.
+
+        Every shuffle of pool is dealt to as many packs as it has count
+        cards for, the rest of it is left over.
+        '''
+        if len(pool) < count:
+            return self.random.choices(pool, k=count * packs)
+
+        per_shuffle = len(pool) // count
+        sheet = list(pool)
+        cards = []
+        while packs > 0:
+            self.random.shuffle(sheet)
+            dealt = min(per_shuffle, packs)
+            cards.extend(sheet[:dealt * count])
+            packs -= dealt
+
+        return cards
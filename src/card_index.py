@@ -0,0 +1,225 @@
+'''A compiled index of master.json that is opened lazily.
+
+Loading master.json means parsing about 1 MB of JSON into nested dicts,
+which every run used to pay at import time. The index compiles it once into
+an SQLite file next to it, in which a single card is looked up through the
+primary key without reading the rest. The index is rebuilt automatically
+whenever master.json is newer than it.
+
+The printings of each card are stored in the order used by MgCardSelector,
+computed from the release order of the sets and the optional release dates
+and scan sizes in master_meta.json (see master_lookup.py).
+
+The index also stores the trigrams of the card names, from which misspelt
+names are matched to the closest card (see fuzzy_match.py).
+'''
+
+import os
+import json
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+
+from src.constants import (
+    MgLookupException, MASTER_JSON, MASTER_INDEX, MASTER_META
+)
+from src.logger_dict import MG_LOGGER_CONST
+from src.fuzzy_match import MgFuzzyIndex, buildGrams
+from src.card_select import (
+    MgPrinting, MgCardEntry, setRanks, setEras, createEntry
+)
+
+# Bumped whenever the layout of the index changes, forcing a rebuild
+INDEX_VERSION = 4
+
+
+class MgCardIndex(object):
+
+    '''Looks up the printings of a card in the compiled index.
+
+    Every thread gets its own read-only connection to the index, as SQLite
+    connections cannot be shared between threads.
+    '''
+
+    def __init__(
+        self, json_path=MASTER_JSON, index_path=MASTER_INDEX,
+        meta_path=MASTER_META
+    ):
+        self.json_path = json_path
+        self.index_path = index_path
+        self.meta_path = meta_path
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._checked = False
+        self._fuzzy = None
+
+    def lookup(self, card_name):
+        '''Returns the MgCardEntry of a card.
+
+        Raises KeyError if the card does not exist.
+        '''
+        row = self.connection().execute(
+            'SELECT printings, picks FROM cards WHERE name = ?', (card_name,)
+        ).fetchone()
+
+        if row is None:
+            raise KeyError(card_name)
+
+        printings = [MgPrinting(*p) for p in json.loads(row[0])]
+        return MgCardEntry(printings, json.loads(row[1]))
+
+    def __contains__(self, card_name):
+        return self.connection().execute(
+            'SELECT 1 FROM cards WHERE name = ?', (card_name,)
+        ).fetchone() is not None
+
+    def closest(self, card_name, threshold=0):
+        '''Returns the card name closest to card_name and its similarity.
+
+        Returns None if no card is at least threshold similar (see
+        MgFuzzyIndex.closest). The trigrams are loaded on the first call.
+        '''
+        connection = self.connection()
+        with self._lock:
+            if self._fuzzy is None:
+                names = [row[0] for row in connection.execute(
+                    'SELECT name FROM cards ORDER BY name'
+                )]
+                grams = {
+                    gram: json.loads(indices)
+                    for gram, indices in connection.execute(
+                        'SELECT gram, names FROM grams'
+                    )
+                }
+                self._fuzzy = MgFuzzyIndex(names, grams)
+
+        return self._fuzzy.closest(card_name, threshold)
+
+    def connection(self):
+        '''Returns the connection of the current thread.'''
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            self.ensureBuilt()
+            connection = sqlite3.connect(
+                'file:%s?mode=ro' % os.path.abspath(self.index_path),
+                uri=True, check_same_thread=False
+            )
+            self._local.connection = connection
+
+        return connection
+
+    def ensureBuilt(self):
+        '''(Re)builds the index if it is missing or out of date.'''
+        with self._lock:
+            if self._checked:
+                return
+
+            if self.isStale():
+                self.build()
+            self._checked = True
+
+    def isStale(self):
+        '''True if the index does not exist or is older than master.json.'''
+        try:
+            index_time = os.path.getmtime(self.index_path)
+        except OSError:
+            return True
+
+        for path in (self.json_path, self.meta_path):
+            try:
+                if os.path.getmtime(path) > index_time:
+                    return True
+            except OSError:
+                # Without master.json, any existing index is the best there is
+                pass
+
+        try:
+            with closing(sqlite3.connect(self.index_path)) as connection:
+                version = connection.execute(
+                    'PRAGMA user_version'
+                ).fetchone()[0]
+        except sqlite3.DatabaseError:
+            return True
+
+        return version != INDEX_VERSION
+
+    def build(self):
+        '''Compiles master.json into the index.
+
+        The index is written to a temporary file and renamed, so concurrent
+        runs never see a half written index.
+        '''
+        try:
+            with open(self.json_path, 'r') as f:
+                card_urls = json.load(f)
+        except (IOError, ValueError):
+            raise MgLookupException(
+                MG_LOGGER_CONST['index_error'] % self.json_path
+            )
+
+        meta = self.loadMeta()
+        ranks = setRanks(card_urls, meta.get('release_dates'))
+        eras = setEras(ranks)
+        scan_sizes = meta.get('scan_sizes')
+
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=directory)
+        os.close(fd)
+
+        try:
+            connection = sqlite3.connect(tmp_path)
+            with connection:
+                connection.execute(
+                    'CREATE TABLE cards ('
+                    'name TEXT PRIMARY KEY, printings TEXT NOT NULL, '
+                    'picks TEXT NOT NULL'
+                    ') WITHOUT ROWID'
+                )
+                connection.executemany(
+                    'INSERT INTO cards VALUES (?, ?, ?)',
+                    self.rows(card_urls, ranks, eras, scan_sizes)
+                )
+                # Names are referred to by their position in name order
+                connection.execute(
+                    'CREATE TABLE grams ('
+                    'gram TEXT PRIMARY KEY, names TEXT NOT NULL'
+                    ') WITHOUT ROWID'
+                )
+                connection.executemany(
+                    'INSERT INTO grams VALUES (?, ?)', (
+                        (gram, json.dumps(indices)) for gram, indices in
+                        buildGrams(sorted(card_urls)).items()
+                    )
+                )
+                connection.execute('PRAGMA user_version = %d' % INDEX_VERSION)
+            connection.close()
+
+            # mkstemp creates files only readable by the owner
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.index_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def rows(self, card_urls, ranks, eras, scan_sizes):
+        '''Yields the rows of the cards table.'''
+        for name, printings_by_set in card_urls.items():
+            entry = createEntry(printings_by_set, ranks, eras, scan_sizes)
+            yield (
+                name,
+                json.dumps([list(p) for p in entry.printings]),
+                json.dumps(entry.picks)
+            )
+
+    def loadMeta(self):
+        '''Returns the contents of master_meta.json or an empty dict.'''
+        try:
+            with open(self.meta_path, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+# The index used to look up card images
+CARD_INDEX = MgCardIndex()
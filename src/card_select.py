@@ -0,0 +1,201 @@
+'''Chooses which printing of a card is used for its image.
+
+Most cards have been printed in several sets, and basic lands several times
+within one set. The choice used to be random, so the same deck resolved to
+different images on every run. MgCardSelector picks a printing according to
+a policy instead, using the ordering precomputed by the card index.
+
+Scan sizes are only known for master.json files crawled with
+master_lookup.py --probe_scans. Without them, the 'resolution' policy picks
+the same printing as 'newest'.
+'''
+
+import hashlib
+import heapq
+from collections import namedtuple, defaultdict, Counter
+
+from src.constants import SELECT_POLICIES, FRAME_ERAS
+
+# A single printing of a card. Rank is the release order of its set (higher
+# is newer). Width and hight are 0 if the scan size is unknown.
+MgPrinting = namedtuple('MgPrinting', 'set_code url rank width hight era')
+
+# The printings of a card, newest set first and within a set in master.json
+# order, and the index of the printing chosen by each policy that does not
+# depend on the set or a seed
+MgCardEntry = namedtuple('MgCardEntry', 'printings picks')
+
+
+def setRanks(card_urls, release_dates=None):
+    '''Returns a dict of set code (key) and release order (value).
+
+    master.json lists the sets of every card in the order the sets were
+    crawled, which is their release order. Merging these per card orders
+    (a topological sort) recovers the release order of all sets. Release
+    dates, if known, take precedence. Sets are ranked from 0 (oldest) up.
+    '''
+    successors = defaultdict(set)
+    indegree = Counter()
+    first_seen = {}
+
+    for printings in card_urls.values():
+        codes = list(printings)
+        for code in codes:
+            first_seen.setdefault(code, len(first_seen))
+        for before, after in zip(codes, codes[1:]):
+            if after not in successors[before]:
+                successors[before].add(after)
+                indegree[after] += 1
+
+    heap = [(first_seen[code], code) for code in first_seen
+            if indegree[code] == 0]
+    heapq.heapify(heap)
+    order = []
+
+    while heap:
+        _, code = heapq.heappop(heap)
+        order.append(code)
+        for after in successors[code]:
+            indegree[after] -= 1
+            if indegree[after] == 0:
+                heapq.heappush(heap, (first_seen[after], after))
+
+    # Contradicting orders leave cycles behind, which keep first seen order
+    placed = set(order)
+    order.extend(sorted(
+        (code for code in first_seen if code not in placed),
+        key=first_seen.get
+    ))
+    crawl_rank = {code: rank for rank, code in enumerate(order)}
+
+    # Release dates are only used if every set has one
+    if release_dates and all(code in release_dates for code in order):
+        order.sort(key=lambda code: (
+            release_dates[code], crawl_rank[code]
+        ))
+
+    return {code: rank for rank, code in enumerate(order)}
+
+
+def setEras(ranks):
+    '''Returns a dict of set code (key) and frame era (value).
+
+    A set has the frame of the latest era introduced at or before it.
+    '''
+    boundaries = [
+        (ranks.get(code, -1), era) for era, code in FRAME_ERAS
+    ]
+
+    eras = {}
+    for code, rank in ranks.items():
+        eras[code] = FRAME_ERAS[0][0]
+        for boundary, era in boundaries:
+            if rank >= boundary:
+                eras[code] = era
+
+    return eras
+
+
+def createEntry(printings_by_set, ranks, eras, scan_sizes=None):
+    '''Creates the MgCardEntry of a card from its master.json printings.'''
+    scan_sizes = scan_sizes or {}
+    printings = []
+
+    for set_code, urls in printings_by_set.items():
+        for url in urls:
+            width, hight = scan_sizes.get(url, (0, 0))
+            printings.append(MgPrinting(
+                set_code, url, ranks[set_code], width, hight, eras[set_code]
+            ))
+
+    # Newest set first. The sort is stable, so the printings of a set keep
+    # their master.json order, which is the order of their card numbers.
+    printings.sort(key=lambda p: -p.rank)
+
+    def largest(indices):
+        # The largest known scan, the first printing if none is known
+        return max(indices, key=lambda i: (scanArea(printings[i]), -i))
+
+    def inSet(rank):
+        return [i for i, p in enumerate(printings) if p.rank == rank]
+
+    picks = {
+        'newest': largest(inSet(printings[0].rank)),
+        'oldest': inSet(printings[-1].rank)[0]
+    }
+    picks['resolution'] = largest(range(len(printings)))
+    if scanArea(printings[picks['resolution']]) == 0:
+        picks['resolution'] = picks['newest']
+    for era, _ in FRAME_ERAS:
+        for printing in printings:
+            if printing.era == era:
+                picks['era:' + era] = largest(inSet(printing.rank))
+                break
+
+    return MgCardEntry(printings, picks)
+
+
+def scanArea(printing):
+    '''The pixels of the scan of a printing, 0 if its size is unknown.'''
+    return printing.width * printing.hight
+
+
+class MgCardSelector(object):
+
+    '''Picks a printing from an MgCardEntry according to a policy.
+
+    Policies are 'newest', 'oldest', 'resolution' (largest scan), 'era'
+    (newest printing with the frame of the given era) and 'random' (random,
+    but the same for a given seed and card). Without a set, the choice is
+    a precomputed lookup. With a set, only the few printings of that set are
+    considered.
+
+    Within a set, 'oldest' picks the first printing (the lowest card number)
+    and the other policies the largest known scan. If no scan size is
+    known, 'resolution' picks the same printing as 'newest', which is the
+    first printing of the newest set.
+    '''
+
+    def __init__(self, policy=SELECT_POLICIES[0], seed=None, era=None):
+        if policy not in SELECT_POLICIES:
+            raise ValueError('Unknown selection policy %s' % policy)
+
+        self.policy = policy
+        self.seed = seed
+        self.era = era or FRAME_ERAS[-1][0]
+
+    def select(self, card_name, entry, set_name=None):
+        '''Returns the chosen MgPrinting. Raises KeyError for unknown sets.'''
+        if set_name is None:
+            printings = entry.printings
+            if self.policy == 'random':
+                return printings[self.randomIndex(card_name, len(printings))]
+            if self.policy == 'era':
+                index = entry.picks.get('era:' + self.era, 0)
+            else:
+                index = entry.picks[self.policy]
+            return printings[index]
+
+        printings = [p for p in entry.printings if p.set_code == set_name]
+        if not printings:
+            raise KeyError(set_name)
+
+        if self.policy == 'oldest':
+            return printings[0]
+        if self.policy == 'random':
+            key = card_name + '\0' + set_name
+            return printings[self.randomIndex(key, len(printings))]
+
+        # max returns the first of equally large scans
+        return max(printings, key=scanArea)
+
+    def randomIndex(self, key, length):
+        '''A random index that only depends on the seed and the key.'''
+        digest = hashlib.sha1(
+            ('%s\0%s' % (self.seed, key)).encode('utf-8')
+        ).digest()
+        return int.from_bytes(digest[:8], 'big') % length
+
+
+# The selector used if none is specified
+DEFAULT_SELECTOR = MgCardSelector()
@@ -1,14 +1,21 @@
-import sys
-import json
-
-
 class MgException(Exception):
     '''Base Exception class used for this program'''
     pass
 
 
 class MgNetworkException(MgException):
-    '''Thrown if the website cannot be reached.'''
+    '''Thrown if the website cannot be reached.
+
+    Status is the HTTP status code of the response, if there was one.
+    '''
+
+    def __init__(self, *args, status=None):
+        super(MgNetworkException, self).__init__(*args)
+        self.status = status
+
+
+class MgTransientNetworkException(MgNetworkException):
+    '''Thrown if the website could not be reached, but might be later.'''
     pass
 
 
@@ -28,11 +35,72 @@ PAGE_X, PAGE_Y = 4, 2  # Default number of cards per jpg file
 BASE_URL = 'http://magiccards.info/scans/en'  # URL of image database
 BASE_URL_JSON = 'http://mtgjson.com/'  # URL of JSON database
 JSON_EXT = '.json'  # Extension for json files on mtgjson.com
-TIMEOUT = 5  # Timeout (sec) for urllib2.geturl()
+MASTER_JSON = 'master.json'  # Card name to image URL lookup
+MASTER_INDEX = 'master.sqlite'  # Compiled index of MASTER_JSON
+MASTER_META = 'master_meta.json'  # Set release dates and scan sizes
+SET_CACHE_DIR = 'set_cache'  # Directory of the downloaded set JSON files
+SET_CACHE_AGE = 24 * 3600  # Age (sec) after which a cached set is revalidated
+SELECT_POLICIES = ('newest', 'oldest', 'resolution', 'era', 'random')
+
+# Card frame eras and the set introducing them, oldest first
+FRAME_ERAS = (('original', None), ('modern', '8ED'), ('m15', 'M15'))
+TIMEOUT = 5  # Timeout (sec) for network requests
+MIN_TIMEOUT = 1  # Lowest timeout (sec) adapted to the observed latencies
+RETRIES = 2  # Retries of a request that failed transiently
+BACKOFF = 0.2  # Mean wait (sec) before the first retry, doubled per retry
+LATENCY_WINDOW = 200  # Number of latest request latencies kept
+LATENCY_SAMPLES = 20  # Latencies needed before timeouts adapt
+NEGATIVE_TTL = 300  # Time (sec) permanent failures are remembered
+NEGATIVE_SIZE = 10000  # Max number of permanent failures remembered
+RETRY_STATUS = (408, 429)  # HTTP client errors that are retried
+POOL_SIZE = 8  # Max number of idle connections kept per host
+MAX_REDIRECTS = 5  # Max number of redirects followed per request
+STREAM_CHUNK = 64 * 1024  # Max bytes read at once from a streamed download
 IMAGE_GET_THREAD = 3  # Number of threads created to fetch images
+FETCH_BACKENDS = ('thread', 'async')  # Available image fetch backends
+ASYNC_FETCH_LIMIT = 100  # Max number of concurrent fetches (async backend)
 PAGE_SAVE_THREAD = 2  # Number of threads created to save pages
+DECODE_WORKERS = 0  # Processes decoding/resizing images (0: page thread does)
+MAX_CARD_QUEUE = 100  # Max number of cards waiting for the image getters
 MAX_IMAGE_QUEUE = 20  # Max number of images that can be stored in a Queue
 MAX_PAGE_QUEUE = 5  # Max number of pages held in Queue
+MEMORY_BUDGET = None  # Bytes of images and pages queued (None: count based)
+BATCH_DECKS = 2  # Max number of decks created at the same time in a batch
+DECK_EXTENSIONS = ('.txt', '.dec', '.mwdeck')  # Deck files in a directory
+STDIN_DECK = '-'  # Input file name of a deck read from stdin
+STDIN_NAME = 'stdin'  # File name of the pages of a deck read from stdin
+IMAGE_EXTENSIONS = (
+    '.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp'
+)  # Extensions of local images, ignored when resolving card names
+LOCAL_INDEX_CHECK = 1  # Min time (sec) between checks for local image changes
+CACHE_SIZE = 512 * 1024 ** 2  # Default byte budget of the image cache
+TILE_CACHE_SIZE = 256 * 1024 ** 2  # Default bytes of resized images served
+SERVE_HOST = '127.0.0.1'  # Decks are only served to the local machine
+OUTPUT_FORMATS = ('jpg', 'pdf')  # A jpg file per page or a single pdf file
+PAGE_ENCODERS = ('jpeg', 'png', 'webp')  # Available page encoders
+JPEG_SUBSAMPLING = ('4:4:4', '4:2:2', '4:2:0')  # Chroma subsampling options
+RESIZE_TIERS = ('print', 'balanced', 'draft')  # Resampling, best to fastest
+MANIFEST_EXT = '.manifest.json'  # Suffix of the manifest of saved pages
+FUZZY_THRESHOLD = 0.75  # Min similarity (0-1) of a card replacing a misspelt
+FUZZY_SUGGEST = 0.5  # Min similarity (0-1) of a card suggested in errors
+BOOSTER_NAME = 'boosters'  # File name of the pages of booster packs
+PACK_LIST_EXT = '.packs.txt'  # Suffix of the list of cards in every pack
+
+# Slots of a booster pack, for sets whose JSON does not list them. A slot
+# lists the rarities (mtgjson booster names) its card is drawn from.
+BOOSTER_TEMPLATE = (
+    (('rare', 'mythic rare'),) + (('uncommon',),) * 3 +
+    (('common',),) * 10 + (('land',),)
+)
+
+# The rarity of the cards of a booster slot name (others are not drawn)
+BOOSTER_RARITIES = {
+    'common': 'Common', 'uncommon': 'Uncommon', 'rare': 'Rare',
+    'mythic rare': 'Mythic Rare', 'land': 'Basic Land'
+}
+
+# Relative odds of the rarities of a slot listing several (default 1)
+BOOSTER_WEIGHTS = {'rare': 7, 'mythic rare': 1}
 
 # The options used for args parsing (see src/argv_input)
 ARG_CONST = {
@@ -58,11 +126,95 @@ ARG_CONST = {
     'alt_name': 'opt_file_name',
 
     # Different file path
-    'opt_path': 'opt_file_path'
-}
+    'opt_path': 'opt_file_path',
+
+    # Directory of the persistent image cache
+    'cache': 'cache_dir',
+
+    # Size of the image cache in megabytes
+    'cache_size': 'cache_size',
+
+    # Backend used to fetch images
+    'backend': 'fetch_backend',
+
+    # Max number of concurrent fetches of the async backend
+    'fetch_limit': 'fetch_limit',
+
+    # Number of processes decoding and resizing images
+    'workers': 'decode_workers',
+
+    # Policy choosing the printing of a card
+    'select': 'select',
+
+    # Seed of the random selection policy
+    'seed': 'seed',
+
+    # Frame era of the era selection policy
+    'era': 'frame_era',
+
+    # Pages are saved as jpg files or a pdf document
+    'output': 'output_format',
+
+    # Encoder of the saved pages
+    'encoder': 'encoder',
+
+    # Quality of the jpeg and webp encoders
+    'quality': 'quality',
 
-try:
-    CARD_URLS = json.load(open('master.json', 'r'))
-except IOError:
-    sys.stderr.write('Cannot open master.json lookup\n')
-    sys.exit()
+    # Extra pass finding the smallest jpeg or png encoding
+    'optimize': 'optimize',
+
+    # Progressive jpeg encoding
+    'progressive': 'progressive',
+
+    # Chroma subsampling of the jpeg encoder
+    'subsampling': 'subsampling',
+
+    # Compress level of the png encoder
+    'compress_level': 'compress_level',
+
+    # Speed/size trade-off of the webp encoder
+    'webp_method': 'webp_method',
+
+    # Report encoding statistics of every page
+    'verbose': 'verbose',
+
+    # Megabytes of images and pages held by the queues
+    'memory_budget': 'memory_budget',
+
+    # Retries of a request that failed transiently
+    'retries': 'retries',
+
+    # Hedge requests slower than usual with a second request
+    'hedge': 'hedge',
+
+    # Image mirrors tried before BASE_URL
+    'mirror': 'mirror',
+
+    # Port decks are served at
+    'serve': 'serve',
+
+    # Unix socket decks are served at
+    'socket': 'socket',
+
+    # Megabytes of resized images kept in memory
+    'tile_cache': 'tile_cache',
+
+    # Only create the pages that changed since the last run
+    'incremental': 'incremental',
+
+    # Replace unknown card names by the closest card
+    'fuzzy': 'fuzzy',
+
+    # Quality and speed of resizing card images
+    'resize': 'resize',
+
+    # Create booster packs of the given sets instead of decks
+    'booster': 'booster',
+
+    # Number of booster packs created of every set
+    'packs': 'packs',
+
+    # Directory the set JSON files of boosters are cached in
+    'set_cache': 'set_cache'
+}
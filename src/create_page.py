@@ -1,9 +1,26 @@
+import os
 from queue import Queue
+from collections import deque, OrderedDict
 
 from src.mg_thread import (MgReport, MgGetImageThread, MgImageCreateThread,
-                           MgSaveThread, MgQueueCar)
+                           MgSaveThread, MgQueueCar, MgFetchCoalescer,
+                           MgPageStore, MgJob, MgFairQueue, removeFile)
+from src.mg_async import MgAsyncGetImageThread
+from src.get_image import localImageKey, createPolicyAddress
+from src.fetch_policy import FETCH_POLICY
+from src.page_encoder import MgJpegEncoder
+from src.page_manifest import MgPageManifest, planPages
+from src.tile_pool import MgTilePool
+from src.pdf_writer import MgPdfWriter
+from src.memory_governor import MgMemoryGovernor, MgBudgetQueue
+from src.image_manip import tileSize
 from src.constants import (IMAGE_GET_THREAD, PAGE_SAVE_THREAD, MAX_IMAGE_QUEUE,
-                           MAX_PAGE_QUEUE)
+                           MAX_PAGE_QUEUE, FETCH_BACKENDS, ASYNC_FETCH_LIMIT,
+                           DECODE_WORKERS, OUTPUT_FORMATS, MEMORY_BUDGET,
+                           BATCH_DECKS, MANIFEST_EXT, MAX_CARD_QUEUE,
+                           RESIZE_TIERS, MgLookupException,
+                           MgNetworkException)
+from src.logger_dict import MG_LOGGER_CONST, logCardName
 
 
 class MgImageCreator(object):
@@ -12,70 +29,409 @@ class MgImageCreator(object):
 
     This object takes the canvas DPI, the width/hight of cards, and the number
     of cards on each canvas. The save directory and file_name are also given.
-    Lastly, an optional logger object can be provided.
+    Lastly, an optional logger object and MgImageCache can be provided.
+    Images are fetched by threads, or by an asyncio event loop running up to
+    fetch_limit concurrent fetches if the backend is 'async'. If workers is
+    not zero, images are decoded and resized by that many processes. The
+    optional MgCardSelector chooses the printing of each card. Pages are
+    saved as jpg files, or as a single pdf file if output is 'pdf'. Pages are
+    encoded by the optional MgPageEncoder, JPEG with Pillow's defaults if
+    none is given. If a memory_budget (in bytes) is given, the queues are
+    bounded by the bytes of the images and pages they hold rather than by
+    their number. The optional MgFetchPolicy retries failed downloads, and
+    the optional MgSourceRouter spreads them over several image mirrors.
+    The optional MgTileCache keeps resized images in memory for later decks.
+    Card images are resized with the quality and speed of the resize tier
+    (see image_manip.resizeImage).
     '''
 
-    def __init__(self, dpi, wh, xy, logger=None):
+    def __init__(
+        self, dpi, wh, xy, logger=None, cache=None,
+        backend=FETCH_BACKENDS[0], fetch_limit=ASYNC_FETCH_LIMIT,
+        workers=DECODE_WORKERS, selector=None, output=OUTPUT_FORMATS[0],
+        encoder=None, memory_budget=MEMORY_BUDGET, policy=None, router=None,
+        tile_cache=None, resize=RESIZE_TIERS[0]
+    ):
         self.dpi = dpi
         self.wh = wh
         self.xy = xy
         self.logger = logger
+        self.cache = cache
+        self.backend = backend
+        self.fetch_limit = fetch_limit
+        self.workers = workers
+        self.selector = selector
+        self.output = output
+        self.encoder = encoder
+        self.memory_budget = memory_budget
+        self.policy = policy
+        self.router = router
+        self.tile_cache = tile_cache
+        self.resize = resize
+
+        # The image getters and governor shared by createDeck (see start)
+        self._stage = None
+        self._governor = None
 
     def create(self, local, input_array, directory, file_name):
         '''Initiates the creation of pictures.
 
         If local is true, takes pictures from files found in directory.
-        Input array is a list of tupples for each card.
+        Input array is an iterable of tupples for each card. It is consumed
+        as the cards are queued for the image getters, so a generator
+        reading the deck lets the first pages be created while the rest of
+        the deck is still being read.
         Pages will be saved to directory with file_name.
 
         Creates three serial Queue chains linking the three created thread
         groups. First thread group downloads the images from the web,
         passed them to the thread that creates the printable page, which
         in turn is passed to the thread group that saves the page to hard disk.
+        Cards listed on several lines are only fetched once, and pages
+        identical to an earlier page are only encoded once. In pdf output,
+        all pages are saved to the file_name pdf in directory.
+        '''
+        return list(self.createBatch(
+            local, [(input_array, directory, file_name)]
+        ))[0]
+
+    def createBatch(self, local, decks):
+        '''Creates the pages of several decks, yielding their reports.
+
+        Decks is an iterable of (input_array, directory, file_name) tupples,
+        each handled as by create. It is consumed lazily. All decks share one
+        group of image getter threads (and decode processes), so images are
+        fetched, cached and decoded only once for all of them. Every deck has
+        its own page and save threads, file names and MgReport. Up to
+        BATCH_DECKS decks are in flight at a time, so the pages of one deck
+        are pasted while the images of the next are fetched. The MgReports
+        are yielded in the order of the decks.
         '''
+        governor = self.createGovernor()
+        stage = MgFetchStage(self)
+        running = deque()
+        try:
+            for input_array, directory, file_name in decks:
+                # source is an empty string for web, directory for local images
+                source = directory if local else ''
+                running.append(self.startDeck(
+                    stage, governor, source, input_array, directory, file_name
+                ))
+                if len(running) >= BATCH_DECKS:
+                    yield self.finishDeck(running.popleft(), governor)
+
+            while running:
+                yield self.finishDeck(running.popleft(), governor)
+        finally:
+            # Decks still running when the caller gives up are finished
+            for deck in running:
+                self.finishDeck(deck, governor)
+            stage.close()
+
+    def start(self):
+        '''Starts the image getters shared by the decks of createDeck.'''
+        self._governor = self.createGovernor()
+        self._stage = MgFetchStage(self)
+
+    def createDeck(self, input_array, directory, file_name, source=''):
+        '''Creates the pages of a deck with the image getters of start.
+
+        Like create, but several decks can be created at the same time by
+        different threads. Local images are taken from the source directory,
+        web images are used if source is an empty string. The image getters
+        take turns between the cards of the decks being created.
+        '''
+        deck = self.startDeck(
+            self._stage, self._governor, source, input_array, directory,
+            file_name
+        )
+        return self.finishDeck(deck, self._governor)
 
-        # source is an empty string for web, directory for local images
+    def close(self):
+        '''Stops the image getters of start, once all decks are finished.
+
+        The threads of hedged requests of the MgFetchPolicy are stopped too.
+        '''
+        self._stage.close()
+        self._stage = None
+        (self.policy or FETCH_POLICY).close()
+
+    def createGovernor(self):
+        '''Returns the MgMemoryGovernor of the memory budget, or None.'''
+        if self.memory_budget is None:
+            return None
+
+        return MgMemoryGovernor(self.memory_budget)
+
+    def createIncremental(self, local, input_array, directory, file_name):
+        '''Creates only the pages that changed since the last run.
+
+        Like create, but cards are placed on the pages in the order of the
+        deck, and an MgPageManifest of the pages is saved next to them. Pages
+        whose cards, parameters and file are the same as in the manifest of
+        an earlier run are kept as they are. Pages left over from a longer
+        deck are removed. Only jpg (or other page files) output is supported.
+        '''
         source = directory if local else ''
+        extension = (self.encoder or MgJpegEncoder()).extension
+        manifest_path = os.path.join(directory, file_name + MANIFEST_EXT)
+        params = {
+            'dpi': self.dpi, 'wh': list(self.wh), 'xy': list(self.xy),
+            'encoder': (self.encoder or MgJpegEncoder()).describe(),
+            'resize': self.resize
+        }
+
+        def pagePath(page_number):
+            return os.path.join(
+                directory, file_name + str(page_number) + extension
+            )
+
+        # Cards that cannot be resolved are left out, as they would be by
+        # the image getters
+        cards, slot_keys, errors = self.resolveCards(source, input_array)
+        plan = planPages(slot_keys, self.xy[0] * self.xy[1])
+        old_manifest = MgPageManifest.load(manifest_path)
+        changed = set(
+            page_number for page_number, slots in enumerate(plan)
+            if old_manifest is None or not old_manifest.unchanged(
+                page_number, slots, params, pagePath(page_number)
+            )
+        )
+
+        # Every card is fetched once for all its slots on changed pages
+        card_input = []
+        card_slots = []
+        slot_number = 0
+        for card_tupple in cards:
+            slots = []
+            for _ in range(card_tupple[1]):
+                page_number, slot = divmod(
+                    slot_number, self.xy[0] * self.xy[1]
+                )
+                if page_number in changed:
+                    slots.append((page_number, slot))
+                slot_number += 1
+
+            if slots:
+                card_input.append(
+                    card_tupple[:1] + [len(slots)] + card_tupple[2:]
+                )
+                card_slots.append(slots)
+
+        stage = MgFetchStage(self)
+        governor = self.createGovernor()
+        try:
+            deck = self.startDeck(
+                stage, governor, source, card_input, directory, file_name,
+                dict((n, plan[n]) for n in changed), card_slots
+            )
+            reporter = self.finishDeck(deck, governor)
+        finally:
+            stage.close()
+
+        for error in errors:
+            self.logError(error, reporter)
+
+        manifest = MgPageManifest(params)
+        if old_manifest is not None and old_manifest.params == params:
+            manifest.pages = old_manifest.pages[:len(plan)]
+
+        # Pages left with empty slots are created again by the next run.
+        # Changed pages that were not saved (none of their cards could be
+        # fetched) must not keep the cards of the earlier run.
+        incomplete = set(reporter.incomplete_pages)
+        saved = set(reporter.saved_pages)
+        for page_number in sorted(changed):
+            if page_number not in saved:
+                removeFile(pagePath(page_number))
+            manifest.setPage(
+                page_number, plan[page_number],
+                pagePath(page_number)
+                if page_number in saved and page_number not in incomplete
+                else None
+            )
+
+        if old_manifest is not None:
+            for page_number in range(len(plan), len(old_manifest.pages)):
+                removeFile(pagePath(page_number))
+
+        try:
+            manifest.save(manifest_path)
+        except OSError as e:
+            self.logError(MG_LOGGER_CONST['save_fail'] % (
+                manifest_path, e.strerror or e
+            ), reporter)
+
+        reporter.setUnchangedPages(len(plan) - len(changed))
+        return reporter
+
+    def createPacks(self, local, packs, directory, file_name):
+        '''Creates the pages of booster packs, keeping every pack together.
+
+        Packs is a list of (set code, card names) tupples. Like create, but
+        the cards of each pack are placed in consecutive slots, in the order
+        of the packs. A card is fetched once for all its slots on a page,
+        and the cards are queued page by page, so only the pages being
+        filled are held in memory. With an MgTileCache, a card on several
+        pages is only decoded once.
+        '''
+        source = directory if local else ''
+        per_page = self.xy[0] * self.xy[1]
+
+        # The slots of every card on every page (key), in page order
+        card_slots = OrderedDict()
+        slot_keys = []
+        for set_code, card_names in packs:
+            for card_name in card_names:
+                page_number, slot = divmod(len(slot_keys), per_page)
+                card_slots.setdefault(
+                    (page_number, set_code, card_name), []
+                ).append((page_number, slot))
+                slot_keys.append('[%s] %s' % (set_code, card_name))
+
+        plan = planPages(slot_keys, per_page)
+        card_input = (
+            [None, len(slots), set_code, card_name]
+            for (_, set_code, card_name), slots in card_slots.items()
+        )
+
+        stage = MgFetchStage(self)
+        governor = self.createGovernor()
+        try:
+            deck = self.startDeck(
+                stage, governor, source, card_input, directory, file_name,
+                dict(enumerate(plan)), list(card_slots.values())
+            )
+            return self.finishDeck(deck, governor)
+        finally:
+            stage.close()
+
+    def resolveCards(self, source, input_array):
+        '''Returns the resolvable cards, the key of every slot and errors.
+
+        The key of a web image is its URL, the key of a local image its path
+        and modification time. The slots of a card are listed in deck order.
+        '''
+        cards = []
+        slot_keys = []
+        errors = []
+        for card_tupple in input_array:
+            card_name = card_tupple[3]
+            try:
+                if source:
+                    key = localImageKey(source, card_name, card_tupple[2])
+                else:
+                    key = createPolicyAddress(
+                        card_name, card_tupple[2], self.selector, self.policy
+                    )
+            except OSError as e:
+                errors.append(MG_LOGGER_CONST['image_file_error'] % (
+                    logCardName(card_tupple), e
+                ))
+                continue
+            except (MgLookupException, MgNetworkException) as e:
+                errors.append(MG_LOGGER_CONST['card_error'] % (
+                    logCardName(card_tupple), e
+                ))
+                continue
+
+            cards.append(list(card_tupple))
+            slot_keys.extend([key] * card_tupple[1])
 
-        reporter = MgReport()
-        card_input = Queue()
-        image_queue = Queue(MAX_IMAGE_QUEUE)
-        canvas_queue = Queue(MAX_PAGE_QUEUE)
+        return cards, slot_keys, errors
+
+    def logError(self, message, reporter):
+        '''Logs an error message and counts it in the reporter.'''
+        if self.logger:
+            self.logger.error(message)
+        reporter.addError()
+
+    def startDeck(
+        self, stage, governor, source, input_array, directory, file_name,
+        plan=None, slots=None
+    ):
+        '''Starts the page and save threads of a deck and queues its cards.
+
+        If a plan is given, slots lists the (page number, slot) of each card
+        (see MgImageCreateThread).
+        '''
+        deck = _MgDeck()
+        deck.reporter = MgReport()
+        page_store = MgPageStore()
+        deck.pdf_writer = (
+            MgPdfWriter(os.path.join(directory, file_name + '.pdf'), self.dpi)
+            if self.output == 'pdf' else None
+        )
+        if governor is None:
+            image_queue = Queue(MAX_IMAGE_QUEUE)
+            deck.canvas_queue = Queue(MAX_PAGE_QUEUE)
+        else:
+            image_queue = MgBudgetQueue(governor)
+            deck.canvas_queue = MgBudgetQueue(governor)
 
         # Create the threads responsible for saving pages
-        save_thread = self.startThread(
+        deck.save_thread = self.startThread(
             MgSaveThread, PAGE_SAVE_THREAD,
-            canvas_queue, directory, file_name, reporter, self.logger
+            deck.canvas_queue, directory, file_name, deck.reporter,
+            self.logger, deck.pdf_writer, self.encoder, page_store
         )
 
         # The page creation thread (only one should be created)
-        page_thread = self.startThread(
+        deck.page_thread = self.startThread(
             MgImageCreateThread, 1,
-            image_queue, canvas_queue, self.dpi, self.wh, self.xy,
-            reporter, self.logger
+            image_queue, deck.canvas_queue, self.dpi, self.wh, self.xy,
+            deck.reporter, self.logger, page_store, self.tile_cache, plan,
+            self.resize
         )
 
-        # The image getter threads are started (the first step in the queue)
-        image_getters = self.startThread(
-            MgGetImageThread, IMAGE_GET_THREAD,
-            card_input, image_queue, source, reporter, self.logger
+        # Web images are the same for every deck, local images are not. The
+        # job puts the stop signal of the page thread on the image_queue once
+        # all cards of the deck have been fetched.
+        job = MgJob(
+            image_queue, deck.reporter, source,
+            MgFetchCoalescer(self.dpi, self.wh, self.resize)
+            if source else stage.coalescer, counted=True
         )
 
         # Load the first queue for processing. Initiates the Queue chain.
-        for card_tupple in input_array:
-            card_input.put(MgQueueCar(card_tupple))
+        try:
+            stage.submit(job, input_array, slots)
+        except BaseException:
+            # The threads of the deck stop once the queued cards are done
+            job.closeCars()
+            self.finishDeck(deck, governor)
+            raise
 
-        # Once the Queue chain has been started, the stop signals can be sent
-        # Stop the image_getter threads (once all images have been downloaded)
-        self.stopAndWaitForThread(image_getters, card_input)
+        job.closeCars()
 
-        # Stop and wait for page_thread to finish
-        self.stopAndWaitForThread(page_thread, image_queue)
+        return deck
+
+    def finishDeck(self, deck, governor):
+        '''Waits for the pages of a deck to be saved and returns its report.'''
+        # The page_thread stops once all images of the deck have been fetched
+        self.waitForThread(deck.page_thread)
 
         # Stop and wait for save_threads to finish
-        self.stopAndWaitForThread(save_thread, canvas_queue)
+        self.stopAndWaitForThread(deck.save_thread, deck.canvas_queue)
 
-        return reporter
+        if deck.pdf_writer is not None:
+            self.closePdf(deck.pdf_writer, deck.reporter)
+
+        if governor is not None:
+            deck.reporter.setQueuedBytes(governor.peak, governor.average)
+
+        return deck.reporter
+
+    def closePdf(self, pdf_writer, reporter):
+        '''Finishes the pdf document, logging an error if that fails.'''
+        try:
+            pdf_writer.close()
+        except IOError as e:
+            if self.logger:
+                self.logger.error(MG_LOGGER_CONST['save_fail'] % (
+                    pdf_writer.file_path, e.strerror or e
+                ))
+            reporter.addError()
 
     def startThread(self, thread, number, *args, **kwargs):
         '''Starts a defined number of threads and returns list
@@ -124,3 +480,84 @@ class MgImageCreator(object):
     def createFromLocal(self, input_array, directory, file_name):
         '''Wrapper function to run image creation from local files.'''
         return self.create(True, input_array, directory, file_name)
+
+
+class MgFetchStage(object):
+
+    '''The image getter threads shared by the decks of an MgImageCreator.
+
+    Cards are submitted with the MgJob of their deck. Cards of web images
+    are registered with the shared coalescer of the stage, so a card in
+    several decks is only fetched once while it is in flight. close must be
+    called once all cards have been submitted. The image getters take turns
+    between the decks submitted (see MgFairQueue).
+    '''
+
+    def __init__(self, creator):
+        self.card_input = MgFairQueue(MAX_CARD_QUEUE)
+        self.coalescer = MgFetchCoalescer(
+            creator.dpi, creator.wh, creator.resize
+        )
+        self.tile_pool = (
+            MgTilePool(
+                creator.workers, creator.dpi, creator.wh, creator.resize
+            )
+            if creator.workers else None
+        )
+        tile_size = tileSize(creator.dpi, creator.wh)
+
+        # The Out-Queue, source and reporter are given by the job of each car
+        args = (
+            self.card_input, None, '', None, creator.logger, creator.cache,
+            None, self.tile_pool, tile_size, creator.selector,
+            creator.policy, creator.router
+        )
+        if creator.backend == 'async':
+            self.image_getters = creator.startThread(
+                MgAsyncGetImageThread, 1, *args, creator.fetch_limit,
+                creator.tile_cache
+            )
+        else:
+            self.image_getters = creator.startThread(
+                MgGetImageThread, IMAGE_GET_THREAD, *args, creator.tile_cache
+            )
+        self.creator = creator
+
+    def submit(self, job, input_array, slots=None):
+        '''Queues the cards of a deck, with the slots of each if given.
+
+        Input_array is consumed as the cards are queued, blocking while
+        MAX_CARD_QUEUE cards are waiting for the image getters. Cards are
+        registered before they are queued, so that duplicates already in
+        flight can share the fetch.
+        '''
+        for index, card_tupple in enumerate(input_array):
+            if job.coalescer is not None:
+                job.coalescer.register(card_tupple)
+            queue_car = MgQueueCar(card_tupple)
+            queue_car.job = job
+            if slots is not None:
+                queue_car.slots = slots[index]
+            job.addCar()
+            self.card_input.put(queue_car)
+
+    def close(self):
+        '''Stops the image getter threads once all cards have been fetched.'''
+        self.creator.stopAndWaitForThread(
+            self.image_getters, self.card_input
+        )
+
+        if self.tile_pool is not None:
+            self.tile_pool.shutdown()
+
+
+class _MgDeck(object):
+
+    '''The threads, queue and report of a deck being created.'''
+
+    def __init__(self):
+        self.reporter = None
+        self.canvas_queue = None
+        self.page_thread = None
+        self.save_thread = None
+        self.pdf_writer = None
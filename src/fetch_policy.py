@@ -0,0 +1,342 @@
+'''Retries, hedging, adaptive timeouts and a negative cache for downloads.
+
+A single attempt with a fixed timeout makes every transient stall cost the
+full timeout or lose the card. MgFetchPolicy retries transient failures
+(timeouts, connection errors, 5xx, 408 and 429 responses) after a jittered
+exponential backoff. Timeouts adapt to a rolling window of observed
+latencies, and a fetch taking longer than the usual (p95) latency can be
+hedged by a second, concurrent request. Permanent failures are remembered for a while, so the
+same missing image (404) or unknown card is not tried again and again.
+'''
+
+import time
+import random
+import asyncio
+from collections import deque
+from threading import Lock
+from concurrent.futures import (ThreadPoolExecutor, wait, FIRST_COMPLETED,
+                                CancelledError)
+
+from src.constants import (
+    MgException, MgNetworkException, MgTransientNetworkException,
+    MgLookupException, TIMEOUT, MIN_TIMEOUT, RETRIES, BACKOFF, LATENCY_WINDOW,
+    LATENCY_SAMPLES, NEGATIVE_TTL, NEGATIVE_SIZE, IMAGE_GET_THREAD
+)
+
+# HTTP status codes of failures that will not go away by trying again
+PERMANENT_STATUS = (404,)
+
+# The adaptive timeout is this multiple of the p99 latency
+TIMEOUT_FACTOR = 3
+
+
+class MgLatencyTracker(object):
+
+    '''A thread-safe rolling window of the latest request latencies.'''
+
+    def __init__(self, window=LATENCY_WINDOW):
+        self._lock = Lock()
+        self._latencies = deque(maxlen=window)
+
+    def add(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percent):
+        '''The latency below which percent of the requests completed.
+
+        None if there are too few samples to tell.
+        '''
+        with self._lock:
+            if len(self._latencies) < LATENCY_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+
+        return ordered[min(len(ordered) - 1, len(ordered) * percent // 100)]
+
+    def timeout(self, attempt, attempts):
+        '''The timeout of an attempt, adapted to the observed latencies.
+
+        The last attempt always gets the full TIMEOUT, so adapting never
+        loses a card that a fixed timeout would have fetched.
+        '''
+        p99 = self.percentile(99)
+        if p99 is None or attempt == attempts - 1:
+            return TIMEOUT
+
+        return min(TIMEOUT, max(MIN_TIMEOUT, p99 * TIMEOUT_FACTOR))
+
+
+def isPermanent(error):
+    '''True if error will not go away by trying again.
+
+    Unknown cards and missing images (PERMANENT_STATUS) are permanent.
+    Other failures, such as 403 responses or unexpected content types,
+    might depend on the mirror or the moment, so they are not remembered.
+    '''
+    if isinstance(error, MgLookupException):
+        return True
+    return (
+        isinstance(error, MgNetworkException) and
+        error.status in PERMANENT_STATUS
+    )
+
+
+class MgFetchPolicy(object):
+
+    '''Fetches data with retries and optional hedging. Thread-safe.
+
+    Fetch functions take the timeout of the attempt and either return the
+    data or raise an MgException. MgTransientNetworkExceptions are retried
+    up to retries times, other exceptions are final. Permanent failures
+    (see isPermanent) are remembered for negative_ttl seconds, at most
+    negative_size of them. Only successful requests count towards the
+    latencies the timeouts adapt to.
+    '''
+
+    def __init__(
+        self, retries=RETRIES, hedge=False, backoff=BACKOFF,
+        negative_ttl=NEGATIVE_TTL, negative_size=NEGATIVE_SIZE
+    ):
+        self.retries = retries
+        self.hedge = hedge
+        self.backoff = backoff
+        self.negative_ttl = negative_ttl
+        self.negative_size = negative_size
+        self.tracker = MgLatencyTracker()
+
+        self._lock = Lock()
+        # Key (key) and expiry time and error (value), in order of expiry
+        self._negative = {}
+        self._executor = None  # Runs hedged requests
+        self._retried = 0
+        self._hedged = 0
+
+    def fetch(self, address, fetch_func):
+        '''Returns the data of address downloaded by fetch_func.'''
+        return self.guard(address, lambda: self.attempts(fetch_func))
+
+    def guard(self, key, func):
+        '''Returns func(), unless key failed permanently not long ago.
+
+        Permanent failures of func are remembered for key.
+        '''
+        self.checkNegative(key)
+        try:
+            return func()
+        except MgException as e:
+            if isPermanent(e):
+                self.addNegative(key, e)
+            raise
+
+    def attempts(self, fetch_func):
+        '''Calls fetch_func, retrying transient failures.'''
+        attempts = self.retries + 1
+        for attempt in range(attempts):
+            timeout = self.tracker.timeout(attempt, attempts)
+            try:
+                if self.hedge:
+                    return self.hedged(fetch_func, timeout)
+                return self.timed(fetch_func, timeout)
+            except MgTransientNetworkException:
+                if attempt == attempts - 1:
+                    raise
+
+            self.addRetry()
+            time.sleep(self.delay(attempt))
+
+    def timed(self, fetch_func, timeout):
+        '''Calls fetch_func, recording its latency if it succeeds.
+
+        Failures are left out, as a burst of quick errors (or timeouts)
+        would skew the timeouts of the following requests.
+        '''
+        start = time.monotonic()
+        data = fetch_func(timeout)
+        self.tracker.add(time.monotonic() - start)
+        return data
+
+    def hedged(self, fetch_func, timeout):
+        '''Calls fetch_func, and again if it is slower than the p95 latency.
+
+        The first request to succeed wins. The other one is left to finish
+        in the background.
+        '''
+        p95 = self.tracker.percentile(95)
+        executor = self.executor()
+        futures = {executor.submit(self.timed, fetch_func, timeout)}
+        if p95 is None:
+            return futures.pop().result()
+
+        done, _ = wait(futures, p95)
+        if not done:
+            self.addHedge()
+            futures.add(executor.submit(self.timed, fetch_func, timeout))
+
+        error = None
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    return future.result()
+                except (MgNetworkException, CancelledError) as e:
+                    error = e
+
+        raise error
+
+    async def fetchAsync(self, address, fetch_coro):
+        '''The asyncio version of fetch.
+
+        Fetch_coro takes the timeout and returns an awaitable of the data.
+        '''
+        self.checkNegative(address)
+        try:
+            return await self.attemptsAsync(fetch_coro)
+        except MgException as e:
+            if isPermanent(e):
+                self.addNegative(address, e)
+            raise
+
+    async def attemptsAsync(self, fetch_coro):
+        '''The asyncio version of attempts.'''
+        attempts = self.retries + 1
+        for attempt in range(attempts):
+            timeout = self.tracker.timeout(attempt, attempts)
+            try:
+                if self.hedge:
+                    return await self.hedgedAsync(fetch_coro, timeout)
+                return await self.timedAsync(fetch_coro, timeout)
+            except MgTransientNetworkException:
+                if attempt == attempts - 1:
+                    raise
+
+            self.addRetry()
+            await asyncio.sleep(self.delay(attempt))
+
+    async def timedAsync(self, fetch_coro, timeout):
+        '''The asyncio version of timed.'''
+        start = time.monotonic()
+        data = await fetch_coro(timeout)
+        self.tracker.add(time.monotonic() - start)
+        return data
+
+    async def hedgedAsync(self, fetch_coro, timeout):
+        '''The asyncio version of hedged. The losing request is cancelled.'''
+        p95 = self.tracker.percentile(95)
+        tasks = {asyncio.ensure_future(self.timedAsync(fetch_coro, timeout))}
+        if p95 is None:
+            return await tasks.pop()
+
+        done, _ = await asyncio.wait(tasks, timeout=p95)
+        if not done:
+            self.addHedge()
+            tasks.add(asyncio.ensure_future(
+                self.timedAsync(fetch_coro, timeout)
+            ))
+
+        error = None
+        try:
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    try:
+                        return task.result()
+                    except MgNetworkException as e:
+                        error = e
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        raise error
+
+    def delay(self, attempt):
+        '''The backoff before the next attempt, with full jitter.'''
+        return random.uniform(0, self.backoff * 2 ** attempt)
+
+    def checkNegative(self, key):
+        '''Raises the remembered permanent failure of key, if any.
+
+        A new exception (with the status of the remembered one) is raised
+        every time, as raising the remembered one would add to its traceback
+        on every hit.
+        '''
+        with self._lock:
+            entry = self._negative.get(key)
+            if entry is None:
+                return
+            if entry[0] < time.monotonic():
+                del self._negative[key]
+                return
+
+        error = entry[1]
+        fresh = type(error)(*error.args)
+        fresh.__dict__.update(error.__dict__)
+        raise fresh from None
+
+    def addNegative(self, key, error):
+        '''Remembers the permanent failure of key.
+
+        Expired failures are dropped, and the oldest ones once there are
+        more than negative_size. Keys are moved to the end when they are
+        added again, so the oldest failure is always the first.
+        '''
+        if self.negative_ttl <= 0:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._negative.pop(key, None)
+            self._negative[key] = (now + self.negative_ttl, error)
+
+            while self._negative:
+                oldest = next(iter(self._negative))
+                if (
+                    len(self._negative) <= self.negative_size and
+                    self._negative[oldest][0] >= now
+                ):
+                    break
+                del self._negative[oldest]
+
+    def addRetry(self):
+        with self._lock:
+            self._retried += 1
+
+    def addHedge(self):
+        with self._lock:
+            self._hedged += 1
+
+    def executor(self):
+        '''The thread pool running hedged requests, created on first use.'''
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(IMAGE_GET_THREAD * 2)
+            return self._executor
+
+    def close(self):
+        '''Stops the threads of hedged requests once they are finished.
+
+        The thread pool is created again if the policy is used later.
+        '''
+        with self._lock:
+            executor, self._executor = self._executor, None
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    @property
+    def retried(self):
+        '''The number of attempts that have been retried.'''
+        with self._lock:
+            return self._retried
+
+    @property
+    def hedged_requests(self):
+        '''The number of hedged requests that have been sent.'''
+        with self._lock:
+            return self._hedged
+
+
+# The policy used if none is specified
+FETCH_POLICY = MgFetchPolicy()
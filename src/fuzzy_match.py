@@ -0,0 +1,164 @@
+'''Finds the card name closest to a misspelt one through its trigrams.
+
+Comparing a name against all of the card names with difflib takes far too
+long for a list of unknown cards. Instead, the card index stores for every
+trigram (three consecutive characters of a normalized name, padded with a
+space at both ends) the card names containing it. The names sharing a
+trigram with the query are counted in a single pass over these lists, and
+their similarity is the Dice coefficient:
+2 * shared trigrams / (trigrams of the query + trigrams of the name).
+
+Only the posting lists of the rarer trigrams of the query are counted.
+Common trigrams (such as "the") merely add to the counts of the names found
+through them, and names that cannot come close to the most similar one
+(given their counts and lengths) are not scored at all. Trigrams miss
+swapped or doubled letters, so the few most similar names are finally
+compared by their edit distance to the query.
+'''
+
+from collections import Counter
+
+from src.local_index import normalizeName
+
+# Trigrams of more than this fraction of the names are common
+COMMON_GRAM = 0.02
+
+# Names this much less similar than the most similar one are not compared
+# by their edit distance, nor are more than RERANK_SIZE names
+RERANK_MARGIN = 0.1
+RERANK_SIZE = 5
+
+# The names with the highest counts scored to estimate the best similarity
+PROBE_SIZE = 20
+
+
+def trigrams(name):
+    '''Returns the set of trigrams of a normalized name.'''
+    padded = ' %s ' % normalizeName(name)
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def buildGrams(names):
+    '''Returns a dict of the indices in names of the names with a trigram.'''
+    grams = {}
+    for index, name in enumerate(names):
+        for gram in trigrams(name):
+            grams.setdefault(gram, []).append(index)
+
+    return grams
+
+
+def editDistance(a, b):
+    '''The number of inserted, removed, replaced or swapped characters.
+
+    The optimal string alignment distance: adjacent characters swapped count
+    as a single edit.
+    '''
+    before_previous = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            cost = min(
+                previous[j - 1] + (char_a != char_b), previous[j] + 1,
+                current[j - 1] + 1
+            )
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b:
+                cost = min(cost, before_previous[j - 2] + 1)
+            current.append(cost)
+        before_previous, previous = previous, current
+
+    return previous[-1]
+
+
+class MgFuzzyIndex(object):
+
+    '''Looks up the name closest to a card name in a list of names.
+
+    Grams is the dict returned by buildGrams for the names.
+    '''
+
+    def __init__(self, names, grams):
+        self.names = names
+        self.grams = grams
+
+        # The number of trigrams of every name
+        self.sizes = [0] * len(names)
+        for indices in grams.values():
+            for index in indices:
+                self.sizes[index] += 1
+
+        # The names with a common trigram, as sets
+        common_size = COMMON_GRAM * len(names)
+        self.common = {
+            gram: frozenset(indices) for gram, indices in grams.items()
+            if len(indices) > common_size
+        }
+
+    def closest(self, card_name, threshold=0):
+        '''Returns the closest name and its similarity, or None.
+
+        The similarity is between 0 and 1, names less similar than threshold
+        are not returned. Of the names at most RERANK_MARGIN less similar
+        than the most similar one, the one with the smallest edit distance
+        (relative to its length) is returned, the first of equally close
+        ones. Names sharing only common trigrams with a query that has rarer
+        ones are never returned.
+        '''
+        query = trigrams(card_name)
+        rare, common = [], []
+        for gram in query:
+            if gram in self.common:
+                common.append(self.common[gram])
+            elif gram in self.grams:
+                rare.append(self.grams[gram])
+        if not rare:
+            rare = [self.grams[gram] for gram in query if gram in self.common]
+            common = []
+
+        shared = Counter()
+        for indices in rare:
+            shared.update(indices)
+        if not shared:
+            return None
+
+        query_size = len(query)
+
+        def similarity(index, count):
+            for indices in common:
+                if index in indices:
+                    count += 1
+            return 2 * count / (query_size + self.sizes[index])
+
+        # A name at least floor similar shares at least needed trigrams
+        best = max(
+            similarity(index, count)
+            for index, count in shared.most_common(PROBE_SIZE)
+        )
+        floor = max(threshold, best - RERANK_MARGIN)
+        needed = floor * query_size / (2 - floor) - len(common) - 1e-9
+
+        scores = []
+        for index, count in shared.items():
+            if count >= needed:
+                score = similarity(index, count)
+                if score >= floor:
+                    scores.append((-score, index))
+
+        if not scores:
+            return None
+
+        scores.sort()
+        if len(scores) > 1 and scores[0][0] > -1:
+            scores = scores[:RERANK_SIZE]
+            name = normalizeName(card_name)
+
+            def distance(score):
+                other = normalizeName(self.names[score[1]])
+                edits = editDistance(name, other)
+                return edits / max(len(name), len(other), 1), score
+
+            scores.sort(key=distance)
+
+        score, index = scores[0]
+        return self.names[index], -score
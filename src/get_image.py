@@ -1,23 +1,25 @@
-import urllib.request
-import urllib.parse
-import urllib.error
+import http.client
 import sys
 import os
 import functools
-import socket
-import random
 
 from io import BytesIO
 from contextlib import closing
 
 from src.constants import (
-    MgNetworkException, MgImageException, MgLookupException,
-    BASE_URL, TIMEOUT, CARD_URLS
+    MgNetworkException, MgTransientNetworkException, MgImageException,
+    MgLookupException, BASE_URL, TIMEOUT, FUZZY_SUGGEST, STREAM_CHUNK,
+    RETRY_STATUS
 )
 from src.logger_dict import MG_LOGGER_CONST
+from src.http_pool import CONNECTION_POOL
+from src.card_index import CARD_INDEX
+from src.card_select import DEFAULT_SELECTOR
+from src.fetch_policy import FETCH_POLICY
+from src.local_index import localIndex
 
 try:
-    from PIL import Image
+    from PIL import Image, UnidentifiedImageError
 except ImportError:
     sys.stderr.write(
         'Cannot run program. ' +
@@ -36,44 +38,167 @@ a mutable object that can be easily changed in the test module.
 ADDRESS_ERROR = []
 
 
-def getGenericData(address, content_type, timeout=TIMEOUT):
+def getGenericData(address, content_type, timeout=TIMEOUT, consumer=None):
     '''Get data of content_type from address.
 
     Raises exception if data cannot be downloaded or if the
-    content_type does not match.
-
-    I've moved the whole code in the try block as urllib2 is known to cause
-    leaky exceptions. I've personally seen the read call cause an
-    undocumented socket.timeout exception to be thrown.
+    content_type does not match. Connections are kept alive in the shared
+    CONNECTION_POOL, so consecutive requests to one host skip the setup.
+    Failures that might not happen again (network errors and timeouts,
+    server errors, see statusError) raise MgTransientNetworkException.
+
+    If consumer is given, it is called for an object with feed and close
+    methods (such as an MgImageParser). The data is fed to it as it arrives
+    (see streamData) and the result of its close method is returned
+    instead of the data.
+
+    I've moved the whole code in the try block as the read call can cause
+    leaky exceptions. I've personally seen it cause an undocumented
+    socket.timeout exception to be thrown.
     '''
     try:
-        with closing(
-            urllib.request.urlopen(address, timeout=timeout)
-        ) as response:
-            response_content_type = response.info()['Content-Type']
+        with CONNECTION_POOL.urlopen(address, timeout) as response:
+            if response.status != 200:
+                raise statusError(response.status, address)
+
+            response_content_type = response.getheader('Content-Type')
             if response_content_type != content_type:
                 raise MgNetworkException(
                     MG_LOGGER_CONST['ct_error'] %
                     (content_type, response_content_type, address)
                 )
 
-            file_size = int(response.info()['Content-Length'])
-            return response.read(file_size)
+            if consumer is None:
+                return response.read()
 
-    except urllib.error.HTTPError as e:
-        raise MgNetworkException(
-            MG_LOGGER_CONST['html_error'] % (e.code, address)
-        )
-    except (urllib.error.URLError) as e:
-        raise MgNetworkException(
-            MG_LOGGER_CONST['network_error'] % (address, e.reason)
-        )
-    except socket.timeout as e:
-        raise MgNetworkException(
+            return streamData(
+                response, consumer(), address,
+                response.getheader('Content-Length')
+            )
+
+    except (OSError, http.client.HTTPException) as e:
+        raise MgTransientNetworkException(
             MG_LOGGER_CONST['network_error'] % (address, str(e))
         )
 
 
+def statusError(status, address):
+    '''The MgNetworkException for a response with an unexpected status.
+
+    Server errors and the status codes in RETRY_STATUS (timeouts and rate
+    limits) are transient. The status is kept on the exception.
+    '''
+    if status >= 500 or status in RETRY_STATUS:
+        error_type = MgTransientNetworkException
+    else:
+        error_type = MgNetworkException
+
+    return error_type(
+        MG_LOGGER_CONST['html_error'] % (status, address), status=status
+    )
+
+
+def streamData(stream, consumer, address, length=None):
+    '''Feeds the data of stream to consumer, returns consumer.close().
+
+    Data is read with read1, so every chunk that arrives is fed right away
+    rather than once STREAM_CHUNK bytes have been received. Data shorter
+    than length (the Content-Length of a response, which http.client does
+    not check for partial reads) raises MgTransientNetworkException.
+    Errors of the consumer raise MgImageException.
+    '''
+    received = 0
+    while True:
+        chunk = stream.read1(STREAM_CHUNK)
+        if not chunk:
+            # Unlike read1, read marks a complete response as closed, which
+            # hands its connection back to the pool
+            stream.read()
+            break
+
+        received += len(chunk)
+        try:
+            consumer.feed(chunk)
+        except IOError as e:
+            raise MgImageException(str(e))
+
+    if length is not None and received != int(length):
+        raise MgTransientNetworkException(
+            MG_LOGGER_CONST['length_error'] % (int(length), received, address)
+        )
+
+    try:
+        return consumer.close()
+    except IOError as e:
+        raise MgImageException(str(e))
+
+
+class MgImageParser(object):
+
+    '''Decodes an image from the chunks of its data, see streamData.
+
+    The chunks are collected as they arrive and decoded at once on close.
+    Given the size the image will be resized to, JPEGs are decoded at a
+    reduced scale just like openAndValidateImage does. Pillow's public
+    ImageFile.Parser decodes JPEGs only on close as well, but at full scale,
+    and its decoder can only be started earlier through Pillow internals.
+    '''
+
+    def __init__(self, size=None):
+        self.size = size
+        self.image = None
+        self._chunks = []
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        with BytesIO(data) as image_stream:
+            image = openImage(image_stream)
+            if self.size is not None:
+                image.draft(image.mode, self.size)
+            image.load()
+
+        self.image = image
+        return image
+
+
+class MgImageDataCheck(object):
+
+    '''Collects the data of a downloaded image, checking it is an image.
+
+    A consumer for getGenericData returning the data itself, for callers
+    that store the data or decode it elsewhere. Only the header is parsed,
+    so a body that is not an image (such as an error page) fails as part of
+    its download, and an MgSourceRouter tries the next source. Truncated
+    data fails the Content-Length check instead.
+    '''
+
+    def __init__(self):
+        self._chunks = []
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        with BytesIO(data) as image_stream:
+            openImage(image_stream).close()
+
+        return data
+
+
+def openImage(image_stream):
+    '''Opens downloaded image data, without the stream in the error.'''
+    try:
+        return Image.open(image_stream)
+    except UnidentifiedImageError:
+        raise IOError(MG_LOGGER_CONST['not_image'])
+
+
 def addressErrorDecorator(f):
     '''Decorates the createAddress function and causes errors for testing.
 
@@ -88,7 +213,7 @@ def addressErrorDecorator(f):
             if ADDRESS_ERROR[0] == 'timeout':
                 # Cause a timeout address by adding port 81
                 timeout_address = 'http://mtgimage.com:81/'
-                return f(card_name, set_name, timeout_address)
+                return f(card_name, set_name, timeout_address, **kwargs)
             elif ADDRESS_ERROR[0] == 'content_type':
                 # Returns text/html data rather than jpeg or json
                 return 'http://mtgimage.com/'
@@ -100,59 +225,179 @@ def addressErrorDecorator(f):
 
 
 @addressErrorDecorator
-def createAddress(card_name, set_name=None, return_url=BASE_URL):
+def createAddress(
+    card_name, set_name=None, return_url=BASE_URL, selector=None
+):
     '''Creates a URL from a card name and an optional set.
-    Correctly escapes characters.'''
-
-    try:
-        card_urls = CARD_URLS[card_name]
 
-        if set_name is None:
-            url = random.choice(list(card_urls.values()))
-        else:
-            url = card_urls[set_name]
+    The printing is chosen by the MgCardSelector, by default the newest one,
+    so the same card always resolves to the same URL. The error for an
+    unknown card suggests the closest card name, if there is one.'''
+    if selector is None:
+        selector = DEFAULT_SELECTOR
 
-        # In case there are multiple cards in a set with  same name (basic land)
-        url = random.choice(url)
+    try:
+        entry = CARD_INDEX.lookup(card_name)
+        printing = selector.select(card_name, entry, set_name)
     except KeyError:
-        raise MgLookupException(MG_LOGGER_CONST['image_database_error'])
+        match = CARD_INDEX.closest(card_name, FUZZY_SUGGEST)
+        if match is None or match[0] == card_name:
+            raise MgLookupException(MG_LOGGER_CONST['image_database_error'])
+        raise MgLookupException(MG_LOGGER_CONST['fuzzy_suggest'] % match[0])
 
-    final_url = BASE_URL + url
+    final_url = return_url + printing.url
     return final_url
 
 
-def getMgImage(card_name, set_name=None):
+def getPolicyData(
+    address, content_type, policy=None, router=None, consumer=None
+):
+    '''Wraps getGenericData with the retries of an MgFetchPolicy.
+
+    If an MgSourceRouter is provided, it downloads the address from the
+    fastest of its sources instead. See getGenericData for consumer, which
+    is called again for every attempt.
+    '''
+    if policy is None:
+        policy = FETCH_POLICY
+
+    if router is None:
+        def fetch_func(timeout):
+            return getGenericData(address, content_type, timeout, consumer)
+    else:
+        def fetch_func(timeout):
+            return router.fetch(address, content_type, timeout, consumer)
+
+    return policy.fetch(address, fetch_func)
+
+
+def getCachedData(
+    address, content_type, cache=None, reporter=None, policy=None,
+    router=None, consumer=None
+):
+    '''Wraps getPolicyData with an optional MgImageCache.
+
+    Data found in the cache is returned without accessing the network.
+    Hits and misses are counted in the reporter, if one is provided.
+    The consumer (see getGenericData) has to return the data, such as
+    MgImageDataCheck does.
+    '''
+    if cache is None:
+        return getPolicyData(address, content_type, policy, router, consumer)
+
+    data = cache.get(address)
+    if data is not None:
+        if reporter:
+            reporter.addCacheHit()
+        return data
+
+    if reporter:
+        reporter.addCacheMiss()
+
+    data = getPolicyData(address, content_type, policy, router, consumer)
+    cache.put(address, data)
+    return data
+
+
+def createPolicyAddress(card_name, set_name=None, selector=None, policy=None):
+    '''Wraps createAddress, remembering unknown cards in the MgFetchPolicy.'''
+    if policy is None:
+        policy = FETCH_POLICY
+
+    return policy.guard(
+        (card_name, set_name),
+        lambda: createAddress(card_name, set_name, selector=selector)
+    )
+
+
+def getMgImageData(
+    card_name, set_name=None, cache=None, reporter=None, selector=None,
+    policy=None, router=None
+):
+    '''Downloads a given card name and returns the undecoded image data.
+
+    If an MgImageCache is provided, it is checked before the image is
+    downloaded. The MgCardSelector chooses the printing. Downloads are
+    retried according to the MgFetchPolicy, and routed to the image mirrors
+    of the MgSourceRouter. Downloaded data is checked to be an image (see
+    MgImageDataCheck).'''
+    address = createPolicyAddress(card_name, set_name, selector, policy)
+    return getCachedData(
+        address, 'image/jpeg', cache, reporter, policy, router,
+        MgImageDataCheck
+    )
+
+
+def getMgImage(
+    card_name, set_name=None, cache=None, reporter=None, size=None,
+    selector=None, policy=None, router=None
+):
     '''Downloads a given card name and returns the Pillow image.
 
-    Note that this function does not check if the downloaded image is a
-    valid image file.'''
-    address = createAddress(card_name, set_name)
-    image_stream = getGenericData(address, 'image/jpeg')
+    See getMgImageData for the optional arguments and openAndValidateImage
+    for size. Without a cache, the image is decoded from the chunks of the
+    response (see MgImageParser).'''
+    if cache is None:
+        address = createPolicyAddress(card_name, set_name, selector, policy)
+        return getPolicyData(
+            address, 'image/jpeg', policy, router,
+            functools.partial(MgImageParser, size)
+        )
+
+    image_stream = getMgImageData(
+        card_name, set_name, cache, reporter, selector, policy, router
+    )
     with closing(BytesIO(image_stream)) as image_stream:
-        return openAndValidateImage(image_stream)
+        return openAndValidateImage(image_stream, size)
+
+
+def createLocalAddress(directory, card_name, set_name=None):
+    '''Create a valid local address from a directory, a card name, extension
+
+    The file is resolved through the MgLocalIndex of the directory, ignoring
+    case, punctuation and the extension (see local_index.py). If no file
+    matches, directory/card_name is returned, which fails when opened.
+    '''
+    address = localIndex(directory).resolve(card_name, set_name)
+    if address is None:
+        return os.path.join(directory, card_name)
 
+    return address
 
-def createLocalAddress(directory, card_name):
-    '''Create a valid local address from a directory, a card name, extension'''
-    return os.path.join(directory, card_name)
 
+def localImageKey(directory, card_name, set_name=None):
+    '''Returns the identity of the local image of a card.
 
-def getLocalMgImage(directory, card_name):
+    The key is the path of the image and its modification time, so it
+    changes when the image is replaced. Raises OSError if there is none.
+    '''
+    address = createLocalAddress(directory, card_name, set_name)
+    return '%s@%d' % (address, os.stat(address).st_mtime_ns)
+
+
+def getLocalMgImage(directory, card_name, size=None, set_name=None):
     '''Returns an image found on a local disk'''
-    address = createLocalAddress(directory, card_name)
+    address = createLocalAddress(directory, card_name, set_name)
 
-    return openAndValidateImage(address)
+    return openAndValidateImage(address, size)
 
 
-def openAndValidateImage(image_file):
+def openAndValidateImage(image_file, size=None):
     '''Opens and checks if PIL image is valid.
 
     PIL does not provide a good way to test if an image is corrupt.
     The easiest way is to load the image into memory and catch the IOError.
     Inability to open file or corrupt file will raise IOError.
+
+    If the size the image will be resized to is given, JPEGs are decoded
+    at the smallest scale (1/2, 1/4 or 1/8) that still covers that size.
+    This is much cheaper than decoding the full image, and the image has to
+    be resized anyway.
     '''
     try:
         image = Image.open(image_file)
+        if size is not None:
+            image.draft(image.mode, size)
         image.load()
     except IOError as e:
         raise MgImageException(str(e))
@@ -2,10 +2,18 @@
 
 import urllib.request, urllib.parse, urllib.error
 from urllib.parse import urljoin
+import os
 import json
+import time
+import http.client
+from threading import Lock
 
-from src.constants import BASE_URL_JSON, JSON_EXT
+from src.constants import (BASE_URL_JSON, JSON_EXT, SET_CACHE_DIR,
+                           SET_CACHE_AGE, TIMEOUT, MgNetworkException,
+                           MgTransientNetworkException)
 from src.get_image import getGenericData
+from src.http_pool import CONNECTION_POOL
+from src.logger_dict import MG_LOGGER_CONST
 
 
 def createSetAddress(set_code):
@@ -44,3 +52,113 @@ def parseLocalSetForRarity(set_dict):
 def parseSetForRarity(set_code):
     '''Wrapper function combining downloading and parsing json set'''
     return parseLocalSetForRarity(getSetJson(set_code))
+
+
+def writeAtomic(path, data):
+    '''Replaces the file at path with data, never leaving half of it.'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class MgSetCache(object):
+
+    '''Keeps the JSON files of sets on disk, revalidating them when old.
+
+    A set is downloaded once and read from directory afterwards. Once its
+    file is older than max_age seconds, it is requested again with the
+    ETag and Last-Modified of the cached copy, so an unchanged set costs a
+    304 response rather than the whole file. If the request fails, the old
+    copy is used. Sets are parsed once per instance.
+    '''
+
+    def __init__(self, directory=SET_CACHE_DIR, max_age=SET_CACHE_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        self._lock = Lock()
+        self._sets = {}
+
+    def get(self, set_code):
+        '''Returns the JSON data of a set as a dict.
+
+        Raises MgNetworkException if the set is neither cached nor can be
+        downloaded.
+        '''
+        with self._lock:
+            if set_code not in self._sets:
+                self._sets[set_code] = self.load(set_code)
+            return self._sets[set_code]
+
+    def load(self, set_code):
+        '''Reads the set from disk, downloading it first if needed.'''
+        file_path = os.path.join(self.directory, set_code + JSON_EXT)
+        meta_path = file_path + '.meta'
+        try:
+            age = time.time() - os.path.getmtime(file_path)
+        except OSError:
+            age = None
+
+        if age is None or age > self.max_age:
+            try:
+                self.download(set_code, file_path, meta_path, age is not None)
+            except MgNetworkException:
+                if age is None:
+                    raise
+
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            raise MgNetworkException(
+                MG_LOGGER_CONST['set_cache_error'] % (file_path, e)
+            )
+
+    def download(self, set_code, file_path, meta_path, conditional):
+        '''Downloads the set to file_path, unless the cached copy is current.
+
+        The validators of the response are saved to meta_path.
+        '''
+        address = createSetAddress(set_code)
+        headers = {}
+        if conditional:
+            try:
+                with open(meta_path, 'r') as f:
+                    validators = json.load(f)
+            except (OSError, ValueError):
+                validators = {}
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        try:
+            with CONNECTION_POOL.urlopen(address, TIMEOUT, headers) as answer:
+                data = answer.read()
+                status = answer.status
+                validators = {
+                    'etag': answer.getheader('ETag'),
+                    'last_modified': answer.getheader('Last-Modified')
+                }
+        except (OSError, http.client.HTTPException) as e:
+            raise MgTransientNetworkException(
+                MG_LOGGER_CONST['network_error'] % (address, str(e))
+            )
+
+        if status == 304 and conditional:
+            # The cached copy is current for another max_age
+            os.utime(file_path)
+            return
+
+        if status != 200:
+            raise MgNetworkException(
+                MG_LOGGER_CONST['html_error'] % (status, address)
+            )
+
+        os.makedirs(self.directory, exist_ok=True)
+        writeAtomic(file_path, data)
+        writeAtomic(meta_path, json.dumps(validators).encode('utf-8'))
+
+    def rarities(self, set_code):
+        '''Returns the card names of a set by rarity (see parseSetForRarity)'''
+        return parseLocalSetForRarity(self.get(set_code))
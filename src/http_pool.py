@@ -0,0 +1,209 @@
+'''A pool of persistent HTTP connections used for all network access.'''
+
+import base64
+import http.client
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+from threading import Lock
+
+from src.constants import TIMEOUT, POOL_SIZE, MAX_REDIRECTS
+
+# Status codes for which the Location header is followed
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# Errors raised when a kept-alive connection has been closed by the server
+STALE_ERRORS = (
+    http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError
+)
+
+
+class MgConnectionPool(object):
+
+    '''Keeps HTTP connections alive between requests to the same host.
+
+    Idle connections are stored per (scheme, host, port, proxy) and reused
+    by the next request to that host, which saves the TCP (and TLS) setup for
+    every card. At most max_size idle connections are kept per host. Servers
+    close idle connections whenever they want, so a request failing on a
+    reused connection is retried once on a fresh one.
+
+    Proxies are taken from the environment (see urllib.request.getproxies),
+    unless a dict like {'http': 'http://proxy:3128'} is given. Hosts
+    excluded by no_proxy are connected to directly. HTTPS requests are
+    tunnelled through the proxy with CONNECT.
+    '''
+
+    def __init__(self, max_size=POOL_SIZE, proxies=None):
+        self.max_size = max_size
+        self.proxies = (
+            urllib.request.getproxies() if proxies is None else proxies
+        )
+        self._lock = Lock()
+        self._idle = {}  # Idle connections by (scheme, host, port, proxy)
+
+    @contextmanager
+    def urlopen(self, address, timeout=TIMEOUT, headers=None):
+        '''Yields the http.client.HTTPResponse of a GET request to address.
+
+        Redirects are followed. Unlike urllib.request.urlopen, responses
+        with an error status code are returned rather than raised. The
+        connection is handed back to the pool when the block is left, as long
+        as the response has been read completely.
+
+        Raises OSError or http.client.HTTPException on network errors.
+        '''
+        connection, response = self.open(address, timeout, headers or {})
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+
+        self.release(connection, response)
+
+    def open(self, address, timeout, headers):
+        '''Sends a GET request, following redirects.
+
+        Returns the connection and its response, which have to be handed
+        back with release.
+        '''
+        for _ in range(MAX_REDIRECTS + 1):
+            connection, response = self.request(address, timeout, headers)
+            if response.status not in REDIRECT_CODES:
+                return connection, response
+
+            location = response.getheader('Location')
+            response.read()
+            self.release(connection, response)
+
+            if location is None:
+                raise http.client.HTTPException(
+                    'Redirect without location from %s' % address
+                )
+            address = urllib.parse.urljoin(address, location)
+
+        raise http.client.HTTPException('Too many redirects for %s' % address)
+
+    def request(self, address, timeout, headers):
+        '''Sends a single GET request on a pooled or new connection.'''
+        parts = urllib.parse.urlsplit(address)
+        proxy = self.proxy(parts)
+        key = (parts.scheme, parts.hostname, parts.port, proxy)
+        path = urllib.parse.urlunsplit(
+            ('', '', parts.path or '/', parts.query, '')
+        )
+        if proxy is not None and parts.scheme == 'http':
+            # Plain HTTP proxies take the full URL
+            path = urllib.parse.urlunsplit(
+                (parts.scheme, parts.netloc, path, '', '')
+            )
+            if proxy[2] is not None:
+                headers = dict(headers, **{'Proxy-Authorization': proxy[2]})
+
+        while True:
+            connection, reused = self.acquire(key, timeout)
+            try:
+                connection.request('GET', path, headers=headers)
+                return connection, connection.getresponse()
+            except STALE_ERRORS:
+                connection.close()
+                # Only a fresh connection failing is a real network error
+                if not reused:
+                    raise
+            except BaseException:
+                connection.close()
+                raise
+
+    def proxy(self, parts):
+        '''The proxy for the URL parts, None for a direct connection.
+
+        A proxy is given as its host, port and Proxy-Authorization header
+        (None without credentials).
+        '''
+        proxy = self.proxies.get(parts.scheme)
+        if not proxy or urllib.request.proxy_bypass(parts.hostname or ''):
+            return None
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy_parts = urllib.parse.urlsplit(proxy)
+        authorization = None
+        if proxy_parts.username is not None:
+            credentials = '%s:%s' % (
+                urllib.parse.unquote(proxy_parts.username),
+                urllib.parse.unquote(proxy_parts.password or '')
+            )
+            authorization = 'Basic ' + base64.b64encode(
+                credentials.encode('utf-8')
+            ).decode('ascii')
+
+        return (
+            proxy_parts.hostname, proxy_parts.port or http.client.HTTP_PORT,
+            authorization
+        )
+
+    def acquire(self, key, timeout):
+        '''Returns an idle connection for key or a new one.
+
+        The second element of the returned tuple is True for a reused
+        connection.
+        '''
+        with self._lock:
+            idle = self._idle.get(key)
+            connection = idle.pop() if idle else None
+
+        if connection is not None:
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            return connection, True
+
+        scheme, host, port, proxy = key
+        if scheme == 'http':
+            connection_class = http.client.HTTPConnection
+        elif scheme == 'https':
+            connection_class = http.client.HTTPSConnection
+        else:
+            raise http.client.InvalidURL('Unsupported scheme %s' % scheme)
+
+        if proxy is None:
+            connection = connection_class(host, port, timeout=timeout)
+        else:
+            connection = connection_class(
+                proxy[0], proxy[1], timeout=timeout
+            )
+            if scheme == 'https':
+                connection.set_tunnel(host, port, headers=(
+                    {'Proxy-Authorization': proxy[2]} if proxy[2] else None
+                ))
+        # Remember where the connection is returned to
+        connection.pool_key = key
+        return connection, False
+
+    def release(self, connection, response):
+        '''Returns the connection to the pool if it can be reused.'''
+        if not response.isclosed() or response.will_close:
+            connection.close()
+            return
+
+        with self._lock:
+            idle = self._idle.setdefault(connection.pool_key, [])
+            if len(idle) < self.max_size:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def clear(self):
+        '''Closes all idle connections.'''
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+# The pool shared by all network access of MgProxy
+CONNECTION_POOL = MgConnectionPool()
@@ -0,0 +1,209 @@
+'''A persistent on-disk cache for downloaded card images.
+
+MgTileCache keeps the decoded and resized images in memory as well, for
+processes creating many decks (see render_server).
+'''
+
+import os
+import hashlib
+import tempfile
+from threading import Lock
+from collections import OrderedDict
+
+from src.constants import CACHE_SIZE, TILE_CACHE_SIZE
+from src.get_image import localImageKey
+
+
+class MgImageCache(object):
+
+    '''Stores downloaded data on disk, keyed by the URL it was fetched from.
+
+    Entries are stored under the SHA-1 of the key, fanned out over 256
+    sub-directories. Files are written to a temporary file and atomically
+    renamed, so several threads (or processes) can safely share one cache
+    directory. The modification time of an entry is refreshed on every hit,
+    which allows the least recently used entries to be evicted once the
+    cache grows beyond max_bytes.
+    '''
+
+    # Temporary files start with this prefix and are ignored by the cache
+    TMP_PREFIX = '.tmp'
+
+    # Eviction trims the cache down to this fraction of max_bytes
+    LOW_WATER = 0.9
+
+    def __init__(self, directory, max_bytes=CACHE_SIZE):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._size = sum(entry[1] for entry in self._entries())
+
+    def keyPath(self, key):
+        '''Returns the file path an entry for key is stored at.'''
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, key):
+        '''Returns the cached bytes for key or None if it is not cached.'''
+        path = self.keyPath(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Mark the entry as recently used
+            os.utime(path)
+        except OSError:
+            return None
+
+        return data
+
+    def put(self, key, data):
+        '''Stores data under key. Returns False if it could not be stored.
+
+        A failure to write to the cache should never stop a card from being
+        pasted, so OSErrors are swallowed.
+        '''
+        path = self.keyPath(key)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                prefix=self.TMP_PREFIX, dir=directory
+            )
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+
+                with self._lock:
+                    try:
+                        self._size -= os.path.getsize(path)
+                    except OSError:
+                        pass
+                    os.replace(tmp_path, path)
+                    self._size += len(data)
+            except OSError:
+                os.remove(tmp_path)
+                raise
+        except OSError:
+            return False
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+        return True
+
+    def evict(self):
+        '''Removes the least recently used entries till the cache fits.
+
+        The directory is rescanned rather than trusting the running total,
+        as other processes may be writing to the same cache.
+        '''
+        with self._lock:
+            entries = sorted(self._entries())
+            self._size = sum(entry[1] for entry in entries)
+            target = self.max_bytes * self.LOW_WATER
+
+            for _, size, path in entries:
+                if self._size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
+
+    @property
+    def size(self):
+        '''The number of bytes currently held in the cache.'''
+        with self._lock:
+            return self._size
+
+    def _entries(self):
+        '''Yields (mtime, size, path) for every entry in the cache.'''
+        for sub_dir in os.scandir(self.directory):
+            if not sub_dir.is_dir():
+                continue
+            for entry in os.scandir(sub_dir.path):
+                if entry.name.startswith(self.TMP_PREFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                yield (stat.st_mtime, stat.st_size, entry.path)
+
+
+class MgTileCache(object):
+
+    '''Keeps card images decoded and resized in memory. Thread-safe.
+
+    Tiles are Pillow images at the size they are pasted at, keyed by key.
+    The least recently used tiles are dropped once the tiles take more than
+    max_bytes. Tiles are copied in and out, as the page thread closes every
+    image it has pasted.
+    '''
+
+    def __init__(self, max_bytes=TILE_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        self._tiles = OrderedDict()  # Key (key) and tile (value), LRU first
+        self._size = 0
+
+    @staticmethod
+    def key(local, card_tupple):
+        '''The key of the tile of a card, local being its image directory.
+
+        Local tiles are keyed by the path and modification time of their
+        image (see localImageKey), so a replaced image is not pasted from
+        the cache. Cards without a local image have no key (None).
+        '''
+        if not local:
+            return (local, card_tupple[3], card_tupple[2])
+
+        try:
+            key = localImageKey(local, card_tupple[3], card_tupple[2])
+        except OSError:
+            return None
+        return (local, key)
+
+    def get(self, key):
+        '''Returns a copy of the tile for key or None if it is not cached.'''
+        with self._lock:
+            tile = self._tiles.get(key)
+            if tile is None:
+                return None
+            self._tiles.move_to_end(key)
+
+        # Cached tiles are never changed or closed, only dropped
+        return tile.copy()
+
+    def put(self, key, tile):
+        '''Stores a copy of tile under key, unless key is already cached.'''
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return
+
+        tile = tile.copy()
+        nbytes = tile.size[0] * tile.size[1] * len(tile.getbands())
+
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = tile
+            self._size += nbytes
+
+            while self._size > self.max_bytes and len(self._tiles) > 1:
+                _, dropped = self._tiles.popitem(last=False)
+                self._size -= (
+                    dropped.size[0] * dropped.size[1] *
+                    len(dropped.getbands())
+                )
+
+    @property
+    def size(self):
+        '''The number of bytes currently held in the cache.'''
+        with self._lock:
+            return self._size
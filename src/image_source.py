@@ -0,0 +1,251 @@
+'''Routes image downloads to the fastest healthy of several sources.
+
+A source is an HTTP mirror or a local directory (given as a path or a
+file:// URL) with the /set/number.jpg layout used by master.json. Every
+source keeps track of its latency and health. MgSourceRouter sends each
+request to the fastest healthy source, and fails over to the next one if
+that source fails.
+'''
+
+import os
+import time
+import asyncio
+import urllib.parse
+import urllib.request
+from threading import Lock
+
+from src.get_image import getGenericData, streamData
+from src.mg_async import getGenericDataAsync
+from src.constants import (
+    MgNetworkException, MgTransientNetworkException, MgImageException,
+    BASE_URL
+)
+from src.logger_dict import MG_LOGGER_CONST
+
+# Weight of the latest latency in a source's moving average
+LATENCY_WEIGHT = 0.3
+
+# Longest time (sec) a failing source is avoided
+MAX_COOLDOWN = 60
+
+
+class MgImageSource(object):
+
+    '''A place images can be fetched from, with its latency and health.
+
+    Subclasses implement fetch (and fetchAsync) for a path such as
+    /m10/246.jpg, taking the consumer of getGenericData. Health is only
+    tracked through record, which is called by the MgSourceRouter while
+    holding its lock.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.latency = None  # Moving average of the latency (sec)
+        self.failures = 0  # Consecutive transient failures
+        self.down_until = 0  # When a failing source is tried again
+
+    def fetch(self, path, content_type, timeout, consumer=None):
+        raise NotImplementedError
+
+    async def fetchAsync(self, path, content_type, timeout, consumer=None):
+        raise NotImplementedError
+
+    def healthy(self, now):
+        return self.down_until <= now
+
+    def record(self, seconds=None):
+        '''Records a successful fetch, or a transient failure if no time.
+
+        A failing source is avoided for a time that doubles with every
+        consecutive failure.
+        '''
+        if seconds is None:
+            self.failures += 1
+            self.down_until = time.monotonic() + min(
+                MAX_COOLDOWN, 2 ** self.failures
+            )
+            return
+
+        self.failures = 0
+        self.down_until = 0
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += LATENCY_WEIGHT * (seconds - self.latency)
+
+
+class MgHttpSource(MgImageSource):
+
+    '''An HTTP(S) mirror of the image database.'''
+
+    def __init__(self, base_url):
+        super(MgHttpSource, self).__init__(base_url)
+        self.base_url = base_url.rstrip('/')
+
+    def fetch(self, path, content_type, timeout, consumer=None):
+        return getGenericData(
+            self.base_url + path, content_type, timeout, consumer
+        )
+
+    async def fetchAsync(self, path, content_type, timeout, consumer=None):
+        address = self.base_url + path
+        return await getGenericDataAsync(
+            address, content_type, timeout, consumer
+        )
+
+
+class MgDirectorySource(MgImageSource):
+
+    '''A local directory (or network share) mirroring the image database.
+
+    A missing image is a permanent failure of this source, but not of the
+    other sources.
+    '''
+
+    def __init__(self, directory):
+        super(MgDirectorySource, self).__init__(directory)
+        self.directory = directory
+
+    def fetch(self, path, content_type, timeout, consumer=None):
+        file_path = os.path.join(self.directory, *path.strip('/').split('/'))
+        try:
+            with open(file_path, 'rb') as f:
+                if consumer is None:
+                    return f.read()
+                return streamData(f, consumer(), file_path)
+        except FileNotFoundError as e:
+            raise MgNetworkException(
+                MG_LOGGER_CONST['network_error'] % (file_path, e.strerror),
+                status=404
+            )
+        except OSError as e:
+            raise MgTransientNetworkException(
+                MG_LOGGER_CONST['network_error'] % (file_path, e.strerror)
+            )
+
+    async def fetchAsync(self, path, content_type, timeout, consumer=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.fetch, path, content_type, timeout, consumer
+        )
+
+
+def createSource(location):
+    '''Creates the MgImageSource of a URL, file:// URL or directory.'''
+    scheme = urllib.parse.urlsplit(location).scheme
+    if scheme in ('http', 'https'):
+        return MgHttpSource(location)
+    if scheme == 'file':
+        return MgDirectorySource(
+            urllib.request.url2pathname(urllib.parse.urlsplit(location).path)
+        )
+    return MgDirectorySource(location)
+
+
+class MgSourceRouter(object):
+
+    '''Fetches images from the fastest healthy source. Thread-safe.
+
+    Only addresses in the image database (starting with base_url) are
+    routed, others are downloaded as they are. Sources are tried from the
+    fastest to the slowest, followed by the sources that have not been used
+    yet in the given order, so later sources are only used as a fallback
+    until they have proven to be faster. Failing sources are tried last.
+    The first success is returned. Data that is not a valid image (raising
+    MgImageException in the consumer) counts as a failure of its source, so
+    the next source is tried. If every source fails, the error of the
+    first is raised, as a transient error if any source failed transiently.
+    '''
+
+    def __init__(self, sources, base_url=BASE_URL):
+        self.sources = list(sources)
+        self.base_url = base_url
+        self._lock = Lock()
+
+    def fetch(self, address, content_type, timeout, consumer=None):
+        '''Returns the data of address, from the first source providing it.
+
+        See getGenericData for consumer, which is called for every source,
+        so the data is validated (or decoded) as part of every attempt.
+        '''
+        path = self.route(address)
+        if path is None:
+            return getGenericData(address, content_type, timeout, consumer)
+
+        errors = []
+        for source in self.ordered():
+            start = time.monotonic()
+            try:
+                data = source.fetch(path, content_type, timeout, consumer)
+            except (MgNetworkException, MgImageException) as e:
+                self.recordError(source, e, errors)
+                continue
+
+            self.record(source, time.monotonic() - start)
+            return data
+
+        raise self.finalError(errors)
+
+    async def fetchAsync(self, address, content_type, timeout, consumer=None):
+        '''The asyncio version of fetch.
+
+        The consumer is fed the data of a source once all of it has been
+        received, in a thread (see mg_async.consumeAsync).
+        '''
+        path = self.route(address)
+        if path is None:
+            return await getGenericDataAsync(
+                address, content_type, timeout, consumer
+            )
+
+        errors = []
+        for source in self.ordered():
+            start = time.monotonic()
+            try:
+                data = await source.fetchAsync(
+                    path, content_type, timeout, consumer
+                )
+            except (MgNetworkException, MgImageException) as e:
+                self.recordError(source, e, errors)
+                continue
+
+            self.record(source, time.monotonic() - start)
+            return data
+
+        raise self.finalError(errors)
+
+    def route(self, address):
+        '''The path of address in the image database, or None.'''
+        if address.startswith(self.base_url + '/'):
+            return address[len(self.base_url):]
+        return None
+
+    def ordered(self):
+        '''The sources in the order they should be tried.'''
+        now = time.monotonic()
+        with self._lock:
+            return sorted(self.sources, key=lambda source: (
+                not source.healthy(now), source.latency is None,
+                source.latency or 0
+            ))
+
+    def record(self, source, seconds):
+        with self._lock:
+            source.record(seconds)
+
+    def recordError(self, source, error, errors):
+        '''Records the failure of source and adds the error to errors.'''
+        errors.append(error)
+        # Data that is not an image is a failure of this source only
+        if isinstance(
+            error, (MgTransientNetworkException, MgImageException)
+        ):
+            with self._lock:
+                source.record()
+
+    def finalError(self, errors):
+        '''The error raised when all sources failed.'''
+        for error in errors:
+            if isinstance(error, MgTransientNetworkException):
+                return MgTransientNetworkException(str(errors[0]))
+        return errors[0]
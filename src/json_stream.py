@@ -0,0 +1,100 @@
+'''Extracts a few fields from a large JSON document without parsing it.'''
+
+import re
+import json
+from collections import OrderedDict
+
+# The characters that change the structure of a JSON document
+STRUCTURE = re.compile(r'["{}\[\]]')
+
+# A complete JSON string, including its quotes
+STRING = re.compile(r'"(?:[^"\\]|\\.)*"', re.DOTALL)
+
+# The first character after a string (a colon if the string is a key)
+NEXT_CHAR = re.compile(r'\s*(\S)')
+
+
+class MgJsonFieldScanner(object):
+
+    '''Collects string fields of the objects nested in a top level object.
+
+    Documents such as mtgjson's AllSets.json map a key (the set code) to an
+    object holding a few small fields and some very large ones (the cards).
+    The document is fed in chunks of text. Only the strings and brackets are
+    looked at, and only the wanted fields of the second level objects are
+    decoded, so memory use does not depend on the size of the document.
+
+    Results is an OrderedDict of top level key (key) and a dict of the wanted
+    fields found in its object (value), in document order.
+    '''
+
+    def __init__(self, fields):
+        self.fields = frozenset(fields)
+        self.results = OrderedDict()
+
+        self._buffer = ''  # Text not yet scanned, as it is incomplete
+        self._depth = 0  # Number of open objects and arrays
+        self._key = None  # The current top level key
+        self._field = None  # The wanted field whose value comes next
+
+    def feed(self, text):
+        '''Scans the next chunk of text.'''
+        buffer = self._buffer + text
+        pos = 0
+
+        while True:
+            match = STRUCTURE.search(buffer, pos)
+            if match is None:
+                pos = len(buffer)
+                break
+
+            char = match.group()
+            start = match.start()
+
+            if char == '"':
+                end = self.scanString(buffer, start)
+                if end is None:
+                    # The string (or what follows it) is incomplete
+                    pos = start
+                    break
+                pos = end
+            elif char in '{[':
+                self._depth += 1
+                pos = start + 1
+            else:
+                self._depth -= 1
+                pos = start + 1
+
+        self._buffer = buffer[pos:]
+
+    def scanString(self, buffer, start):
+        '''Handles the string at start. Returns where scanning continues.
+
+        Returns None if the buffer ends before the string can be handled.
+        '''
+        string = STRING.match(buffer, start)
+        if string is None:
+            return None
+
+        end = string.end()
+        if self._depth > 2:
+            # Nothing is wanted from deeper levels
+            return end
+
+        next_char = NEXT_CHAR.match(buffer, end)
+        if next_char is None:
+            return None
+
+        if next_char.group(1) == ':':
+            key = json.loads(string.group())
+            if self._depth == 1:
+                self._key = key
+            elif self._depth == 2:
+                self._field = key if key in self.fields else None
+        elif self._depth == 2 and self._field is not None:
+            self.results.setdefault(self._key, {})[self._field] = json.loads(
+                string.group()
+            )
+            self._field = None
+
+        return end
@@ -0,0 +1,195 @@
+'''An in-memory index of the card images in a local directory.
+
+Local images used to be opened at exactly directory/card_name, so file names
+had to match the card names byte for byte, without an extension. The index
+scans the directory once with os.scandir instead, and resolves card names
+in constant time, ignoring case, accents, punctuation and the extension of
+the file. The printing of a set can be given as a subfolder named after the
+set (M10/Swamp.jpg or [M10]/Swamp.jpg) or as a suffix (Swamp [M10].jpg).
+
+The index is refreshed when the modification time of the directory or one
+of its set subfolders changes, which is checked at most once every
+LOCAL_INDEX_CHECK seconds.
+'''
+
+import os
+import re
+import time
+import threading
+import unicodedata
+
+from src.constants import IMAGE_EXTENSIONS, LOCAL_INDEX_CHECK
+
+# Matches a set given as a [SET] suffix of the file name
+_SET_SUFFIX = re.compile(r'^(.*?)\s*\[([^\]]+)\]$')
+
+# Runs of characters that are not letters or digits
+_PUNCTUATION = re.compile(r'[\W_]+')
+
+# Letters not decomposed by NFKD
+_LIGATURES = {ord('æ'): 'ae', ord('œ'): 'oe', ord('ß'): 'ss'}
+
+
+def normalizeName(name):
+    '''Returns the name case-folded, without accents and punctuation.
+
+    Apostrophes are removed, other runs of punctuation become a single
+    space: "Æther Vial" is "aether vial", "Fire // Ice" is "fire ice".
+    '''
+    name = unicodedata.normalize('NFKD', name.casefold())
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    name = name.translate(_LIGATURES).replace("'", '').replace('’', '')
+    return _PUNCTUATION.sub(' ', name).strip()
+
+
+def normalizeSet(set_name):
+    '''Returns the set code case-folded, without surrounding brackets.'''
+    return set_name.strip().strip('[]').strip().casefold()
+
+
+def splitFileName(file_name):
+    '''Returns the card name and set of an image file, or None.
+
+    The set is None if the file name has no [SET] suffix. Files with an
+    extension that is not an image extension are kept whole, as card names
+    can contain dots.
+    '''
+    stem, extension = os.path.splitext(file_name)
+    if extension.lower() not in IMAGE_EXTENSIONS:
+        stem = file_name
+
+    match = _SET_SUFFIX.match(stem)
+    if match:
+        return match.group(1), match.group(2)
+
+    return stem, None
+
+
+class MgLocalIndex(object):
+
+    '''Resolves card names to the image files of a directory.
+
+    Files directly in the directory are cards of any set. The files of a
+    subfolder are the printings of the set it is named after.
+    '''
+
+    def __init__(self, directory, check_interval=LOCAL_INDEX_CHECK):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._cards = {}  # Normalized name -> path
+        self._printings = {}  # (Normalized name, set) -> path
+        self._mtimes = None  # Directory path -> mtime when scanned
+        self._checked = 0  # When the mtimes were last checked
+
+    def resolve(self, card_name, set_name=None):
+        '''Returns the path of the image of a card, None if there is none.
+
+        The printing of set_name is preferred, any printing is returned if
+        the directory has none of that set.
+        '''
+        self.refresh()
+        name = normalizeName(card_name)
+        if set_name:
+            path = self._printings.get((name, normalizeSet(set_name)))
+            if path is not None:
+                return path
+
+        return self._cards.get(name)
+
+    def refresh(self):
+        '''Scans the directory again if it has changed since the last scan.'''
+        with self._lock:
+            now = time.monotonic()
+            if self._mtimes is not None:
+                if now - self._checked < self.check_interval:
+                    return
+
+                # Only a check that has run delays the next one
+                self._checked = now
+                if not self.isStale():
+                    return
+
+            self.scan()
+            self._checked = now
+
+    def isStale(self):
+        '''True if a scanned directory has been modified or removed.'''
+        for path, mtime in self._mtimes.items():
+            try:
+                if os.stat(path).st_mtime_ns != mtime:
+                    return True
+            except OSError:
+                return True
+
+        return False
+
+    def scan(self):
+        '''Builds the index from the files of the directory and subfolders.
+
+        Files are indexed in name order, so that the first of several files
+        with the same normalized name is always the one resolved.
+        '''
+        cards = {}
+        printings = {}
+        mtimes = {}
+        subfolders = []
+
+        for entry in self.entries(self.directory, mtimes):
+            if entry.is_dir():
+                subfolders.append(entry)
+                continue
+
+            card_name, set_name = splitFileName(entry.name)
+            name = normalizeName(card_name)
+            cards.setdefault(name, entry.path)
+            if set_name:
+                printings.setdefault(
+                    (name, normalizeSet(set_name)), entry.path
+                )
+
+        for folder in subfolders:
+            set_code = normalizeSet(folder.name)
+            for entry in self.entries(folder.path, mtimes):
+                if entry.is_dir():
+                    continue
+
+                card_name, set_name = splitFileName(entry.name)
+                name = normalizeName(card_name)
+                printings.setdefault((name, set_code), entry.path)
+                cards.setdefault(name, entry.path)
+
+        self._cards = cards
+        self._printings = printings
+        self._mtimes = mtimes
+
+    def entries(self, path, mtimes):
+        '''Returns the visible entries of a directory sorted by name.
+
+        The modification time of the directory is recorded in mtimes, before
+        it is read, so that a change while scanning triggers another scan.
+        '''
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+            with os.scandir(path) as it:
+                entries = [e for e in it if not e.name.startswith('.')]
+        except OSError:
+            mtimes.setdefault(path, None)
+            return []
+
+        return sorted(entries, key=lambda entry: entry.name)
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def localIndex(directory):
+    '''Returns the MgLocalIndex of a directory, shared by all threads.'''
+    directory = os.path.abspath(directory)
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(directory)
+        if index is None:
+            index = _INDEXES[directory] = MgLocalIndex(directory)
+
+    return index
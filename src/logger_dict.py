@@ -47,6 +47,9 @@ MG_LOGGER_CONST = {
     # Cannot open input file
     'bad_input': 'Could not open input file: %s',
 
+    # Reading an input file failed part way
+    'read_fail': 'Could not read the rest of the input file. Reason: %s.',
+
     # Timeout error getting a card from the network
     'network_error': (
         'Could not connect to %s. Reason: %s.'),
@@ -57,6 +60,12 @@ MG_LOGGER_CONST = {
     # Error message for unexpected content type of HTML response
     'ct_error': 'Expected Content-Type %s. Received %s instead from %s',
 
+    # Downloaded data that is not an image
+    'not_image': 'The data received is not an image',
+
+    # Error message for a response shorter than its Content-Length
+    'length_error': 'Expected %d bytes. Received %d instead from %s',
+
     # Failed card download (second placeholder is the reason)
     'card_error': 'Could not download %s. %s',
 
@@ -66,8 +75,68 @@ MG_LOGGER_CONST = {
     # Local database copy could not be found
     'image_database_error': 'Card could not be found in local database',
 
+    # Unknown card, with the closest card name
+    'fuzzy_suggest': (
+        'Card could not be found in local database (closest card: %s)'
+    ),
+
+    # Unknown card replaced by the closest card (--fuzzy)
+    'fuzzy_msg': 'Using %s for unknown card %s (%d%% similar).',
+
+    # The card lookup could not be opened
+    'index_error': 'Cannot open %s lookup',
+
     # Failed to save file to specified path
-    'save_fail': 'Could not save page as %s. Reason: %s.'
+    'save_fail': 'Could not save page as %s. Reason: %s.',
+
+    # Image cache statistics
+    'cache_msg': 'Image cache: %d hit(s) and %d miss(es).',
+
+    # Bytes held by the queues of a memory budget
+    'memory_msg': (
+        'Queued images and pages: %d byte(s) at peak, %d byte(s) on average.'
+    ),
+
+    # Page encoder statistics
+    'encode_msg': 'Page encoder %s: %d page(s) in %.3f s, %d byte(s).',
+
+    # Pages saved from an identical page instead of being encoded
+    'reuse_msg': '%d identical page(s) reused an earlier page.',
+
+    # A page that was not pasted, as it is identical to a page that failed
+    'reuse_fail': 'the identical page %d could not be saved',
+
+    # Retried and hedged downloads
+    'fetch_msg': '%d download(s) retried and %d hedged.',
+
+    # Encode statistics of a single page
+    'encode_page': 'Page %d encoded in %.3f s to %d byte(s).',
+
+    # Start of the report of a deck in a batch
+    'deck_msg': 'Deck %s:',
+
+    # Throughput of all decks in a batch
+    'batch_msg': (
+        'Batch: %d deck(s), %d card(s) across %d page(s) with %d error(s) ' +
+        'in %.1f s (%.1f card(s) and %.1f page(s) per second).'
+    ),
+
+    # The server is ready to create decks
+    'serve_msg': 'Creating the decks POSTed to %s/render. Ctrl+C stops.',
+
+    # Pages created again by an incremental run
+    'incremental_msg': '%d of %d page(s) changed and have been created.',
+
+    # A deck created by the server
+    'job_msg': (
+        'Deck %s: %d card(s) across %d page(s) with %d error(s) in %.2f s.'
+    ),
+
+    # The cached JSON of a set could not be read
+    'set_cache_error': 'Could not read the set file %s. Reason: %s.',
+
+    # Booster packs sampled before their pages are created
+    'booster_msg': '%d booster pack(s) of %s drawn, listed in %s.'
 }
 
 
@@ -0,0 +1,125 @@
+'''Bounds the memory held by the queues between the thread groups.
+
+Bounding a queue by its number of items says little about its memory: a
+decoded scan and a full page at a high dpi differ in size by orders of
+magnitude. MgBudgetQueue charges every queue car the size of the pixel
+buffer it carries against a shared MgMemoryGovernor, and producers block
+while the budget is exhausted.
+'''
+
+import time
+from queue import Queue
+from threading import Condition
+
+from src.tile_pool import MgPendingTile
+
+
+def queuedBytes(queue_car):
+    '''Estimates the bytes of the pixel buffer carried by a queue car.'''
+    image = queue_car.image
+    if image is None:
+        return 0
+
+    if isinstance(image, MgPendingTile):
+        return image.nbytes
+
+    return image.size[0] * image.size[1] * len(image.getbands())
+
+
+class MgMemoryGovernor(object):
+
+    '''A thread-safe byte budget shared by several queues.
+
+    A queue holding nothing is always allowed to take a car, even one larger
+    than the remaining budget. Otherwise a queue whose consumer is blocked
+    putting on another queue could never be drained, and a car larger than
+    the whole budget could never be queued. The budget can therefore be
+    exceeded by at most one car per queue.
+    '''
+
+    def __init__(self, budget):
+        self.budget = budget
+
+        self._condition = Condition()
+        self._used = 0  # Bytes currently charged
+        self._owners = {}  # Bytes charged by each queue
+        self._peak = 0
+        self._start = time.monotonic()
+        self._changed = self._start  # When _used last changed
+        self._byte_seconds = 0.0  # Integral of _used over time
+
+    def acquire(self, owner, nbytes):
+        '''Charges nbytes to owner, blocking while the budget is exhausted.'''
+        with self._condition:
+            while (
+                self._owners.get(owner, 0) > 0 and
+                self._used + nbytes > self.budget
+            ):
+                self._condition.wait()
+
+            self.update(nbytes)
+            self._owners[owner] = self._owners.get(owner, 0) + nbytes
+
+    def release(self, owner, nbytes):
+        '''Returns nbytes charged to owner to the budget.'''
+        with self._condition:
+            self.update(-nbytes)
+            self._owners[owner] -= nbytes
+            self._condition.notify_all()
+
+    def update(self, nbytes):
+        '''Changes the used bytes, keeping the statistics. Lock must be held.'''
+        now = time.monotonic()
+        self._byte_seconds += self._used * (now - self._changed)
+        self._changed = now
+
+        self._used += nbytes
+        self._peak = max(self._peak, self._used)
+
+    @property
+    def peak(self):
+        '''The most bytes charged at any one time.'''
+        with self._condition:
+            return self._peak
+
+    @property
+    def average(self):
+        '''The bytes charged, averaged over the lifetime of the governor.'''
+        with self._condition:
+            now = time.monotonic()
+            byte_seconds = (
+                self._byte_seconds + self._used * (now - self._changed)
+            )
+            elapsed = now - self._start
+            return byte_seconds / elapsed if elapsed > 0 else self._used
+
+
+class MgBudgetQueue(Queue):
+
+    '''A Queue of MgQueueCars bounded by an MgMemoryGovernor.
+
+    The optional maxsize still bounds the number of cars as well.
+    '''
+
+    def __init__(self, governor, maxsize=0):
+        super(MgBudgetQueue, self).__init__(maxsize)
+        self.governor = governor
+
+    def put(self, item, block=True, timeout=None):
+        '''Charges the car to the budget and puts it on the queue.
+
+        Unlike Queue.put, waiting for the budget ignores block and timeout.
+        '''
+        item.queued_bytes = queuedBytes(item)
+        self.governor.acquire(self, item.queued_bytes)
+        try:
+            super(MgBudgetQueue, self).put(item, block, timeout)
+        except BaseException:
+            self.governor.release(self, item.queued_bytes)
+            raise
+
+    def get(self, block=True, timeout=None):
+        '''Takes a car off the queue and returns its bytes to the budget.'''
+        item = super(MgBudgetQueue, self).get(block, timeout)
+        self.governor.release(self, item.queued_bytes)
+        return item
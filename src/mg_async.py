@@ -0,0 +1,500 @@
+'''An asyncio based fetch backend, an alternative to MgGetImageThread.'''
+
+import ssl
+import asyncio
+import weakref
+import http.client
+import urllib.parse
+from io import BytesIO
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+
+from src.mg_thread import MgGetImageThread, FETCH_ERRORS
+from src.image_cache import MgTileCache
+from src.get_image import (createPolicyAddress, createLocalAddress,
+                           getLocalMgImage, openAndValidateImage,
+                           MgImageDataCheck, streamData, statusError)
+from src.fetch_policy import FETCH_POLICY
+from src.http_pool import REDIRECT_CODES, STALE_ERRORS
+from src.constants import (
+    MgNetworkException, MgTransientNetworkException, TIMEOUT, MAX_REDIRECTS,
+    ASYNC_FETCH_LIMIT, POOL_SIZE
+)
+from src.logger_dict import MG_LOGGER_CONST
+
+# The connection pool of every running event loop, see asyncPool
+_POOLS = weakref.WeakKeyDictionary()
+
+
+class MgAsyncConnectionPool(object):
+
+    '''The asyncio version of http_pool.MgConnectionPool.
+
+    Keeps the stream reader and writer of idle connections per
+    (scheme, host, port). Streams belong to the event loop that opened them,
+    so every loop has a pool of its own (see asyncPool). A request failing
+    on a reused connection before the status line is retried once on a
+    fresh one. Unlike MgConnectionPool, it does not use proxies, so the
+    thread backend has to be used behind one.
+    '''
+
+    def __init__(self, max_size=POOL_SIZE):
+        self.max_size = max_size
+        self._idle = {}  # Idle (reader, writer) pairs by (scheme, host, port)
+
+    async def acquire(self, key, context):
+        '''Returns the reader and writer of a connection to key.
+
+        The last value returned is true if the connection was reused.
+        '''
+        idle = self._idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+
+        reader, writer = await asyncio.open_connection(
+            key[1], key[2], ssl=context
+        )
+        return reader, writer, False
+
+    def release(self, key, reader, writer):
+        '''Hands a connection back, closes it if the pool is full.'''
+        idle = self._idle.setdefault(key, [])
+        if writer.is_closing() or len(idle) >= self.max_size:
+            writer.close()
+        else:
+            idle.append((reader, writer))
+
+    def clear(self):
+        '''Closes all idle connections.'''
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle.clear()
+
+
+def asyncPool():
+    '''Returns the MgAsyncConnectionPool of the running event loop.'''
+    loop = asyncio.get_running_loop()
+    pool = _POOLS.get(loop)
+    if pool is None:
+        pool = _POOLS[loop] = MgAsyncConnectionPool()
+    return pool
+
+
+async def consumeAsync(data, consumer, address):
+    '''Feeds downloaded data to a new consumer in a thread, see streamData.
+
+    Returns the data as it is if there is no consumer.
+    '''
+    if consumer is None:
+        return data
+
+    return await asyncio.get_running_loop().run_in_executor(
+        None, streamData, BytesIO(data), consumer(), address
+    )
+
+
+async def getGenericDataAsync(
+    address, content_type, timeout=TIMEOUT, consumer=None
+):
+    '''The asyncio version of get_image.getGenericData.
+
+    Raises the same MgNetworkExceptions. The timeout applies to the
+    request as a whole. The optional consumer is fed the data once all of
+    it has been received (see consumeAsync).
+    '''
+    try:
+        data = await asyncio.wait_for(
+            _getData(address, content_type), timeout
+        )
+    except asyncio.TimeoutError:
+        raise MgTransientNetworkException(
+            MG_LOGGER_CONST['network_error'] % (address, 'timed out')
+        )
+    except (OSError, EOFError, http.client.HTTPException) as e:
+        raise MgTransientNetworkException(
+            MG_LOGGER_CONST['network_error'] % (address, str(e))
+        )
+
+    return await consumeAsync(data, consumer, address)
+
+
+async def _getData(address, content_type):
+    '''Downloads address, following redirects. See getGenericDataAsync.
+
+    Connections are kept alive in the asyncPool, unless the response
+    ends with the connection or has not been read completely.
+    '''
+    pool = asyncPool()
+    location = address
+    for _ in range(MAX_REDIRECTS + 1):
+        response = await _request(pool, location)
+        keep = False
+        try:
+            status, headers = response.status, response.headers
+            if status in REDIRECT_CODES and 'location' in headers:
+                location = urllib.parse.urljoin(location, headers['location'])
+                continue
+
+            if status != 200:
+                raise statusError(status, address)
+
+            response_content_type = headers.get('content-type')
+            if response_content_type != content_type:
+                raise MgNetworkException(
+                    MG_LOGGER_CONST['ct_error'] %
+                    (content_type, response_content_type, address)
+                )
+
+            data = await response.read()
+            keep = response.keep_alive
+            return data
+        finally:
+            if keep:
+                pool.release(response.key, response.reader, response.writer)
+            else:
+                response.writer.close()
+
+    raise http.client.HTTPException('Too many redirects for %s' % address)
+
+
+class MgAsyncResponse(object):
+
+    '''The status, headers (with lower case names) and body of a response.
+
+    keep_alive is true if the connection can be reused once the body has
+    been read.
+    '''
+
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.status = None
+        self.headers = {}
+        self.keep_alive = False
+
+    async def readHead(self):
+        '''Reads the status line and headers.'''
+        status_line = (await self.reader.readline()).decode('latin-1')
+        if not status_line:
+            raise http.client.RemoteDisconnected(
+                'Remote end closed connection without response'
+            )
+        try:
+            version, status = status_line.split(None, 2)[:2]
+            self.status = int(status)
+        except ValueError:
+            raise http.client.BadStatusLine(status_line)
+
+        while True:
+            line = (await self.reader.readline()).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            self.headers[name.strip().lower()] = value.strip()
+
+        connection = self.headers.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = connection == 'keep-alive'
+        else:
+            self.keep_alive = connection != 'close'
+
+    async def read(self):
+        '''Reads the body, chunked, of Content-Length or up to the end.'''
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            return await self.readChunked()
+
+        if 'content-length' in self.headers:
+            try:
+                length = int(self.headers['content-length'])
+            except ValueError:
+                raise http.client.HTTPException(
+                    'Bad Content-Length %s' % self.headers['content-length']
+                )
+            return await self.reader.readexactly(length)
+
+        # The body ends with the connection
+        self.keep_alive = False
+        return await self.reader.read()
+
+    async def readChunked(self):
+        '''Reads a body sent with the chunked transfer encoding.'''
+        chunks = []
+        while True:
+            line = await self.reader.readline()
+            try:
+                size = int(line.split(b';', 1)[0].strip(), 16)
+            except ValueError:
+                raise http.client.HTTPException('Bad chunk size %r' % line)
+            if size == 0:
+                break
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)  # The CRLF after the chunk
+
+        # Skips the trailer, which ends with an empty line
+        while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        return b''.join(chunks)
+
+
+async def _request(pool, address):
+    '''Sends a GET request and reads the status line and headers.
+
+    HTTP/1.1 is used on a connection of the pool. A request on a reused
+    connection that the server has closed meanwhile is sent again on a new
+    connection. Returns the MgAsyncResponse, the body is left unread.
+    '''
+    parts = urllib.parse.urlsplit(address)
+    if parts.scheme == 'https':
+        port = parts.port or http.client.HTTPS_PORT
+        context = ssl.create_default_context()
+    elif parts.scheme == 'http':
+        port = parts.port or http.client.HTTP_PORT
+        context = None
+    else:
+        raise http.client.InvalidURL('Unsupported scheme %s' % parts.scheme)
+
+    key = (parts.scheme, parts.hostname, port)
+    path = urllib.parse.urlunsplit(
+        ('', '', parts.path or '/', parts.query, '')
+    )
+    request = (
+        'GET %s HTTP/1.1\r\nHost: %s\r\nAccept: */*\r\n'
+        'Accept-Encoding: identity\r\nConnection: keep-alive\r\n\r\n' %
+        (path, parts.netloc)
+    ).encode('latin-1')
+
+    while True:
+        reader, writer, reused = await pool.acquire(key, context)
+        response = MgAsyncResponse(key, reader, writer)
+        try:
+            writer.write(request)
+            await writer.drain()
+            await response.readHead()
+        except STALE_ERRORS + (asyncio.IncompleteReadError,):
+            writer.close()
+            if reused:
+                continue
+            raise
+        except BaseException:
+            writer.close()
+            raise
+        return response
+
+
+class MgAsyncGetImageThread(MgGetImageThread):
+
+    '''Fetches images on an asyncio event loop instead of blocking threads.
+
+    Has the same In-Queue and Out-Queue as MgGetImageThread, but only one
+    instance is needed. Up to limit cards are fetched concurrently. Image
+    decoding, card lookups and cache access block, so they are handed to a
+    small thread pool. Decoding is left to the MgTilePool instead, if one is
+    provided. Taking cars off the In-Queue and putting images on the
+    (bounded) Out-Queue can block for long, so each has a single thread of
+    its own. Finished cars are handed over to the Out-Queue thread in order,
+    through an asyncio.Queue.
+    '''
+
+    def __init__(
+        self, in_queue, out_queue, local, reporter, logger=None, cache=None,
+        coalescer=None, tile_pool=None, tile_size=None, selector=None,
+        policy=None, router=None, limit=ASYNC_FETCH_LIMIT, tiles=None
+    ):
+        super(MgAsyncGetImageThread, self).__init__(
+            in_queue, out_queue, local, reporter, logger, cache, coalescer,
+            tile_pool, tile_size, selector, policy, router, tiles
+        )
+        self.limit = limit
+        self.executor = None
+        self.get_executor = None
+        self.put_executor = None
+
+    def run(self):
+        '''Runs the event loop till the stop signal has been received.'''
+        with ThreadPoolExecutor() as executor, \
+                ThreadPoolExecutor(1) as get_executor, \
+                ThreadPoolExecutor(1) as put_executor:
+            self.executor = executor
+            self.get_executor = get_executor
+            self.put_executor = put_executor
+            asyncio.run(self.runLoop())
+
+    async def runLoop(self):
+        '''Takes cars off the In-Queue and starts a task for each of them.
+
+        A car holds on to its place under the limit until it has been handed
+        over, so waiting on a full Out-Queue slows the fetches down.
+        '''
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.limit)
+        finished = asyncio.Queue()
+        hand_over = asyncio.ensure_future(self.handOver(finished, semaphore))
+        tasks = set()
+
+        try:
+            while True:
+                queue_car = await loop.run_in_executor(
+                    self.get_executor, self.in_queue.get
+                )
+                if queue_car.end_thread:
+                    self.in_queue.task_done()
+                    break
+
+                await semaphore.acquire()
+                task = asyncio.ensure_future(
+                    self.fetchCar(queue_car, finished)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+            await finished.put(None)
+            await hand_over
+        finally:
+            asyncPool().clear()
+
+    async def handOver(self, finished, semaphore):
+        '''Passes finished cars to putCar, one at a time, till None.'''
+        loop = asyncio.get_running_loop()
+        while True:
+            queue_car = await finished.get()
+            if queue_car is None:
+                return
+            await loop.run_in_executor(
+                self.put_executor, self.putCar, queue_car
+            )
+            semaphore.release()
+
+    def putCar(self, queue_car):
+        '''Puts the image of a finished car on the Out-Queue.
+
+        Puts the stop signal on the Out-Queue once the job is done. Runs in
+        the Out-Queue thread.
+        '''
+        job = queue_car.job or self.job
+        if queue_car.image is not None:
+            job.out_queue.put(queue_car)
+        job.finishCar()
+        self.in_queue.task_done()
+
+    async def fetchCar(self, queue_car, finished):
+        '''Fetches the image of a single car and hands it over when done.'''
+        job = queue_car.job or self.job
+        card_tupple = queue_car.input_tupple
+        try:
+            if self.tiles is not None:
+                # Keys of local tiles stat the image, off the event loop
+                queue_car.tile_key = await self.inExecutor(
+                    MgTileCache.key, job.local, card_tupple
+                )
+            queue_car.image = await self.fetchAsync(
+                card_tupple, job, queue_car.tile_key
+            )
+        except FETCH_ERRORS as reason:
+            self.logFetchError(card_tupple, reason, job.reporter)
+        finally:
+            await finished.put(queue_car)
+
+    async def fetchAsync(self, card_tupple, job, tile_key=None):
+        '''Returns the image, shared through the coalescer if provided.'''
+        if job.coalescer is None:
+            return await self.getImage(card_tupple, job, tile_key)
+
+        return await job.coalescer.fetchAsync(
+            card_tupple, lambda: self.getImage(card_tupple, job, tile_key)
+        )
+
+    async def getImage(self, card_tupple, job, tile_key=None):
+        '''Returns the image of a card from the web or local directory.
+
+        The tile cached under tile_key is returned instead, if there is one.
+        '''
+        card_name = card_tupple[3]
+        set_name = card_tupple[2]
+
+        if self.tiles is not None:
+            tile = await self.inExecutor(self.cachedTile, tile_key)
+            if tile is not None:
+                return tile
+
+        if job.local:
+            if self.tile_pool is not None:
+                # Resolving may scan the directory, off the event loop
+                address = await self.inExecutor(
+                    createLocalAddress, job.local, card_name, set_name
+                )
+                return self.tile_pool.submit(address)
+            return await self.inExecutor(
+                getLocalMgImage, job.local, card_name, self.tile_size,
+                set_name
+            )
+
+        # The lookup can build the card index, off the event loop
+        address = await self.inExecutor(
+            createPolicyAddress, card_name, set_name, self.selector,
+            self.policy
+        )
+        data = await self.getData(address, job.reporter)
+
+        if self.tile_pool is not None:
+            return self.tile_pool.submit(data)
+        return await self.inExecutor(self.decode, data)
+
+    async def getData(self, address, reporter=None):
+        '''Downloads address, checking the image cache first.
+
+        Cache hits and misses are counted in the optional reporter.
+        '''
+        if self.cache is None:
+            return await self.download(address)
+
+        data = await self.inExecutor(self.cache.get, address)
+        if data is not None:
+            if reporter:
+                reporter.addCacheHit()
+            return data
+
+        if reporter:
+            reporter.addCacheMiss()
+        # Only data that has passed the MgImageDataCheck is cached
+        data = await self.download(address)
+        await self.inExecutor(self.cache.put, address, data)
+        return data
+
+    async def download(self, address):
+        '''Downloads address with the retries of the MgFetchPolicy.
+
+        The data is checked to be an image (see MgImageDataCheck).
+        '''
+        policy = self.policy or FETCH_POLICY
+
+        if self.router is None:
+            def fetch_coro(timeout):
+                return getGenericDataAsync(
+                    address, 'image/jpeg', timeout, MgImageDataCheck
+                )
+        else:
+            # Bodies that are not images fail over to the next source
+            def fetch_coro(timeout):
+                return self.router.fetchAsync(
+                    address, 'image/jpeg', timeout, MgImageDataCheck
+                )
+
+        return await policy.fetchAsync(address, fetch_coro)
+
+    def decode(self, data):
+        '''Opens the downloaded data as a Pillow image.'''
+        with closing(BytesIO(data)) as image_stream:
+            return openAndValidateImage(image_stream, self.tile_size)
+
+    def inExecutor(self, func, *args):
+        '''Runs a blocking call in the thread pool.'''
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
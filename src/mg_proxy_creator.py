@@ -1,15 +1,35 @@
 import re
-import os.path
+import os
+import sys
+import time
+import contextlib
+import signal
 import logging
 
 from src.create_page import MgImageCreator
-from src.constants import MgException, ARG_CONST
+from src.image_cache import MgImageCache, MgTileCache
+from src.card_index import CARD_INDEX
+from src.render_server import MgRenderService, createServer
+from src.card_select import MgCardSelector
+from src.page_encoder import PAGE_ENCODER_CLASSES
+from src.fetch_policy import MgFetchPolicy
+from src.image_source import MgSourceRouter, MgHttpSource, createSource
+from src.booster import MgBoosterSampler, boosterSlots
+from src.get_mtg_json import MgSetCache, parseLocalSetForRarity
+from src.constants import (MgException, ARG_CONST, PAGE_ENCODERS, BASE_URL,
+                           DECK_EXTENSIONS, STDIN_DECK, STDIN_NAME,
+                           BOOSTER_NAME, PACK_LIST_EXT)
 from src.argv_input import arg_parser
 from src.logger_dict import MG_LOGGER_CONST
 
 logger = logging.getLogger(MG_LOGGER_CONST['base_name'])
 
 
+# Compiled once, as every line of a deck is matched against them
+CARD_LINE = re.compile(r'^\s*(?:(SB:)\s+)?(\d+)\s+(?:\[(\w*)\]\s+)?(\S.*)$')
+COMMENT_LINE = re.compile(r'^\s*//')
+
+
 def parseLine(line):
     '''Parses input lines for card information.
     Expects the following format: ['SB:'] int [SET: three char code] card name.
@@ -19,7 +39,7 @@ def parseLine(line):
     TODO: Rather then returning a list, it might be better to return a
     dictionary for legibilities sake. DAVE WAS HERE!
     '''
-    match = re.match(r'^\s*(?:(SB:)\s+)?(\d+)\s+(?:\[(\w*)\]\s+)?(\S.*)$', line)
+    match = CARD_LINE.match(line)
 
     if match is None:
         raise MgException(MG_LOGGER_CONST['bad_parse'] % line.strip())
@@ -39,25 +59,80 @@ def parseLine(line):
     return parsed
 
 
+class MgDeckParser(object):
+
+    '''Parses the lines of a deck as they are read, counting invalid ones.
+
+    Parse is a generator, so the cards of a deck can be created while the
+    rest of it is still being read, from a large file or a pipe. The number
+    of invalid lines is complete once it is exhausted.
+    '''
+
+    def __init__(self):
+        self.invalid_lines = 0
+
+    def parse(self, lines):
+        '''Yields the parsed list of every valid line.
+
+        Invalid lines are logged and counted. An error reading the lines is
+        logged and counted as an invalid line, ending the deck.
+        '''
+        try:
+            for line in lines:
+                # Ignore lines that are whitespace only or start with //
+                if line.isspace() or COMMENT_LINE.match(line):
+                    continue
+
+                try:
+                    card = parseLine(line)
+                except MgException as e:
+                    self.invalid_lines += 1
+                    logger.error(str(e))
+                    continue
+
+                yield card
+        except (IOError, UnicodeDecodeError) as e:
+            self.invalid_lines += 1
+            logger.critical(MG_LOGGER_CONST['read_fail'] % e)
+
+
 def parseFile(f):
     '''Takes MWS file object and arses it.
 
     Returns tupple with two elements: a list of valid lines and
     count of invalid lines
     '''
-    valid_list = []
-    invalid_lines = 0
+    parser = MgDeckParser()
+    valid_list = list(parser.parse(f))
 
-    for line in f:
-        # Ignore lines that are whitespace only or start with //
-        if not (line.isspace() or re.match(r'^\s*//', line)):
-            try:
-                valid_list.append(parseLine(line))
-            except MgException as e:
-                invalid_lines += 1
-                logger.error(str(e))
+    return (valid_list, parser.invalid_lines)
+
+
+def correctNames(cards, threshold):
+    '''Yields the cards, replacing unknown names by the closest card name.
+
+    Names are only replaced by a card at least threshold similar. Other
+    unknown cards are left for the image getters to report.
+    '''
+    for card in cards:
+        card_name = card[3]
+        try:
+            match = None if card_name in CARD_INDEX else CARD_INDEX.closest(
+                card_name, threshold
+            )
+        except MgException as e:
+            # Without an index, no name can be corrected
+            logger.critical(str(e))
+            yield card
+            yield from cards
+            return
 
-    return (valid_list, invalid_lines)
+        if match is not None:
+            card[3] = match[0]
+            logger.warning(MG_LOGGER_CONST['fuzzy_msg'] % (
+                match[0], card_name, match[1] * 100
+            ))
+        yield card
 
 
 def createMgInstance(parsed_input):
@@ -66,10 +141,132 @@ def createMgInstance(parsed_input):
         parsed_input[ARG_CONST['dpi']],
         parsed_input[ARG_CONST['dimension']],
         parsed_input[ARG_CONST['number']],
-        logger
+        logger,
+        createCache(parsed_input),
+        parsed_input[ARG_CONST['backend']],
+        parsed_input[ARG_CONST['fetch_limit']],
+        parsed_input[ARG_CONST['workers']],
+        MgCardSelector(
+            parsed_input[ARG_CONST['select']],
+            parsed_input[ARG_CONST['seed']],
+            parsed_input[ARG_CONST['era']]
+        ),
+        parsed_input[ARG_CONST['output']],
+        createEncoder(parsed_input),
+        createMemoryBudget(parsed_input),
+        MgFetchPolicy(
+            parsed_input[ARG_CONST['retries']],
+            parsed_input[ARG_CONST['hedge']]
+        ),
+        createRouter(parsed_input),
+        createTileCache(parsed_input),
+        parsed_input[ARG_CONST['resize']]
         )
 
 
+def createCache(parsed_input):
+    '''Creates the MgImageCache requested by the user or returns None.'''
+    cache_dir = parsed_input[ARG_CONST['cache']]
+    if cache_dir is None:
+        return None
+
+    cache_size = parsed_input[ARG_CONST['cache_size']] * 1024 ** 2
+    return MgImageCache(cache_dir, cache_size)
+
+
+def createTileCache(parsed_input):
+    '''Creates the MgTileCache requested by the user or returns None.
+
+    Decks are served, and boosters created, with a tile cache, unless its
+    size is set to 0.
+    '''
+    tile_cache = parsed_input[ARG_CONST['tile_cache']]
+    if tile_cache is None:
+        boosters = parsed_input[ARG_CONST['booster']]
+        if not (isServing(parsed_input) or boosters):
+            return None
+        return MgTileCache()
+
+    if tile_cache == 0:
+        return None
+    return MgTileCache(tile_cache * 1024 ** 2)
+
+
+def isServing(parsed_input):
+    '''True if decks are served rather than created from input files.'''
+    return (
+        parsed_input[ARG_CONST['serve']] is not None or
+        parsed_input[ARG_CONST['socket']] is not None
+    )
+
+
+def createRouter(parsed_input):
+    '''Creates the MgSourceRouter of the image mirrors or returns None.
+
+    BASE_URL is always the last source.
+    '''
+    mirrors = parsed_input[ARG_CONST['mirror']]
+    if not mirrors:
+        return None
+
+    sources = [createSource(mirror) for mirror in mirrors]
+    sources.append(MgHttpSource(BASE_URL))
+    return MgSourceRouter(sources)
+
+
+def createMemoryBudget(parsed_input):
+    '''Returns the memory budget in bytes, None if none was requested.'''
+    memory_budget = parsed_input[ARG_CONST['memory_budget']]
+    if memory_budget is None:
+        return None
+
+    return memory_budget * 1024 ** 2
+
+
+def createEncoder(parsed_input):
+    '''Creates the MgPageEncoder requested by the user.
+
+    Raises MgImageException if the encoder is not supported by Pillow.
+    '''
+    name = parsed_input[ARG_CONST['encoder']]
+    if name == 'jpeg':
+        options = {
+            'quality': parsed_input[ARG_CONST['quality']],
+            'optimize': parsed_input[ARG_CONST['optimize']],
+            'progressive': parsed_input[ARG_CONST['progressive']],
+            'subsampling': parsed_input[ARG_CONST['subsampling']]
+        }
+    elif name == 'png':
+        options = {
+            'compress_level': parsed_input[ARG_CONST['compress_level']],
+            'optimize': parsed_input[ARG_CONST['optimize']]
+        }
+    else:
+        options = {
+            'quality': parsed_input[ARG_CONST['quality']],
+            'method': parsed_input[ARG_CONST['webp_method']]
+        }
+
+    return PAGE_ENCODER_CLASSES[name](**options)
+
+
+def logEncodes(encoder, reporter):
+    '''Logs the encode time and size of every page and their totals.
+
+    Pages reusing an identical page have not been encoded.
+    '''
+    encodes = reporter.encodes
+    for encode in encodes:
+        logger.info(MG_LOGGER_CONST['encode_page'] % encode)
+
+    logger.info(MG_LOGGER_CONST['encode_msg'] % (
+        encoder.describe(), len(encodes),
+        sum(seconds for _, seconds, _ in encodes),
+        sum(size for _, _, size in encodes)
+    ))
+    logger.info(MG_LOGGER_CONST['reuse_msg'] % reporter.reused_pages)
+
+
 def getFileNamePath(file_path, parsed_args=None):
     '''Returns a tupple containing the file path and file name.
 
@@ -95,36 +292,270 @@ def getFileNamePath(file_path, parsed_args=None):
     return (directory, file_name)
 
 
+def findDecks(paths):
+    '''Returns the deck files among the given files and directories.
+
+    Directories are not searched recursively. Only their files with one of
+    the DECK_EXTENSIONS are decks, sorted by name.
+    '''
+    decks = []
+    for path in paths:
+        if not os.path.isdir(path):
+            decks.append(path)
+            continue
+
+        with os.scandir(path) as entries:
+            decks.extend(sorted(
+                entry.path for entry in entries
+                if entry.is_file() and
+                os.path.splitext(entry.name)[1].lower() in DECK_EXTENSIONS
+            ))
+
+    return decks
+
+
+def readDecks(deck_paths, parsed_input, invalid):
+    '''Yields the (cards, directory, file_name) of each deck that opens.
+
+    The cards are a generator parsing the deck as it is read, so it must be
+    exhausted before the next deck is requested. The path and MgDeckParser
+    of each yielded deck are appended to invalid. Decks that cannot be
+    opened are logged and skipped. A path of STDIN_DECK reads the deck from
+    stdin. With --fuzzy, misspelt names of web cards are corrected.
+    '''
+    for full_path in deck_paths:
+        if full_path == STDIN_DECK:
+            # stdin is left open, as it is not ours to close
+            name_path = STDIN_NAME
+            deck_file = contextlib.nullcontext(sys.stdin)
+        else:
+            name_path = full_path
+            try:
+                deck_file = open(full_path, 'r')
+            except IOError:
+                logger.critical(MG_LOGGER_CONST['bad_input'] % full_path)
+                continue
+
+        with deck_file as f:
+            file_path, file_name = getFileNamePath(name_path, parsed_input)
+            logger.info(MG_LOGGER_CONST['save_loc'] % file_path)
+
+            parser = MgDeckParser()
+            cards = parser.parse(f)
+            threshold = parsed_input[ARG_CONST['fuzzy']]
+            if threshold is not None and not parsed_input[ARG_CONST['local']]:
+                cards = correctNames(cards, threshold)
+
+            invalid.append((full_path, parser))
+            yield (cards, file_path, file_name)
+
+
+def logReport(creator, reporter, invalid_lines, parsed_input):
+    '''Logs the report of a deck.'''
+    if creator.cache is not None:
+        logger.info(
+            MG_LOGGER_CONST['cache_msg'] %
+            (reporter.cache_hits, reporter.cache_misses)
+        )
+
+    if creator.memory_budget is not None:
+        logger.info(
+            MG_LOGGER_CONST['memory_msg'] %
+            (reporter.queued_peak, reporter.queued_average)
+        )
+
+    if parsed_input[ARG_CONST['verbose']]:
+        logEncodes(creator.encoder, reporter)
+
+    if parsed_input[ARG_CONST['incremental']]:
+        logger.info(MG_LOGGER_CONST['incremental_msg'] % (
+            reporter.pages, reporter.pages + reporter.unchanged_pages
+        ))
+
+    errors = invalid_lines + reporter.errors
+    logger.info(
+        MG_LOGGER_CONST['final_msg'] %
+        (reporter.cards, reporter.pages, errors)
+    )
+
+
 def createFromWebOrLocal(parsed_input):
-    '''Takes parsed input from arg_parser and shunts it to function'''
+    '''Takes parsed input from arg_parser and shunts it to function
+
+    Several input files are created as a batch sharing the image getters
+    and cache, followed by the throughput of the whole batch.
+    '''
     logger.info(MG_LOGGER_CONST['start_prog'])
 
-    full_path = parsed_input[ARG_CONST['input_file']]
+    deck_paths = findDecks(parsed_input[ARG_CONST['input_file']])
     try:
-        with open(full_path, 'r') as f:
-            file_path, file_name = getFileNamePath(full_path, parsed_input)
-            logger.info(MG_LOGGER_CONST['save_loc'] % file_path)
+        creator = createMgInstance(parsed_input)
+    except MgException as e:
+        logger.critical(str(e))
+        return
+
+    start = time.monotonic()
+    invalid = []
+    totals = [0, 0, 0]  # Cards, pages and errors of all decks
+    local = parsed_input[ARG_CONST['local']]
+    decks = readDecks(deck_paths, parsed_input, invalid)
+    if parsed_input[ARG_CONST['incremental']]:
+        reporters = (
+            creator.createIncremental(local, *deck) for deck in decks
+        )
+    else:
+        reporters = creator.createBatch(local, decks)
+    # Decks are read as they are created, so invalid grows with reporters
+    for index, reporter in enumerate(reporters):
+        full_path, parser = invalid[index]
+        invalid_lines = parser.invalid_lines
+        if len(deck_paths) > 1:
+            logger.info(MG_LOGGER_CONST['deck_msg'] % full_path)
+        logReport(creator, reporter, invalid_lines, parsed_input)
+
+        totals[0] += reporter.cards
+        totals[1] += reporter.pages
+        totals[2] += invalid_lines + reporter.errors
+
+    if parsed_input[ARG_CONST['verbose']]:
+        logger.info(MG_LOGGER_CONST['fetch_msg'] % (
+            creator.policy.retried, creator.policy.hedged_requests
+        ))
+
+    if len(deck_paths) > 1:
+        elapsed = max(time.monotonic() - start, 1e-6)
+        logger.info(MG_LOGGER_CONST['batch_msg'] % (
+            len(invalid), totals[0], totals[1], totals[2], elapsed,
+            totals[0] / elapsed, totals[1] / elapsed
+        ))
+
+
+def drawPacks(parsed_input):
+    '''Returns the booster packs of every set, as (set, card names) tupples.
+
+    Sets that cannot be downloaded are logged and skipped.
+    '''
+    set_cache = MgSetCache(parsed_input[ARG_CONST['set_cache']])
+    seed = parsed_input[ARG_CONST['seed']]
+    packs = []
+    for set_code in parsed_input[ARG_CONST['booster']]:
+        try:
+            set_dict = set_cache.get(set_code)
+        except MgException as e:
+            logger.critical(str(e))
+            continue
+
+        # Every set gets its own sequence of packs from the seed
+        sampler = MgBoosterSampler(
+            parseLocalSetForRarity(set_dict), boosterSlots(set_dict),
+            None if seed is None else '%s:%s' % (seed, set_code)
+        )
+        packs.extend(
+            (set_code, card_names) for card_names in
+            sampler.sample(parsed_input[ARG_CONST['packs']])
+        )
 
-            user_input, invalid_lines = parseFile(f)
+    return packs
 
-            creator = createMgInstance(parsed_input)
 
-            if parsed_input[ARG_CONST['local']]:
-                reporter = creator.createFromLocal(
-                    user_input, file_path, file_name
-                )
-            else:
-                reporter = creator.createFromWeb(
-                    user_input, file_path, file_name
-                )
+def writePackList(packs, file_path, per_page):
+    '''Saves the cards of every pack as a deck, noting the pages it is on.
 
-            errors = invalid_lines + reporter.errors
-            logger.info(
-                MG_LOGGER_CONST['final_msg'] %
-                (reporter.cards, reporter.pages, errors)
-            )
-    except IOError:
-        logger.critical(MG_LOGGER_CONST['bad_input'] % full_path)
+    Raises IOError if the file cannot be written.
+    '''
+    slot_number = 0
+    with open(file_path, 'w') as f:
+        for number, (set_code, card_names) in enumerate(packs):
+            first_page = slot_number // per_page
+            slot_number += len(card_names)
+            f.write('// Pack %d [%s], pages %d-%d\n' % (
+                number + 1, set_code, first_page, (slot_number - 1) // per_page
+            ))
+            for card_name in card_names:
+                f.write('1 [%s] %s\n' % (set_code, card_name))
+
+
+def createBoosters(parsed_input):
+    '''Creates the pages of booster packs of the sets given by --booster.
+
+    The cards of every pack are listed in a file next to the pages.
+    '''
+    logger.info(MG_LOGGER_CONST['start_prog'])
+
+    try:
+        creator = createMgInstance(parsed_input)
+    except MgException as e:
+        logger.critical(str(e))
+        return
+
+    packs = drawPacks(parsed_input)
+    directory, file_name = getFileNamePath(BOOSTER_NAME, parsed_input)
+    logger.info(MG_LOGGER_CONST['save_loc'] % directory)
+
+    list_path = os.path.join(directory, file_name + PACK_LIST_EXT)
+    try:
+        writePackList(packs, list_path, creator.xy[0] * creator.xy[1])
+    except IOError as e:
+        logger.error(MG_LOGGER_CONST['save_fail'] % (
+            list_path, e.strerror or e
+        ))
+    logger.info(MG_LOGGER_CONST['booster_msg'] % (
+        len(packs), ', '.join(parsed_input[ARG_CONST['booster']]), list_path
+    ))
+
+    reporter = creator.createPacks(
+        parsed_input[ARG_CONST['local']], packs, directory, file_name
+    )
+    logReport(creator, reporter, 0, parsed_input)
+
+
+def serve(parsed_input):
+    '''Creates the decks POSTed to the server until interrupted.
+
+    The card index, image getters and caches are set up once, before the
+    first deck arrives. Pages are created in a directory of their own under
+    the -p directory (by default the working directory), which is removed
+    once they have been answered.
+    '''
+    try:
+        creator = createMgInstance(parsed_input)
+    except MgException as e:
+        logger.critical(str(e))
+        return
+
+    # Builds the index if needed, so the first deck does not have to
+    CARD_INDEX.ensureBuilt()
+
+    directory = os.path.abspath(parsed_input[ARG_CONST['opt_path']] or '.')
+    service = MgRenderService(creator, directory, parseFile, logger)
+    socket_path = parsed_input[ARG_CONST['socket']]
+    try:
+        server = createServer(
+            service, parsed_input[ARG_CONST['serve']], socket_path
+        )
+    except OSError as e:
+        logger.critical(str(e))
+        return
+
+    if socket_path is None:
+        location = 'http://%s:%d' % server.server_address[:2]
+    else:
+        location = 'unix:' + socket_path
+
+    # Stopping the server as a daemon cleans up just like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    creator.start()
+    try:
+        logger.info(MG_LOGGER_CONST['serve_msg'] % location)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        creator.close()
+        if socket_path is not None:
+            os.remove(socket_path)
 
 
 def main(args=None):
@@ -136,4 +567,35 @@ def main(args=None):
 
     # If there are errors or if -h tag is used, program stops at this line
     parsed_input = vars(arg_parser.parse_args(args))
+
+    # A single pdf file cannot be partially created again
+    if (parsed_input[ARG_CONST['output']] == 'pdf' and
+            parsed_input[ARG_CONST['incremental']]):
+        arg_parser.error('incremental creation requires jpg output')
+
+    # Pages are embedded in pdf files as they have been encoded
+    if (parsed_input[ARG_CONST['output']] == 'pdf' and
+            parsed_input[ARG_CONST['encoder']] != PAGE_ENCODERS[0]):
+        arg_parser.error(
+            'pdf output requires the %s encoder' % PAGE_ENCODERS[0]
+        )
+
+    if isServing(parsed_input):
+        serve(parsed_input)
+        return
+
+    if parsed_input[ARG_CONST['booster']]:
+        createBoosters(parsed_input)
+        return
+
+    if not parsed_input[ARG_CONST['input_file']]:
+        arg_parser.error(
+            'an input file is required, unless serving decks or boosters'
+        )
+
+    # Every deck of a batch would be saved with the same file name
+    if (parsed_input[ARG_CONST['alt_name']] is not None and
+            len(findDecks(parsed_input[ARG_CONST['input_file']])) > 1):
+        arg_parser.error('-f requires a single input file')
+
     createFromWebOrLocal(parsed_input)
@@ -1,15 +1,32 @@
 '''This module houses code that will drive the thread based part of MgProxy'''
 
-from threading import Lock, Thread
+from threading import Lock, Thread, Event
+from collections import Counter, OrderedDict, deque
+from queue import Queue
+import asyncio
 import os
-
-from src.get_image import getMgImage, getLocalMgImage
+import time
+import shutil
+from concurrent.futures.process import BrokenProcessPool
+
+from src.get_image import (getMgImage, getMgImageData, getLocalMgImage,
+                           createLocalAddress)
+from src.tile_pool import MgPendingTile
+from src.image_cache import MgTileCache
+from src.page_encoder import MgJpegEncoder
 from src.constants import (
-    MgNetworkException, MgImageException, MgLookupException
+    MgNetworkException, MgImageException, MgLookupException, RESIZE_TIERS
 )
 from src.logger_dict import MG_LOGGER_CONST, logCardName
 from src.image_manip import createCanvas, pasteImage, resizeImage
 
+# The exceptions that cause a single card to be skipped by the getter threads
+FETCH_ERRORS = (MgNetworkException, MgImageException, MgLookupException)
+
+# The exceptions that cause a single page to be skipped by the save threads.
+# Pillow encoders raise ValueError for settings they do not support.
+SAVE_ERRORS = (OSError, ValueError, MgImageException)
+
 
 class MgQueueCar(object):
 
@@ -30,6 +47,24 @@ class MgQueueCar(object):
         # How many cards are on the image to be saved
         self.card_number = None
 
+        # The position of the page to be saved, counting from 0
+        self.page_number = None
+
+        # The number of an earlier, identical page (see MgPageStore)
+        self.duplicate_of = None
+
+        # The bytes charged to a memory budget (see MgBudgetQueue)
+        self.queued_bytes = 0
+
+        # The deck of the card, if several decks share threads (see MgJob)
+        self.job = None
+
+        # The key the resized image is cached under (see MgTileCache)
+        self.tile_key = None
+
+        # The (page number, slot) the image is pasted at, if pages are planned
+        self.slots = None
+
 
 class MgReport(object):
 
@@ -45,6 +80,15 @@ class MgReport(object):
         self._pages = 0  # Number of pages successfully pasted
         self._cards = 0  # Number of cards successfully pasted
         self._errors = 0  # The number of errors encountered by program
+        self._cache_hits = 0  # Images found in the image cache
+        self._cache_misses = 0  # Images not found in the image cache
+        self._encodes = []  # Page number, encode time and bytes of each page
+        self._reused_pages = 0  # Pages saved from an identical page
+        self._queued_peak = 0  # Most bytes held by the queues at any time
+        self._queued_average = 0  # Bytes held by the queues on average
+        self._incomplete_pages = []  # Planned pages saved with empty slots
+        self._saved_pages = []  # Numbers of the pages saved successfully
+        self._unchanged_pages = 0  # Pages kept from an earlier run
 
     def addPage(self):
         '''Adds a page and returns the page count before addition'''
@@ -61,6 +105,41 @@ class MgReport(object):
         with self._lock:
             self._errors += 1
 
+    def addCacheHit(self):
+        with self._lock:
+            self._cache_hits += 1
+
+    def addCacheMiss(self):
+        with self._lock:
+            self._cache_misses += 1
+
+    def addReusedPage(self):
+        with self._lock:
+            self._reused_pages += 1
+
+    def addIncompletePage(self, page_number):
+        with self._lock:
+            self._incomplete_pages.append(page_number)
+
+    def addSavedPage(self, page_number):
+        with self._lock:
+            self._saved_pages.append(page_number)
+
+    def setUnchangedPages(self, pages):
+        with self._lock:
+            self._unchanged_pages = pages
+
+    def setQueuedBytes(self, peak, average):
+        '''Sets the peak and average bytes held by the queues'''
+        with self._lock:
+            self._queued_peak = peak
+            self._queued_average = average
+
+    def addEncode(self, page_number, seconds, size):
+        '''Adds the time taken to encode a page and its size in bytes'''
+        with self._lock:
+            self._encodes.append((page_number, seconds, size))
+
     @property
     def pages(self):
         with self._lock:
@@ -76,6 +155,351 @@ class MgReport(object):
         with self._lock:
             return self._errors
 
+    @property
+    def cache_hits(self):
+        with self._lock:
+            return self._cache_hits
+
+    @property
+    def cache_misses(self):
+        with self._lock:
+            return self._cache_misses
+
+    @property
+    def reused_pages(self):
+        with self._lock:
+            return self._reused_pages
+
+    @property
+    def queued_peak(self):
+        with self._lock:
+            return self._queued_peak
+
+    @property
+    def queued_average(self):
+        with self._lock:
+            return self._queued_average
+
+    @property
+    def incomplete_pages(self):
+        '''The numbers of the planned pages saved with empty slots'''
+        with self._lock:
+            return sorted(self._incomplete_pages)
+
+    @property
+    def saved_pages(self):
+        '''The numbers of the pages saved successfully'''
+        with self._lock:
+            return sorted(self._saved_pages)
+
+    @property
+    def unchanged_pages(self):
+        with self._lock:
+            return self._unchanged_pages
+
+    @property
+    def encodes(self):
+        '''The (page number, seconds, bytes) of every page, in page order'''
+        with self._lock:
+            return sorted(self._encodes)
+
+
+class MgFetchCoalescer(object):
+
+    '''Shares a single fetch between all queue cars requesting the same card.
+
+    Every card that will be fetched is registered before it is put on the
+    In-Queue. The first thread to fetch a (name, set) pair does the work,
+    while any other thread asking for the same pair waits for the result.
+    Each car receives its own copy of the image, as images are closed once
+    they have been pasted. The last car to be served receives the original,
+    at which point the result is dropped to release memory.
+
+    If dpi and wh are given, an image that more cars are waiting for is
+    resized (see resizeImage) before it is kept, rather than keeping the
+    decoded scan until the last car has been served. Pending tiles are
+    already resized.
+    '''
+
+    def __init__(self, dpi=None, wh=None, resize=RESIZE_TIERS[0]):
+        self.dpi = dpi
+        self.wh = wh
+        self.resize = resize
+        self._lock = Lock()
+        self._demand = Counter()  # Registered cars not yet served, by key
+        self._entries = {}  # Fetches in flight or waiting to be served
+
+    @staticmethod
+    def key(card_tupple):
+        '''The (name, set) pair identifying identical card requests.'''
+        return (card_tupple[3], card_tupple[2])
+
+    def register(self, card_tupple):
+        '''Announces that the card will be requested by a queue car.'''
+        with self._lock:
+            self._demand[self.key(card_tupple)] += 1
+
+    def fetch(self, card_tupple, fetch_func):
+        '''Returns the result of fetch_func, shared between identical cards.
+
+        Exceptions raised by fetch_func are raised for every car sharing
+        the fetch, so that each of them can be logged.
+        '''
+        key = self.key(card_tupple)
+        entry, owner = self.claim(key)
+
+        if owner:
+            try:
+                entry.result = self.shrink(key, fetch_func())
+            except Exception as e:
+                entry.error = e
+            finally:
+                self.finish(entry)
+        else:
+            entry.done.wait()
+
+        return self.serve(key, entry)
+
+    async def fetchAsync(self, card_tupple, fetch_coro):
+        '''The asyncio version of fetch. fetch_coro returns an awaitable.
+
+        Waiting for an identical fetch does not block the event loop, the
+        image is resized in the default executor of the loop.
+        '''
+        key = self.key(card_tupple)
+        entry, owner = self.claim(key)
+
+        if owner:
+            try:
+                result = await fetch_coro()
+                entry.result = await asyncio.get_running_loop(
+                ).run_in_executor(None, self.shrink, key, result)
+            except Exception as e:
+                entry.error = e
+            finally:
+                self.finish(entry)
+        else:
+            loop = asyncio.get_running_loop()
+            waiter = loop.create_future()
+            with self._lock:
+                if entry.done.is_set():
+                    waiter.set_result(None)
+                else:
+                    entry.waiters.append((loop, waiter))
+            await waiter
+
+        return self.serve(key, entry)
+
+    def claim(self, key):
+        '''Returns the entry for key and whether the caller has to fetch it.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                return entry, False
+
+            entry = _MgFetchEntry()
+            self._entries[key] = entry
+            return entry, True
+
+    def shrink(self, key, image):
+        '''Returns the image to keep for the other cars requesting key.
+
+        The image is resized and closed if other cars are registered for
+        key and the coalescer has a dpi. Otherwise it is returned as is.
+        '''
+        with self._lock:
+            shared = self._demand[key] > 1
+        if not shared or self.dpi is None or isinstance(image, MgPendingTile):
+            return image
+
+        try:
+            return resizeImage(image, self.dpi, self.wh, self.resize)
+        finally:
+            image.close()
+
+    def finish(self, entry):
+        '''Wakes up everyone waiting for the entry.'''
+        with self._lock:
+            entry.done.set()
+            for loop, waiter in entry.waiters:
+                loop.call_soon_threadsafe(waiter.set_result, None)
+
+    def serve(self, key, entry):
+        '''Hands the result of a finished entry to one queue car.
+
+        Every car raises an exception of its own, chained to the one raised
+        by the fetch, as raising the same object in several threads would
+        mix up their tracebacks.
+        '''
+        with self._lock:
+            self._demand[key] -= 1
+            last = self._demand[key] <= 0
+            if last:
+                del self._demand[key]
+                self._entries.pop(key, None)
+
+            if entry.error is None:
+                # Copying under the lock guarantees that the original is not
+                # handed out (and closed) while it is still being copied
+                return entry.result if last else entry.result.copy()
+
+        error = entry.error
+        fresh = type(error)(*error.args)
+        fresh.__dict__.update(error.__dict__)
+        raise fresh from error
+
+
+class _MgFetchEntry(object):
+
+    '''The result of a fetch shared by MgFetchCoalescer.'''
+
+    def __init__(self):
+        self.done = Event()
+        self.waiters = []  # (loop, future) pairs of asyncio waiters
+        self.result = None
+        self.error = None
+
+
+class MgPageStore(object):
+
+    '''Shares saved pages with identical pages saved later.
+
+    The page thread registers every page that is not identical to an earlier
+    one. Once it has been saved, its location is stored, and identical pages
+    reuse it instead of being encoded again. As pages are saved by several
+    threads, an identical page might have to wait for the original.
+    '''
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pages = {}  # Page number (key) and _MgSavedPage (value)
+
+    def register(self, page_number):
+        '''Announces a page that identical pages might reuse.'''
+        with self._lock:
+            self._pages[page_number] = _MgSavedPage()
+
+    def finish(self, page_number, location):
+        '''Stores where the page has been saved, None if saving failed.'''
+        with self._lock:
+            page = self._pages.get(page_number)
+
+        if page is not None:
+            page.location = location
+            page.done.set()
+
+    def wait(self, page_number):
+        '''Waits for a registered page to be saved and returns its location.'''
+        with self._lock:
+            page = self._pages[page_number]
+
+        page.done.wait()
+        return page.location
+
+
+class _MgSavedPage(object):
+
+    '''A page registered with MgPageStore.'''
+
+    def __init__(self):
+        self.done = Event()
+        self.location = None
+
+
+class MgJob(object):
+
+    '''The deck a card belongs to, when several decks share fetch threads.
+
+    Holds the Out-Queue, MgReport, local image directory (an empty string for
+    web images) and MgFetchCoalescer of the deck. If the job is counted, every
+    card of the deck is added with addCar as it is queued, and closeCars is
+    called once all have been. The stop signal is then put on the Out-Queue as
+    soon as every card has been fetched (or has failed to be), which ends the
+    page thread of the deck while the fetch threads go on with the next deck.
+    The cards of a deck can thus be queued while they are still being read.
+    '''
+
+    def __init__(
+        self, out_queue, reporter, local, coalescer=None, counted=False
+    ):
+        self.out_queue = out_queue
+        self.reporter = reporter
+        self.local = local
+        self.coalescer = coalescer
+
+        self._lock = Lock()
+        self._remaining = 0 if counted else None
+        self._closed = False
+
+    def addCar(self):
+        '''Counts a card of the deck as queued.'''
+        if self._remaining is None:
+            return
+
+        with self._lock:
+            self._remaining += 1
+
+    def closeCars(self):
+        '''Marks all cards of the deck as queued.'''
+        if self._remaining is None:
+            return
+
+        with self._lock:
+            self._closed = True
+            done = self._remaining == 0
+
+        if done:
+            self.out_queue.put(MgQueueCar())
+
+    def finishCar(self):
+        '''Counts a card of the deck as done.'''
+        if self._remaining is None:
+            return
+
+        with self._lock:
+            self._remaining -= 1
+            done = self._closed and self._remaining == 0
+
+        if done:
+            self.out_queue.put(MgQueueCar())
+
+
+class MgFairQueue(Queue):
+
+    '''A Queue taking turns between the MgJobs of its queue cars.
+
+    Cars are handed out round robin by job, so a large deck cannot hold up
+    the decks queued after it. Stop signals are only handed out once no
+    other cars are left.
+    '''
+
+    def _init(self, maxsize):
+        self._jobs = OrderedDict()  # Job (key) and its cars (value)
+        self._stops = deque()
+        self._count = 0
+
+    def _qsize(self):
+        return self._count
+
+    def _put(self, item):
+        if item.end_thread:
+            self._stops.append(item)
+        else:
+            self._jobs.setdefault(item.job, deque()).append(item)
+        self._count += 1
+
+    def _get(self):
+        self._count -= 1
+        if not self._jobs:
+            return self._stops.popleft()
+
+        # The job served moves to the back of the line
+        job, cars = self._jobs.popitem(last=False)
+        item = cars.popleft()
+        if cars:
+            self._jobs[job] = cars
+        return item
+
 
 class MgGetImageThread(Thread):
 
@@ -85,11 +509,25 @@ class MgGetImageThread(Thread):
     downloads the image and passes it off to the Out-Queue. In addition,
     optional thread-safe logging and report objects can be passed to init.
     By default, gets the images from the web. Provide directory of local images
-    to get images from local folder.
+    to get images from local folder. Web images are looked up in the optional
+    MgImageCache before they are downloaded. An optional MgFetchCoalescer
+    makes sure each distinct card is only fetched and decoded once. If an
+    MgTilePool is provided, images are not decoded by this thread. Instead,
+    an MgPendingTile is passed on. Otherwise, images are decoded at reduced
+    resolution if they are larger than the optional tile_size. The optional
+    MgCardSelector chooses which printing of a card is downloaded, the
+    optional MgFetchPolicy how often and how long downloads are tried, and
+    the optional MgSourceRouter which image mirror they are downloaded from.
+    Cars carrying an MgJob are passed on to the Out-Queue of their job, and
+    use its local directory, reporter and coalescer instead. If an
+    MgTileCache is provided, images cached in it are neither fetched nor
+    decoded, and other images are marked to be cached by the page thread.
     '''
 
     def __init__(
-        self, in_queue, out_queue, local, reporter, logger=None
+        self, in_queue, out_queue, local, reporter, logger=None, cache=None,
+        coalescer=None, tile_pool=None, tile_size=None, selector=None,
+        policy=None, router=None, tiles=None
     ):
         # Call init of Thread before doing anything else
         super(MgGetImageThread, self).__init__()
@@ -99,6 +537,17 @@ class MgGetImageThread(Thread):
         self.local = local
         self.logger = logger
         self.reporter = reporter
+        self.cache = cache
+        self.coalescer = coalescer
+        self.tile_pool = tile_pool
+        self.tile_size = tile_size
+        self.selector = selector
+        self.policy = policy
+        self.router = router
+        self.tiles = tiles
+
+        # Used for cars that do not carry a job
+        self.job = MgJob(out_queue, reporter, local, coalescer)
 
     def run(self):
         '''The main loop of the MgGetImageThread.
@@ -112,57 +561,122 @@ class MgGetImageThread(Thread):
                 self.in_queue.task_done()
                 break
 
-            if self.local:
-                self.getImageFromDisk(self.local, queue_car)
+            job = queue_car.job or self.job
+            if self.tiles is not None:
+                queue_car.tile_key = MgTileCache.key(
+                    job.local, queue_car.input_tupple
+                )
+
+            if job.local:
+                self.getImageFromDisk(job.local, queue_car)
             else:
                 self.getMgImageFromWeb(queue_car)
 
+            job.finishCar()
             self.in_queue.task_done()
 
     def getMgImageFromWeb(self, queue_car):
         '''Download the image from the web and puts it in Out-Queue.'''
+        job = queue_car.job or self.job
         card_tupple = queue_car.input_tupple
         card_name = card_tupple[3]
         set_name = card_tupple[2]
 
-        try:
-            image = getMgImage(card_name, set_name)
-        except MgNetworkException as reason:
-            self.logError(
-                MG_LOGGER_CONST['card_error'] % (
-                    # logCardName expects a tupple of card info
-                    logCardName(card_tupple),
-                    reason
+        if self.tile_pool is None:
+            def fetch_func():
+                return getMgImage(
+                    card_name, set_name, self.cache, job.reporter,
+                    self.tile_size, self.selector, self.policy, self.router
                 )
+        else:
+            def fetch_func():
+                return self.tile_pool.submit(getMgImageData(
+                    card_name, set_name, self.cache, job.reporter,
+                    self.selector, self.policy, self.router
+                ))
+
+        try:
+            image = self.fetch(
+                card_tupple, fetch_func, job, queue_car.tile_key
             )
-        except MgImageException as reason:
-            self.logError(MG_LOGGER_CONST['image_file_error'] % (
-                logCardName(card_tupple),
-                reason
-            ))
-        except MgLookupException as reason:
-            self.logError(str(reason) + ': ' + logCardName(card_tupple))
+        except FETCH_ERRORS as reason:
+            self.logFetchError(card_tupple, reason, job.reporter)
         else:
             queue_car.image = image
-            self.out_queue.put(queue_car)
+            job.out_queue.put(queue_car)
 
     def getImageFromDisk(self, directory, queue_car):
         '''Get image from local disk and put it in the Out-Queue.'''
+        job = queue_car.job or self.job
         card_tupple = queue_car.input_tupple
         card_name = card_tupple[3]
+        set_name = card_tupple[2]
+
+        if self.tile_pool is None:
+            def fetch_func():
+                return getLocalMgImage(
+                    directory, card_name, self.tile_size, set_name
+                )
+        else:
+            def fetch_func():
+                return self.tile_pool.submit(
+                    createLocalAddress(directory, card_name, set_name)
+                )
 
         try:
-            image = getLocalMgImage(directory, card_name)
+            image = self.fetch(
+                card_tupple, fetch_func, job, queue_car.tile_key
+            )
         except MgImageException as reason:
+            self.logFetchError(card_tupple, reason, job.reporter)
+        else:
+            queue_car.image = image
+            job.out_queue.put(queue_car)
+
+    def fetch(self, card_tupple, fetch_func, job, tile_key=None):
+        '''Calls fetch_func through the coalescer of the job, if it has one.
+
+        The tile cached under tile_key is returned instead, if there is one.
+        '''
+        def tile_func():
+            tile = self.cachedTile(tile_key)
+            return fetch_func() if tile is None else tile
+
+        if job.coalescer is None:
+            return tile_func()
+
+        return job.coalescer.fetch(card_tupple, tile_func)
+
+    def cachedTile(self, tile_key):
+        '''Returns the tile of tile_key from the MgTileCache, or None.'''
+        if self.tiles is None or tile_key is None:
+            return None
+
+        return self.tiles.get(tile_key)
+
+    def logFetchError(self, card_tupple, reason, reporter=None):
+        '''Logs why the image of a card could not be fetched.
+
+        The error is counted in the given reporter, by default the reporter
+        of the thread.
+        '''
+        if isinstance(reason, MgNetworkException):
+            self.logError(MG_LOGGER_CONST['card_error'] % (
+                # logCardName expects a tupple of card info
+                logCardName(card_tupple),
+                reason
+            ), reporter)
+        elif isinstance(reason, MgImageException):
             self.logError(MG_LOGGER_CONST['image_file_error'] % (
                 logCardName(card_tupple),
                 reason
-            ))
+            ), reporter)
         else:
-            queue_car.image = image
-            self.out_queue(queue_car)
+            self.logError(
+                str(reason) + ': ' + logCardName(card_tupple), reporter
+            )
 
-    def logError(self, message):
+    def logError(self, message, reporter=None):
         '''Logs an error message if a logger has been provided.
 
         Also counts up the error in the reporter.
@@ -170,8 +684,9 @@ class MgGetImageThread(Thread):
         if self.logger:
             self.logger.error(message)
 
-        if self.reporter:
-            self.reporter.addError()
+        reporter = reporter or self.reporter
+        if reporter:
+            reporter.addError()
 
 
 class MgImageCreateThread(Thread):
@@ -181,10 +696,25 @@ class MgImageCreateThread(Thread):
     As the operations are CPU bound, only one thread of this class should be
     used. It has been written with that limitation in mind. It spawns threads
     to save the pages as that is the limiting I/O step in the process.
+    Images decoded and resized by an MgTilePool (MgPendingTile) are only
+    pasted by this thread. If an MgPageStore is provided, pages holding the
+    same cards in the same places as an earlier page are marked as its
+    duplicates, so that the earlier page can be reused when saving. Images
+    are only pasted once their page is complete, so duplicates of an earlier
+    page are never pasted at all. Resized
+    images of cars with a tile_key are stored in the optional MgTileCache.
+
+    Pages can be planned instead, for cars with slots: plan maps the number
+    of every planned page to the sources of its slots. Each image is pasted
+    into its slots, and a planned page is saved as soon as all its slots
+    are filled. Pages with slots left empty are saved at the end.
+
+    Images are resized with the given resize tier (see resizeImage).
     '''
 
     def __init__(
-        self, in_queue, out_queue, dpi, wh, xy, reporter, logger=None
+        self, in_queue, out_queue, dpi, wh, xy, reporter, logger=None,
+        page_store=None, tiles=None, plan=None, resize=RESIZE_TIERS[0]
     ):
         super(MgImageCreateThread, self).__init__()
         self.in_queue = in_queue
@@ -194,7 +724,15 @@ class MgImageCreateThread(Thread):
         self.xy = xy
 
         self.pic_count = 0  # How many pictures on the current page
-        self.current_canvas = createCanvas(dpi, wh, xy)
+        self.page_count = 0  # How many pages have been put on the Out-Queue
+        self.page_images = []  # The pictures waiting to be pasted on the page
+        self.page_sources = []  # The card of every picture on the page
+        self.page_signatures = {}  # Page sources (key) and first page (value)
+        self.page_store = page_store
+        self.tiles = tiles
+        self.plan = plan
+        self.planned = {}  # Page number (key) and canvas and filled slots
+        self.resize = resize
 
         self.logger = logger
         self.reporter = reporter
@@ -209,22 +747,31 @@ class MgImageCreateThread(Thread):
             queue_car = self.in_queue.get()
             if queue_car.end_thread:
                 if self.pic_count > 0:
-                    # Stop signals should not be passed down the queue
-                    queue_car.end_thread = False
-                    self.save(queue_car, self.current_canvas)
+                    self.save(queue_car)
+                self.saveIncomplete(queue_car)
 
                 self.in_queue.task_done()
                 break
 
-            resized_image = resizeImage(queue_car.image, self.dpi, self.wh)
+            card_tupple = queue_car.input_tupple
 
-            # Explicitly close original image to release memory
-            queue_car.image.close()
-            queue_car.image = resized_image
+            try:
+                queue_car.image = self.prepareImage(queue_car.image)
+            except (MgImageException, BrokenProcessPool) as reason:
+                self.logError(MG_LOGGER_CONST['image_file_error'] % (
+                    logCardName(card_tupple),
+                    reason
+                ))
+                self.in_queue.task_done()
+                continue
 
-            card_tupple = queue_car.input_tupple
+            if self.tiles is not None and queue_car.tile_key is not None:
+                self.tiles.put(queue_car.tile_key, queue_car.image)
 
-            self.pasteMulti(queue_car)
+            if queue_car.slots is None:
+                self.pasteMulti(queue_car)
+            else:
+                self.pastePlanned(queue_car)
             log_msg = logCardName(card_tupple)
             self.logInfo(
                 MG_LOGGER_CONST['good_paste'] % (card_tupple[1], log_msg)
@@ -232,13 +779,28 @@ class MgImageCreateThread(Thread):
 
             self.in_queue.task_done()
 
-    def paste(self, image):
-        '''Pastes the image into the next slot on the canvas.
+    def prepareImage(self, image):
+        '''Returns the image resized for pasting.
+
+        Pending tiles are already resized, but might fail to be decoded.
+        '''
+        if isinstance(image, MgPendingTile):
+            return image.result()
+
+        resized_image = resizeImage(image, self.dpi, self.wh, self.resize)
+
+        # Explicitly close original image to release memory
+        image.close()
+        return resized_image
+
+    def paste(self, image, source):
+        '''Places the image of source into the next slot of the page.
+
+        The image is pasted by save, once the page is complete.
         TODO: This should throw an exception if there are no more free spaces.
-        TODO: Make the xy variable calculation a lot more readable.
         '''
-        xy = (self.pic_count % self.xy[0], self.pic_count//self.xy[0])
-        pasteImage(self.current_canvas, image, xy)
+        self.page_images.append(image)
+        self.page_sources.append(source)
         self.pic_count += 1
 
     def pasteMulti(self, queue_car):
@@ -247,30 +809,133 @@ class MgImageCreateThread(Thread):
         image = queue_car.image
         number = queue_car.input_tupple[1]
 
+        # Identical cards share a fetch, so they share an image as well
+        source = MgFetchCoalescer.key(queue_car.input_tupple)
+
         for _ in range(0, number):
-            self.paste(image)
+            self.paste(image, source)
 
             if self.pic_count == self.xy[0] * self.xy[1]:
-                self.save(queue_car, self.current_canvas)
+                self.save(queue_car, image)
+
+        # Explicitly close image, unless the current page still needs it
+        if not self.page_images or self.page_images[-1] is not image:
+            image.close()
+
+    def pastePlanned(self, queue_car):
+        '''Pastes the image into its slots, saving the pages it completes.'''
+        image = queue_car.image
+
+        for page_number, slot in queue_car.slots:
+            page = self.planned.get(page_number)
+            if page is None:
+                page = [createCanvas(self.dpi, self.wh, self.xy), 0]
+                self.planned[page_number] = page
+
+            xy = (slot % self.xy[0], slot // self.xy[0])
+            pasteImage(page[0], image, xy)
+            page[1] += 1
+
+            # Planned pages can be left incomplete, so they are pasted
+            # before they are compared
+            signature = tuple(self.plan[page_number])
+            if page[1] == len(signature):
+                del self.planned[page_number]
+                self.savePage(
+                    queue_car, page[0], page[1], page_number,
+                    self.originalPage(page_number, signature)
+                )
 
-        # Explicitly close image after it has been pasted
         image.close()
 
-    def save(self, queue_car, canvas):
-        '''Put the newly created canvas on the output Queue.'''
-        queue_car.image = canvas
-        queue_car.card_number = self.pic_count
+    def saveIncomplete(self, queue_car):
+        '''Saves the planned pages that still have empty slots.'''
+        for page_number in sorted(self.planned):
+            canvas, filled = self.planned[page_number]
+            if self.reporter:
+                self.reporter.addIncompletePage(page_number)
+            self.savePage(queue_car, canvas, filled, page_number)
+
+        self.planned = {}
+
+    def save(self, queue_car, keep=None):
+        '''Pastes the current page and puts it on the output Queue.
 
-        self.out_queue.put(queue_car)
+        Every page gets its own car, as the cards of one car can fill several
+        pages. Pages are numbered in the order they are created. A duplicate
+        of an earlier page is put on the queue without a canvas. The images
+        of the page are closed, except for keep.
+        '''
+        original = self.originalPage(
+            self.page_count, tuple(self.page_sources)
+        )
+        canvas = None
+        if original is None:
+            canvas = createCanvas(self.dpi, self.wh, self.xy)
+            for index, image in enumerate(self.page_images):
+                xy = (index % self.xy[0], index // self.xy[0])
+                pasteImage(canvas, image, xy)
+
+        self.savePage(
+            queue_car, canvas, self.pic_count, self.page_count, original
+        )
+        self.page_count += 1
+
+        closed = None
+        for image in self.page_images:
+            if image is not keep and image is not closed:
+                image.close()
+                closed = image
 
-        self.current_canvas = createCanvas(self.dpi, self.wh, self.xy)
         self.pic_count = 0
+        self.page_images = []
+        self.page_sources = []
+
+    def originalPage(self, page_number, signature):
+        '''Returns the number of the earlier page with the signature, or None.
+
+        The signature holds the sources of the slots of the page. A page that
+        is not a duplicate is registered with the MgPageStore, if one is
+        provided. Otherwise pages are never shared.
+        '''
+        if self.page_store is None:
+            return None
+
+        original = self.page_signatures.get(signature)
+        if original is None:
+            self.page_signatures[signature] = page_number
+            self.page_store.register(page_number)
+
+        return original
+
+    def savePage(
+        self, queue_car, canvas, card_number, page_number, duplicate_of=None
+    ):
+        '''Puts a page on the Out-Queue, as a duplicate of an earlier page
+        if its number is given.'''
+        page_car = MgQueueCar(queue_car.input_tupple)
+        # Stop signals should not be passed down the queue
+        page_car.end_thread = False
+        page_car.image = canvas
+        page_car.card_number = card_number
+        page_car.page_number = page_number
+        page_car.duplicate_of = duplicate_of
+
+        self.out_queue.put(page_car)
 
     def logInfo(self, message):
         '''Logs an info message if a logger has been provided'''
         if self.logger:
             self.logger.info(message)
 
+    def logError(self, message):
+        '''Logs an error message and counts it in the reporter'''
+        if self.logger:
+            self.logger.error(message)
+
+        if self.reporter:
+            self.reporter.addError()
+
 
 class MgSaveThread(Thread):
 
@@ -278,15 +943,27 @@ class MgSaveThread(Thread):
 
     Saving is the slowest step in the program, due to the slow I/O nature
     of hard drives. Threading should greatly increase the speed.
+    Pages are encoded by the MgPageEncoder (JPEG by default), and the time
+    and size of every encoding is added to the reporter. If an MgPdfWriter
+    is provided, pages are added to its document instead of being saved as
+    individual files, which requires a JPEG encoder. With an MgPageStore,
+    duplicate pages are hardlinked (or copied) from the saved original, or
+    refer to its image in the document, instead of being encoded again.
     '''
 
-    def __init__(self, in_queue, directory, file_name, reporter, logger=None):
+    def __init__(
+        self, in_queue, directory, file_name, reporter, logger=None,
+        pdf_writer=None, encoder=None, page_store=None
+    ):
         super(MgSaveThread, self).__init__()
         self.in_queue = in_queue
         self.directory = directory
         self.file_name = file_name
         self.reporter = reporter
         self.logger = logger
+        self.pdf_writer = pdf_writer
+        self.encoder = encoder or MgJpegEncoder()
+        self.page_store = page_store
 
     def run(self):
         while True:
@@ -299,27 +976,124 @@ class MgSaveThread(Thread):
             self.in_queue.task_done()
 
     def saveFunc(self, queue_car):
-        '''Saves the file_name to the directory.'''
+        '''Saves the file_name to the directory.
+
+        The pages waiting for the page in the MgPageStore are released
+        however saving ends, with a location only if it has been saved.
+        '''
+        location = None
+        try:
+            location = self.saveCar(queue_car)
+        finally:
+            # Explicitly close image (duplicates have none)
+            if queue_car.image is not None:
+                queue_car.image.close()
+
+            if self.page_store is not None and queue_car.duplicate_of is None:
+                self.page_store.finish(queue_car.page_number, location)
+
+    def saveCar(self, queue_car):
+        '''Saves the page of the car, returns its location or None.'''
         page_number = self.reporter.addPage()
+        if queue_car.page_number is not None:
+            # Pages are saved concurrently, so the count may be out of order
+            page_number = queue_car.page_number
         canvas = queue_car.image
         cards_on_page = queue_car.card_number
 
-        new_file_name = str(self.file_name) + str(page_number) + '.jpg'
-        file_path = os.path.join(self.directory, new_file_name)
+        if self.pdf_writer is None:
+            new_file_name = (
+                str(self.file_name) + str(page_number) + self.encoder.extension
+            )
+            file_path = os.path.join(self.directory, new_file_name)
+        else:
+            file_path = self.pdf_writer.file_path
+
         try:
-            canvas.save(file_path)
-        except IOError as e:
+            if self.reuse(queue_car.duplicate_of, page_number, file_path):
+                self.reporter.addReusedPage()
+            elif canvas is None:
+                # Duplicates are not pasted, so there is nothing to encode
+                raise MgImageException(
+                    MG_LOGGER_CONST['reuse_fail'] % queue_car.duplicate_of
+                )
+            else:
+                self.writePage(page_number, canvas, file_path)
+        except SAVE_ERRORS as e:
             self.logError(MG_LOGGER_CONST['save_fail'] % (
-                e.filename, e.strerror
+                file_path, getattr(e, 'strerror', None) or e
             ))
             self.reporter.addError()
-        else:
-            self.reporter.addCards(cards_on_page)
-        finally:
-            # Explicitly close image
-            canvas.close()
+            if self.pdf_writer is None:
+                # A partly written page must not pass for a saved one
+                try:
+                    removeFile(file_path)
+                except OSError:
+                    pass
+            return None
+
+        self.reporter.addCards(cards_on_page)
+        self.reporter.addSavedPage(page_number)
+        return file_path
+
+    def writePage(self, page_number, canvas, file_path):
+        '''Encodes the page and saves it to the file or PDF document.'''
+        page_data = self.encode(page_number, canvas)
+        if self.pdf_writer is not None:
+            self.pdf_writer.addPage(
+                page_number, page_data, canvas.size, canvas.mode
+            )
+            return
+
+        # An earlier run might have left the file linked to another page
+        removeFile(file_path)
+        with open(file_path, 'wb') as f:
+            f.write(page_data)
+
+    def reuse(self, original, page_number, file_path):
+        '''Saves the page from the identical original page.
+
+        Returns False if there is no original or it could not be saved.
+        '''
+        if original is None or self.page_store is None:
+            return False
+
+        location = self.page_store.wait(original)
+        if location is None:
+            return False
+
+        if self.pdf_writer is not None:
+            self.pdf_writer.addDuplicatePage(page_number, original)
+            return True
+
+        removeFile(file_path)
+        try:
+            os.link(location, file_path)
+        except OSError:
+            # Hardlinks are not supported by every file system
+            shutil.copyfile(location, file_path)
+
+        return True
+
+    def encode(self, page_number, canvas):
+        '''Encodes the page, reporting the time taken and the size.'''
+        start = time.perf_counter()
+        page_data = self.encoder.encode(canvas)
+        self.reporter.addEncode(
+            page_number, time.perf_counter() - start, len(page_data)
+        )
+
+        return page_data
 
     def logError(self, message):
         '''Logs an error message if a logger has been provided'''
         if self.logger:
             self.logger.error(message)
+
+
+def removeFile(file_path):
+    '''Removes the file if it exists.'''
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
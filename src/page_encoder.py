@@ -0,0 +1,105 @@
+'''The encoders used to save finished pages.
+
+Encoding is most of the work of saving a page, and the right trade-off
+between speed, size and quality depends on the printer. Every encoder turns a
+canvas into the bytes of an image file, so that the time spent encoding can
+be measured apart from the time spent writing.
+'''
+
+from io import BytesIO
+from contextlib import closing
+
+try:
+    from PIL import features
+except ImportError:
+    pass  # image_manip has already reported the missing module
+
+from src.constants import MgImageException
+
+
+class MgPageEncoder(object):
+
+    '''Encodes a canvas in the Pillow format of the subclass.
+
+    Options are passed to Pillow's save. Options that are None are left at
+    Pillow's default.
+    '''
+
+    name = None  # The name used on the command line
+    format = None  # The Pillow format
+    extension = None  # The extension of saved pages
+
+    def __init__(self, **options):
+        self.options = {
+            key: value for key, value in options.items() if value is not None
+        }
+
+    def encode(self, canvas):
+        '''Returns the encoded canvas.'''
+        with closing(BytesIO()) as page_stream:
+            canvas.save(page_stream, self.format, **self.options)
+            return page_stream.getvalue()
+
+    def describe(self):
+        '''The name and options of the encoder, for logging.'''
+        options = ', '.join(
+            '%s=%s' % (key, self.options[key]) for key in sorted(self.options)
+        )
+        return '%s (%s)' % (self.name, options or 'defaults')
+
+
+class MgJpegEncoder(MgPageEncoder):
+
+    '''Lossy JPEG. Subsampling is '4:4:4', '4:2:2' or '4:2:0'.'''
+
+    name = 'jpeg'
+    format = 'JPEG'
+    extension = '.jpg'
+
+    def __init__(
+        self, quality=None, optimize=False, progressive=False,
+        subsampling=None
+    ):
+        super(MgJpegEncoder, self).__init__(
+            quality=quality, optimize=optimize or None,
+            progressive=progressive or None, subsampling=subsampling
+        )
+
+
+class MgPngEncoder(MgPageEncoder):
+
+    '''Lossless PNG. Compress level trades speed (0) against size (9).'''
+
+    name = 'png'
+    format = 'PNG'
+    extension = '.png'
+
+    def __init__(self, compress_level=None, optimize=False):
+        super(MgPngEncoder, self).__init__(
+            compress_level=compress_level, optimize=optimize or None
+        )
+
+
+class MgWebpEncoder(MgPageEncoder):
+
+    '''Lossy WebP. Method trades speed (0) against size (6).
+
+    Raises MgImageException if Pillow has been built without WebP support.
+    '''
+
+    name = 'webp'
+    format = 'WEBP'
+    extension = '.webp'
+
+    def __init__(self, quality=None, method=None):
+        if not features.check('webp'):
+            raise MgImageException('Pillow has no WebP support')
+
+        super(MgWebpEncoder, self).__init__(quality=quality, method=method)
+
+
+# The available encoders by name
+PAGE_ENCODER_CLASSES = {
+    encoder.name: encoder
+    for encoder in (MgJpegEncoder, MgPngEncoder, MgWebpEncoder)
+}
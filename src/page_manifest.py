@@ -0,0 +1,146 @@
+'''Records what is on every page, so that only changed pages are created.
+
+Next to the pages, a manifest lists the card in every slot of every page,
+identified by the resolved image URL (or the path and modification time of
+a local image), the parameters the pages were created with, and the
+SHA-256 of every page file. A later run plans its pages from the deck in
+the same way, and only creates the pages whose entry differs. A page file
+that has been modified since is created again as well. Its size and
+modification time are compared first, so unchanged files are not read.
+'''
+
+import os
+import json
+import hashlib
+
+# Bumped whenever the layout of the manifest changes
+MANIFEST_VERSION = 1
+
+# Bytes hashed at a time
+HASH_CHUNK = 1024 ** 2
+
+
+def planPages(slot_keys, per_page):
+    '''Splits the slots of a deck into pages of per_page slots.
+
+    Slot_keys lists the key of every card in every slot, in deck order.
+    '''
+    return [
+        slot_keys[start:start + per_page]
+        for start in range(0, len(slot_keys), per_page)
+    ]
+
+
+def fileHash(file_path):
+    '''Returns the SHA-256 of a file as a hex string.'''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class MgPageManifest(object):
+
+    '''The pages saved in a directory and the parameters they were made with.
+
+    Pages is a list with an entry for every page number, None for pages
+    that have not been saved completely. Params is a dict of everything
+    other than the cards that determines the content of the pages.
+    '''
+
+    def __init__(self, params, pages=None):
+        self.params = params
+        self.pages = pages if pages is not None else []
+
+    @classmethod
+    def load(cls, file_path):
+        '''Returns the manifest saved at file_path, None if there is none.
+
+        A manifest that cannot be read is treated as missing, so that all
+        pages are created again.
+        '''
+        try:
+            with open(file_path, 'r') as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (not isinstance(content, dict) or
+                content.get('version') != MANIFEST_VERSION):
+            return None
+
+        return cls(content.get('params'), content.get('pages'))
+
+    def save(self, file_path):
+        '''Atomically replaces the manifest at file_path.
+
+        Raises OSError if the manifest cannot be written.
+        '''
+        tmp_path = file_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'version': MANIFEST_VERSION,
+                    'params': self.params,
+                    'pages': self.pages
+                }, f, indent=1)
+            os.replace(tmp_path, file_path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def unchanged(self, page_number, slots, params, file_path):
+        '''True if the page at file_path is saved with the given slots.'''
+        if params != self.params or page_number >= len(self.pages):
+            return False
+
+        entry = self.pages[page_number]
+        if entry is None or entry['slots'] != slots:
+            return False
+
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+
+        if (stat.st_size == entry['size'] and
+                stat.st_mtime_ns == entry['mtime_ns']):
+            return True
+
+        try:
+            return fileHash(file_path) == entry['hash']
+        except OSError:
+            return False
+
+    def setPage(self, page_number, slots, file_path):
+        '''Records the page saved at file_path.
+
+        The page is recorded as not saved if file_path is None or cannot be
+        read.
+        '''
+        while len(self.pages) <= page_number:
+            self.pages.append(None)
+
+        if file_path is None:
+            self.pages[page_number] = None
+            return
+
+        try:
+            stat = os.stat(file_path)
+            page_hash = fileHash(file_path)
+        except OSError:
+            self.pages[page_number] = None
+            return
+
+        self.pages[page_number] = {
+            'file': os.path.basename(file_path),
+            'slots': slots,
+            'hash': page_hash,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
@@ -0,0 +1,168 @@
+'''Writes pages into a single PDF document as they are saved.
+
+Every page is a full page JPEG image. The JPEG data is embedded as is (the
+PDF DCTDecode filter), so pages are never decoded again. Pages are written
+to the file as soon as they arrive, in whatever order the save threads
+deliver them. Only the offsets of the written objects are kept in memory,
+and the page tree listing the pages in page order is written at the end.
+Identical pages share the image of the first of them.
+'''
+
+from threading import Lock
+
+# Object numbers of the page tree and catalog, written last
+PAGES_OBJECT = 1
+CATALOG_OBJECT = 2
+
+# Postscript points per inch, the unit of PDF page sizes
+POINTS = 72
+
+# The PDF color spaces of Pillow image modes
+COLOR_SPACES = {'RGB': '/DeviceRGB', 'L': '/DeviceGray'}
+
+
+class MgPdfWriter(object):
+
+    '''A thread-safe PDF document of JPEG pages.
+
+    The file is created when the first page is added. Pages are identified
+    by their page number, which determines their place in the document.
+    close must be called once all pages have been added.
+    '''
+
+    def __init__(self, file_path, dpi):
+        self.file_path = file_path
+        self.dpi = dpi
+
+        self._lock = Lock()
+        self._file = None
+        self._offsets = {}  # Object number (key) and file offset (value)
+        self._pages = {}  # Page number (key) and page object number (value)
+        self._resources = {}  # Page number (key) and its image and content
+        self._next_object = CATALOG_OBJECT + 1
+
+    def addPage(self, page_number, jpeg_data, size, mode='RGB'):
+        '''Writes the JPEG data of a page with the given pixel size.
+
+        Raises IOError if the document cannot be written.
+        '''
+        width = size[0] * POINTS / self.dpi
+        hight = size[1] * POINTS / self.dpi
+        content = ('q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q' % (
+            width, hight
+        )).encode('latin-1')
+
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.file_path, 'wb')
+                self._file.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+
+            image_object = self.writeObject(
+                '<< /Type /XObject /Subtype /Image /Width %d /Height %d '
+                '/ColorSpace %s /BitsPerComponent 8 /Filter /DCTDecode '
+                '/Length %d >>' % (
+                    size[0], size[1], COLOR_SPACES[mode], len(jpeg_data)
+                ),
+                jpeg_data
+            )
+            content_object = self.writeObject(
+                '<< /Length %d >>' % len(content), content
+            )
+            self._resources[page_number] = (
+                image_object, content_object, width, hight
+            )
+            self.writePage(page_number, page_number)
+
+    def addDuplicatePage(self, page_number, original_page_number):
+        '''Adds a page identical to an already added page.
+
+        The page shows the image of the original, which is not written again.
+        '''
+        with self._lock:
+            self.writePage(page_number, original_page_number)
+
+    def close(self):
+        '''Writes the page tree and cross reference table. Closes the file.
+
+        Nothing is written if no page has been added.
+        '''
+        with self._lock:
+            if self._file is None:
+                return
+
+            kids = ' '.join(
+                '%d 0 R' % self._pages[page_number]
+                for page_number in sorted(self._pages)
+            )
+            self.writeObject(
+                '<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                    kids, len(self._pages)
+                ),
+                number=PAGES_OBJECT
+            )
+            self.writeObject(
+                '<< /Type /Catalog /Pages %d 0 R >>' % PAGES_OBJECT,
+                number=CATALOG_OBJECT
+            )
+
+            xref_offset = self._file.tell()
+            lines = [
+                'xref',
+                '0 %d' % self._next_object,
+                '0000000000 65535 f '
+            ]
+            lines.extend(
+                '%010d 00000 n ' % self._offsets[number]
+                for number in range(1, self._next_object)
+            )
+            lines.extend([
+                'trailer',
+                '<< /Size %d /Root %d 0 R >>' % (
+                    self._next_object, CATALOG_OBJECT
+                ),
+                'startxref',
+                str(xref_offset),
+                '%%EOF',
+                ''
+            ])
+            self._file.write('\n'.join(lines).encode('latin-1'))
+
+            self._file.close()
+            self._file = None
+
+    def writePage(self, page_number, resource_page_number):
+        '''Writes the page object showing the image of the resource page.
+
+        Lock must be held.
+        '''
+        image_object, content_object, width, hight = self._resources[
+            resource_page_number
+        ]
+        self._pages[page_number] = self.writeObject(
+            '<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f] '
+            '/Resources << /XObject << /Im0 %d 0 R >> >> '
+            '/Contents %d 0 R >>' % (
+                PAGES_OBJECT, width, hight, image_object, content_object
+            )
+        )
+
+    def writeObject(self, dictionary, stream=None, number=None):
+        '''Writes an object and returns its number. Lock must be held.
+
+        A new object number is used, unless one is given.
+        '''
+        if number is None:
+            number = self._next_object
+            self._next_object += 1
+
+        self._offsets[number] = self._file.tell()
+        self._file.write(
+            ('%d 0 obj\n%s\n' % (number, dictionary)).encode('latin-1')
+        )
+        if stream is not None:
+            self._file.write(b'stream\n')
+            self._file.write(stream)
+            self._file.write(b'\nendstream\n')
+        self._file.write(b'endobj\n')
+
+        return number
@@ -0,0 +1,196 @@
+'''Creates decks sent to a local HTTP server, keeping everything warm.
+
+Every run of MgProxy opens the card index, connects to the image hosts and
+decodes every card image again. The server keeps a single MgImageCreator
+running instead: its image getter threads, decode processes, connections,
+card index and an MgTileCache of resized card images last as long as the
+server. Creating a deck whose cards have been seen before is then mostly a
+matter of pasting and encoding its pages.
+
+The text of a deck is POSTed to /render, optionally with the name of its
+files (?name=) and a directory of local images (?local=). Its pages are
+saved to a new directory and answered as JSON (base64 encoded) along with
+the report of the deck, the directory is removed once they have been read.
+Decks POSTed at the same time are created at the same time, the image
+getters taking turns between them.
+'''
+
+import os
+import json
+import time
+import base64
+import shutil
+import tempfile
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.constants import (SERVE_HOST, MgException, MgNetworkException,
+                           MgTransientNetworkException, MgLookupException)
+from src.logger_dict import MG_LOGGER_CONST
+
+# The file name of decks POSTed without a name
+DEFAULT_NAME = 'deck'
+
+# The status answered for the errors of a deck, the first match applies.
+# Any other error is answered with 500.
+ERROR_STATUS = (
+    ((ValueError, UnicodeDecodeError), 400),
+    (MgLookupException, 422),
+    (MgTransientNetworkException, 503),
+    (MgNetworkException, 502)
+)
+
+
+class MgRenderService(object):
+
+    '''Creates decks with an MgImageCreator that has been started.
+
+    Parse_func turns the lines of a deck into a list of card tupples and
+    the number of invalid lines (see mg_proxy_creator.parseFile). The pages
+    of every deck are saved to a new directory in directory, which is
+    removed once they have been read. Decks are logged if a logger is
+    provided.
+    '''
+
+    def __init__(self, creator, directory, parse_func, logger=None):
+        self.creator = creator
+        self.directory = directory
+        self.parse_func = parse_func
+        self.logger = logger
+
+    def render(self, text, name=DEFAULT_NAME, local=None):
+        '''Creates the pages of a deck and returns its summary as a dict.
+
+        Local is the directory of the local images, None for web images.
+        Raises ValueError if the name or local directory is not valid.
+        '''
+        if not name or os.path.basename(name) != name:
+            raise ValueError('Invalid deck name %s' % name)
+        if local is not None and not os.path.isdir(local):
+            raise ValueError('Not a directory: %s' % local)
+
+        start = time.monotonic()
+        cards, invalid_lines = self.parse_func(text.splitlines(True))
+        directory = tempfile.mkdtemp(prefix=name + '-', dir=self.directory)
+        try:
+            reporter = self.creator.createDeck(
+                cards, directory, name,
+                os.path.abspath(local) if local else ''
+            )
+            files = readPages(directory)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+        summary = {
+            'files': files,
+            'cards': reporter.cards,
+            'pages': reporter.pages,
+            'errors': invalid_lines + reporter.errors,
+            'cache_hits': reporter.cache_hits,
+            'cache_misses': reporter.cache_misses,
+            'reused_pages': reporter.reused_pages,
+            'seconds': time.monotonic() - start
+        }
+
+        if self.logger:
+            self.logger.info(MG_LOGGER_CONST['job_msg'] % (
+                name, summary['cards'], summary['pages'],
+                summary['errors'], summary['seconds']
+            ))
+
+        return summary
+
+
+def readPages(directory):
+    '''Returns the name and base64 encoded data of the pages in directory.
+
+    The directory is new, so it only holds the pages of a single deck, which
+    are listed in the order of their numbers.
+    '''
+    pages = []
+    for file_name in sorted(os.listdir(directory), key=lambda file_name: (
+        len(file_name), file_name
+    )):
+        with open(os.path.join(directory, file_name), 'rb') as f:
+            data = base64.b64encode(f.read()).decode('ascii')
+        pages.append({'name': file_name, 'data': data})
+
+    return pages
+
+
+def errorStatus(error):
+    '''Returns the HTTP status answered for an error, see ERROR_STATUS.'''
+    for types, status in ERROR_STATUS:
+        if isinstance(error, types):
+            return status
+
+    return 500
+
+
+class MgRenderHandler(BaseHTTPRequestHandler):
+
+    '''Answers the requests to the server of an MgRenderService.'''
+
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != '/render':
+            self.sendJson(404, {'error': 'Not found: %s' % url.path})
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            text = self.rfile.read(length).decode('utf-8')
+            summary = self.server.service.render(
+                text, query.get('name', [DEFAULT_NAME])[0],
+                query.get('local', [None])[0]
+            )
+        except Exception as e:
+            status = errorStatus(e)
+            logger = self.server.service.logger
+            if logger and status == 500 and not isinstance(e, MgException):
+                logger.exception(str(e))
+            self.sendJson(status, {'error': str(e)})
+            return
+
+        self.sendJson(200, summary)
+
+    def sendJson(self, status, content):
+        body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        '''Decks are logged by the service, the client is always local.'''
+        pass
+
+
+class _MgUnixHTTPServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+
+    '''A ThreadingHTTPServer listening at a Unix socket.'''
+
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super(_MgUnixHTTPServer, self).get_request()
+        return (request, ('localhost', 0))
+
+
+def createServer(service, port=None, socket_path=None):
+    '''Creates the server of service at localhost:port or a Unix socket.
+
+    The server is started with serve_forever.
+    '''
+    if socket_path is None:
+        server = ThreadingHTTPServer((SERVE_HOST, port), MgRenderHandler)
+    else:
+        server = _MgUnixHTTPServer(socket_path, MgRenderHandler)
+
+    server.service = service
+    return server
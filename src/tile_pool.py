@@ -0,0 +1,129 @@
+'''Decodes and resizes card images in worker processes.
+
+Pillow holds the GIL while resampling, so a single page thread keeps only
+one core busy. MgTilePool hands the compressed image data (or the path of a
+local image) to a pool of processes, which return tiles ready to be pasted
+at the target size. Only the compressed source crosses the process
+boundary, never the full decoded scan. The pixels of a tile are left in a
+shared memory block, only its name, mode and size are sent back.
+'''
+
+import multiprocessing
+from io import BytesIO
+from threading import Lock
+from contextlib import closing
+from multiprocessing.shared_memory import SharedMemory
+from concurrent.futures import ProcessPoolExecutor
+
+from src.get_image import openAndValidateImage
+from src.image_manip import resizeImage, tileSize
+from src.constants import RESIZE_TIERS
+
+try:
+    from PIL import Image
+except ImportError:
+    pass  # get_image has already reported the missing module
+
+
+def createTile(source, dpi, wh, resize=RESIZE_TIERS[0]):
+    '''Decodes and resizes an image. Runs in a worker process.
+
+    Source is either the compressed image data or the path to an image file.
+    The raw pixel data of the resized image is written to a new shared memory
+    block. Returns the name of the block and the mode and size of the image.
+    The block is unlinked by the MgPendingTile reading it.
+    '''
+    size = tileSize(dpi, wh)
+    if isinstance(source, bytes):
+        with closing(BytesIO(source)) as image_stream:
+            image = openAndValidateImage(image_stream, size)
+    else:
+        image = openAndValidateImage(source, size)
+
+    with closing(image):
+        tile = resizeImage(image, dpi, wh, resize)
+
+    with closing(tile):
+        data = tile.tobytes()
+        block = SharedMemory(create=True, size=max(len(data), 1))
+        try:
+            block.buf[:len(data)] = data
+        except BaseException:
+            block.unlink()
+            raise
+        finally:
+            block.close()
+
+        return (block.name, tile.mode, tile.size)
+
+
+class MgPendingTile(object):
+
+    '''A card image that is being decoded and resized by MgTilePool.
+
+    Stands in for the Pillow image passed between the queues. Every call to
+    result creates a new image, so the tile can be shared by several queue
+    cars without copying. Nbytes estimates the size of the finished tile.
+    '''
+
+    def __init__(self, future, nbytes):
+        self.future = future
+        self.nbytes = nbytes
+        self._lock = Lock()
+        self._tile = None
+
+    def result(self):
+        '''Waits for the tile and returns it as a Pillow image.
+
+        The first call copies the tile out of its shared memory block and
+        unlinks the block. Raises MgImageException if the image could not be
+        opened.
+        '''
+        name, mode, size = self.future.result()
+        with self._lock:
+            if self._tile is None:
+                block = SharedMemory(name)
+                try:
+                    self._tile = Image.frombytes(mode, size, block.buf)
+                finally:
+                    block.close()
+                    block.unlink()
+            return self._tile.copy()
+
+    def copy(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class MgTilePool(object):
+
+    '''A pool of worker processes creating tiles at the given dpi and wh.
+
+    Processes are spawned rather than forked, as forking a process running
+    several threads can leave locks in the child in a held state. Images
+    are resized with the given resize tier.
+    '''
+
+    def __init__(self, workers, dpi, wh, resize=RESIZE_TIERS[0]):
+        self.dpi = dpi
+        self.wh = wh
+        self.resize = resize
+        self.executor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context('spawn')
+        )
+
+    def submit(self, source):
+        '''Starts creating the tile for source and returns an MgPendingTile.'''
+        width, hight = tileSize(self.dpi, self.wh)
+        return MgPendingTile(
+            self.executor.submit(
+                createTile, source, self.dpi, self.wh, self.resize
+            ),
+            width * hight * 3
+        )
+
+    def shutdown(self):
+        '''Waits for all pending tiles and stops the worker processes.'''
+        self.executor.shutdown()
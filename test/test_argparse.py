@@ -1,9 +1,12 @@
 '''Tests that args provided by user are correctly parsed and processed'''
 import unittest
 import os.path
+import shutil
+import tempfile
 
 from src.argv_input import arg_parser
-from src.mg_proxy_creator import createMgInstance, getFileNamePath
+from src.mg_proxy_creator import (createMgInstance, getFileNamePath,
+                                  findDecks)
 import src.constants as CON
 
 
@@ -60,6 +63,26 @@ class TestArgs(unittest.TestCase):
 
         self.assertEqual(results[0], os.path.abspath('opt/bin'))
 
+    def test_batch_input(self):
+        '''Test that several files and directories of decks can be given'''
+        parsed_input = vars(arg_parser.parse_args(['a.txt', 'decks']))
+        self.assertEqual(
+            parsed_input[CON.ARG_CONST['input_file']], ['a.txt', 'decks']
+        )
+
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('b.dec', 'a.txt', 'Swamp', 'notes.md'):
+                open(os.path.join(directory, name), 'w').close()
+
+            self.assertEqual(
+                findDecks(['x.txt', directory]),
+                ['x.txt', os.path.join(directory, 'a.txt'),
+                 os.path.join(directory, 'b.dec')]
+            )
+        finally:
+            shutil.rmtree(directory)
+
 
 if __name__ == '__main__':
     unittest.main()
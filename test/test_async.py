@@ -0,0 +1,217 @@
+'''Tests the asyncio fetch backend against a local HTTP server'''
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+from io import BytesIO
+from queue import Queue
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from PIL import Image
+
+from src.mg_async import MgAsyncGetImageThread, getGenericDataAsync
+from src.mg_thread import MgQueueCar, MgReport
+from src.image_cache import MgImageCache
+from src.get_image import MgImageDataCheck
+from src.image_source import MgSourceRouter, createSource
+from src.create_page import MgImageCreator
+from src.fetch_policy import MgFetchPolicy
+from src.constants import MgNetworkException, MgImageException
+
+# Cards with an image each, see createPolicyAddress
+CARDS = [
+    'Swamp', 'Forest', 'Island', 'Mountain', 'Plains', 'Giant Growth',
+    'Lightning Bolt', 'Llanowar Elves', 'Shock', 'Cancel'
+]
+
+
+def createJpeg(color):
+    '''Returns the JPEG data of a small image of a single color'''
+    data = BytesIO()
+    Image.new('RGB', (10, 14), color).save(data, 'JPEG')
+    return data.getvalue()
+
+
+class MgTestHandler(BaseHTTPRequestHandler):
+    '''Answers every path with a JPEG, see TestAsync for the exceptions'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(MgTestHandler, self).setup()
+        self.server.count('connections')
+
+    def do_GET(self):
+        server = self.server
+        server.count('requests')
+        server.paths.append(self.path)
+        with server.lock:
+            server.active += 1
+            server.peak = max(server.peak, server.active)
+        try:
+            time.sleep(server.delay)
+            self.answer()
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def answer(self):
+        if self.path.endswith('/missing.jpg') or 'ori/269' in self.path:
+            self.send_error(404)
+            return
+
+        body = b'not an image' if 'text' in self.path else createJpeg('red')
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        if 'chunked' in self.path:
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 100):
+                chunk = body[start:start + 100]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestAsync(unittest.TestCase):
+    '''Test MgAsyncGetImageThread and its HTTP client.
+
+    The server answers 404 for missing.jpg and the Forest of CARDS, a body
+    that is not an image for paths containing text, and a chunked body for
+    paths containing chunked.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), MgTestHandler)
+        self.server.lock = Lock()
+        self.server.delay = 0
+        self.server.active = self.server.peak = 0
+        self.server.counts = {'connections': 0, 'requests': 0}
+        self.server.paths = []
+
+        def count(name):
+            with self.server.lock:
+                self.server.counts[name] += 1
+        self.server.count = count
+
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.router = MgSourceRouter([createSource(self.url)])
+        Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def helperFetch(self, names, limit=4, cache=None):
+        '''Fetches names with a thread, returns the Out-Queue and report'''
+        in_queue, out_queue = Queue(), Queue()
+        reporter = MgReport()
+        getter = MgAsyncGetImageThread(
+            in_queue, out_queue, '', reporter, cache=cache,
+            policy=MgFetchPolicy(retries=0), router=self.router,
+            limit=limit
+        )
+        for name in names:
+            in_queue.put(MgQueueCar((None, 1, None, name)))
+        in_queue.put(MgQueueCar())
+        getter.run()
+
+        cars = []
+        while not out_queue.empty():
+            cars.append(out_queue.get())
+        return cars, reporter
+
+    def test_keep_alive(self):
+        '''Test that one connection serves several and chunked responses'''
+        async def fetch():
+            return [
+                await getGenericDataAsync(
+                    self.url + path, 'image/jpeg', 5
+                ) for path in ('/a.jpg', '/chunked.jpg', '/b.jpg')
+            ]
+
+        bodies = asyncio.run(fetch())
+        self.assertEqual(bodies, [createJpeg('red')] * 3)
+        self.assertEqual(self.server.counts['connections'], 1)
+
+    def test_errors(self):
+        '''Test the errors raised for missing images and wrong bodies'''
+        async def fetch(path):
+            return await getGenericDataAsync(
+                self.url + path, 'image/jpeg', 5, MgImageDataCheck
+            )
+
+        with self.assertRaises(MgNetworkException):
+            asyncio.run(fetch('/missing.jpg'))
+        with self.assertRaises(MgImageException):
+            asyncio.run(fetch('/text.jpg'))
+
+    def test_order(self):
+        '''Test that every image is passed on before the stop signal'''
+        cars, reporter = self.helperFetch(CARDS)
+
+        # The Forest is missing, no stop signal without a job
+        names = [car.input_tupple[3] for car in cars]
+        self.assertEqual(sorted(names), sorted(set(CARDS) - {'Forest'}))
+        self.assertEqual(reporter.errors, 1)
+
+        # With a job, its stop signal is put after the last of its images
+        creator = MgImageCreator(
+            10, (1, 1), (2, 1), backend='async',
+            policy=MgFetchPolicy(retries=0), router=self.router
+        )
+        cards = [(None, 1, None, name) for name in CARDS + ['Not a card']]
+        reporter = creator.create(False, cards, self.directory, 'deck')
+        self.assertEqual((reporter.cards, reporter.pages), (9, 5))
+        self.assertEqual(reporter.errors, 2)
+
+    def test_limit(self):
+        '''Test that no more than limit images are fetched at once'''
+        self.server.delay = 0.05
+        cars, _ = self.helperFetch(CARDS, limit=3)
+        self.assertEqual(len(cars), len(CARDS) - 1)
+        self.assertEqual(self.server.peak, 3)
+
+    def test_cache(self):
+        '''Test that cached images are not fetched again'''
+        cache = MgImageCache(self.directory)
+        names = ['Swamp', 'Island', 'Forest']
+        cars, reporter = self.helperFetch(names, cache=cache)
+        self.assertEqual(len(cars), 2)
+        self.assertEqual((reporter.cache_hits, reporter.cache_misses), (0, 3))
+        self.assertEqual(self.server.counts['requests'], 3)
+
+        cars, reporter = self.helperFetch(names, cache=cache)
+        self.assertEqual(len(cars), 2)
+        self.assertEqual((reporter.cache_hits, reporter.cache_misses), (2, 1))
+        self.assertEqual(self.server.counts['requests'], 4)
+
+    def test_cache_check(self):
+        '''Test that data which is not an image is not cached'''
+        cache = MgImageCache(self.directory)
+        getter = MgAsyncGetImageThread(
+            Queue(), Queue(), '', MgReport(), cache=cache,
+            policy=MgFetchPolicy(retries=0)
+        )
+        address = self.url + '/text.jpg'
+        with self.assertRaises(MgImageException):
+            asyncio.run(getter.getData(address))
+        self.assertIsNone(cache.get(address))
+
+        address = self.url + '/image.jpg'
+        data = asyncio.run(getter.getData(address))
+        self.assertEqual(cache.get(address), data)
+
+
+if __name__ == '__main__':
+    unittest.main()
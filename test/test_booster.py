@@ -0,0 +1,89 @@
+'''Tests drawing booster packs from the cards of a set'''
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from src.booster import MgBoosterSampler, boosterSlots
+from src.get_mtg_json import MgSetCache, parseLocalSetForRarity
+
+
+class TestBoosterSampler(unittest.TestCase):
+    '''Test packs drawn from the local M10 set'''
+
+    def setUp(self):
+        with open('test/files/M10.json', 'r') as f:
+            self.set_dict = json.load(f)
+        self.rarities = parseLocalSetForRarity(self.set_dict)
+
+    def helperSampler(self, seed=1):
+        return MgBoosterSampler(
+            self.rarities, boosterSlots(self.set_dict), seed
+        )
+
+    def test_pack_slots(self):
+        '''Test that every pack follows the slots of the set'''
+        rarity_of = dict(
+            (name, rarity) for rarity, names in self.rarities.items()
+            for name in names
+        )
+        packs = self.helperSampler().sample(200)
+
+        self.assertEqual(len(packs), 200)
+        mythics = 0
+        for pack in packs:
+            # The marketing slot has no cards to draw from
+            self.assertEqual(len(pack), 15)
+            self.assertEqual(len(set(pack)), 15)
+            rarities = Counter(rarity_of[name] for name in pack)
+            self.assertEqual(rarities['Common'], 10)
+            self.assertEqual(rarities['Uncommon'], 3)
+            self.assertEqual(rarities['Basic Land'], 1)
+            self.assertEqual(rarities['Rare'] + rarities['Mythic Rare'], 1)
+            mythics += rarities['Mythic Rare']
+
+        # One in eight packs has a mythic rare
+        self.assertTrue(5 < mythics < 50)
+
+    def test_seed(self):
+        '''Test that packs only depend on the seed'''
+        self.assertEqual(
+            self.helperSampler('a').sample(3),
+            self.helperSampler('a').sample(3)
+        )
+        self.assertNotEqual(
+            self.helperSampler('a').sample(3),
+            self.helperSampler('b').sample(3)
+        )
+
+    def test_default_slots(self):
+        '''Test that sets without booster slots get the default ones'''
+        del self.set_dict['booster']
+        self.assertEqual(len(self.helperSampler().sample(1)[0]), 15)
+
+
+class TestSetCache(unittest.TestCase):
+    '''Test that cached sets are read without downloading them'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        shutil.copy(
+            'test/files/M10.json', os.path.join(self.directory, 'M10.json')
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_cached_set(self):
+        '''Test that a set younger than max_age is read from disk'''
+        set_cache = MgSetCache(self.directory)
+        set_dict = set_cache.get('M10')
+        self.assertEqual(set_dict['code'], 'M10')
+        self.assertIs(set_cache.get('M10'), set_dict)
+        self.assertIn('Mythic Rare', set_cache.rarities('M10'))
+
+
+if __name__ == '__main__':
+    unittest.main()
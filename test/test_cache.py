@@ -0,0 +1,102 @@
+'''Tests the persistent on-disk image cache'''
+import unittest
+import tempfile
+import shutil
+import os
+
+from PIL import Image
+
+from src.image_cache import MgImageCache, MgTileCache
+
+
+class TestImageCache(unittest.TestCase):
+    '''Test storing, retrieving and evicting cached images'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_get_put(self):
+        '''Test that stored data is returned and missing data is None'''
+        cache = MgImageCache(self.directory)
+
+        self.assertIsNone(cache.get('http://a/1.jpg'))
+        self.assertTrue(cache.put('http://a/1.jpg', b'abc'))
+        self.assertEqual(cache.get('http://a/1.jpg'), b'abc')
+        self.assertEqual(cache.size, 3)
+
+        # Overwriting an entry does not count its size twice
+        cache.put('http://a/1.jpg', b'abcd')
+        self.assertEqual(cache.size, 4)
+
+    def test_persistent(self):
+        '''Test that a new cache instance finds the existing entries'''
+        MgImageCache(self.directory).put('http://a/1.jpg', b'abc')
+        cache = MgImageCache(self.directory)
+
+        self.assertEqual(cache.size, 3)
+        self.assertEqual(cache.get('http://a/1.jpg'), b'abc')
+
+    def test_lru_eviction(self):
+        '''Test that the least recently used entries are evicted first'''
+        cache = MgImageCache(self.directory, 30)
+
+        for number in range(3):
+            cache.put(str(number), b'x' * 10)
+            # Guarantee distinct modification times
+            os.utime(cache.keyPath(str(number)), (number, number))
+
+        # Using entry 0 makes entry 1 the least recently used one
+        cache.get('0')
+        cache.put('3', b'x' * 10)
+
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(cache.get('0'), b'x' * 10)
+        self.assertEqual(cache.get('3'), b'x' * 10)
+        self.assertLessEqual(cache.size, 30)
+
+
+class TestTileCache(unittest.TestCase):
+    '''Test keeping resized images in memory'''
+
+    def test_lru(self):
+        '''Test that tiles are copied and the least recently used dropped'''
+        cache = MgTileCache(2 * 10 * 10 * 3)
+        keys = [MgTileCache.key('', (None, 1, None, name))
+                for name in ('Swamp', 'Forest', 'Island')]
+
+        tile = Image.new('RGB', (10, 10), 'red')
+        cache.put(keys[0], tile)
+        tile.close()
+        self.assertEqual(cache.get(keys[0]).getpixel((0, 0)), (255, 0, 0))
+        self.assertIsNone(cache.get(keys[1]))
+
+        cache.put(keys[1], Image.new('RGB', (10, 10)))
+        cache.get(keys[0])
+        cache.put(keys[2], Image.new('RGB', (10, 10)))
+
+        self.assertIsNone(cache.get(keys[1]))
+        self.assertIsNotNone(cache.get(keys[0]))
+        self.assertEqual(cache.size, 2 * 10 * 10 * 3)
+
+    def test_local_key(self):
+        '''Test that the key of a local tile changes with its image'''
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        file_path = os.path.join(directory, 'swamp.jpg')
+        Image.new('RGB', (10, 10)).save(file_path)
+
+        card = (None, 1, None, 'Swamp')
+        key = MgTileCache.key(directory, card)
+        self.assertIsNotNone(key)
+        self.assertIsNone(MgTileCache.key(directory, (None, 1, None, 'Ice')))
+
+        mtime = os.stat(file_path).st_mtime_ns + 10 ** 9
+        os.utime(file_path, ns=(mtime, mtime))
+        self.assertNotEqual(MgTileCache.key(directory, card), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
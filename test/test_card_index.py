@@ -0,0 +1,204 @@
+'''Tests the compiled card index built from master.json'''
+import unittest
+import tempfile
+import shutil
+import json
+import time
+import os
+
+from src.card_index import MgCardIndex
+from src.card_select import MgCardSelector, setRanks
+from src.fuzzy_match import MgFuzzyIndex, buildGrams, editDistance
+from src.constants import MgLookupException, MASTER_JSON, FUZZY_SUGGEST
+
+MASTER = {
+    'Forest': {
+        'LEA': ['/al/294.jpg', '/al/295.jpg'], '8ED': ['/8e/347.jpg'],
+        'M10': ['/m10/246.jpg', '/m10/247.jpg'], 'M15': ['/m15/270.jpg']
+    },
+    'Swamp': {'LEA': ['/al/290.jpg'], 'M10': ['/m10/238.jpg']}
+}
+
+META = {
+    'scan_sizes': {'/8e/347.jpg': [480, 680], '/m10/247.jpg': [312, 445]}
+}
+
+
+class TestCardIndex(unittest.TestCase):
+    '''Test building, looking up and rebuilding the index'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.json_path = os.path.join(self.directory, 'master.json')
+        self.index_path = os.path.join(self.directory, 'master.sqlite')
+        self.meta_path = os.path.join(self.directory, 'master_meta.json')
+        self.writeMaster(MASTER)
+
+        with open(self.meta_path, 'w') as f:
+            json.dump(META, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def writeMaster(self, master):
+        with open(self.json_path, 'w') as f:
+            json.dump(master, f)
+
+    def createIndex(self):
+        return MgCardIndex(self.json_path, self.index_path, self.meta_path)
+
+    def test_lookup(self):
+        '''Test that the index returns the same printings as master.json'''
+        index = self.createIndex()
+
+        urls = [p.url for p in index.lookup('Forest').printings]
+        self.assertCountEqual(
+            urls, [u for us in MASTER['Forest'].values() for u in us]
+        )
+        self.assertIn('Swamp', index)
+        self.assertNotIn('Island', index)
+        with self.assertRaises(KeyError):
+            index.lookup('Island')
+
+    def test_closest(self):
+        '''Test that misspelt names are matched to the closest card'''
+        index = self.createIndex()
+
+        name, similarity = index.closest('swmap')
+        self.assertEqual(name, 'Swamp')
+        self.assertEqual(index.closest('Forrest')[0], 'Forest')
+        self.assertEqual(index.closest('Forest'), ('Forest', 1))
+        self.assertIsNone(index.closest('swmap', similarity + 0.01))
+        self.assertIsNone(index.closest('Island'))
+
+    def test_rebuild_when_newer(self):
+        '''Test that the index is rebuilt if master.json is newer'''
+        self.createIndex().lookup('Forest')
+        os.utime(self.index_path, (0, 0))
+
+        self.writeMaster({'Island': {'M10': ['/m10/230.jpg']}})
+        index = self.createIndex()
+
+        self.assertIn('Island', index)
+        self.assertNotIn('Forest', index)
+
+    def test_missing_master(self):
+        '''Test that a missing master.json raises a lookup exception'''
+        os.remove(self.json_path)
+        index = self.createIndex()
+
+        with self.assertRaises(MgLookupException):
+            index.lookup('Forest')
+
+
+    def test_set_ranks(self):
+        '''Test that the release order is recovered from per card orders'''
+        ranks = setRanks(MASTER)
+        order = sorted(ranks, key=ranks.get)
+
+        self.assertEqual(order, ['LEA', '8ED', 'M10', 'M15'])
+
+    def test_policies(self):
+        '''Test the printing chosen by each selection policy'''
+        entry = self.createIndex().lookup('Forest')
+
+        def select(policy, set_name=None, **kwargs):
+            selector = MgCardSelector(policy, **kwargs)
+            return selector.select('Forest', entry, set_name).url
+
+        self.assertEqual(select('newest'), '/m15/270.jpg')
+        self.assertEqual(select('oldest'), '/al/294.jpg')
+        self.assertEqual(select('resolution'), '/8e/347.jpg')
+        self.assertEqual(select('era', era='modern'), '/m10/247.jpg')
+        self.assertEqual(select('era', era='original'), '/al/294.jpg')
+
+        # Within a set, the largest known scan or the first printing
+        self.assertEqual(select('newest', 'M10'), '/m10/247.jpg')
+        self.assertEqual(select('resolution', 'M10'), '/m10/247.jpg')
+        self.assertEqual(select('oldest', 'M10'), '/m10/246.jpg')
+        with self.assertRaises(KeyError):
+            select('newest', 'XXX')
+
+    def test_unknown_sizes(self):
+        '''Test that resolution picks the newest printing without sizes'''
+        index = self.createIndex()
+        selector = MgCardSelector('resolution')
+        for name, set_name, url in (
+            ('Swamp', None, '/m10/238.jpg'), ('Forest', 'LEA', '/al/294.jpg')
+        ):
+            printing = selector.select(name, index.lookup(name), set_name)
+            self.assertEqual(printing.url, url)
+
+    def test_seeded_random(self):
+        '''Test that random selection only depends on the seed'''
+        entry = self.createIndex().lookup('Forest')
+
+        def select(seed):
+            return MgCardSelector('random', seed).select('Forest', entry).url
+
+        self.assertEqual(select('a'), select('a'))
+        self.assertGreater(
+            len(set(select(str(seed)) for seed in range(50))), 1
+        )
+
+
+
+class TestFuzzyIndex(unittest.TestCase):
+    '''Test suggestions for misspelt names among all cards of master.json'''
+
+    # Misspelt names and the cards they are meant to be
+    MISSPELT = {
+        'Llanowar Elfs': 'Llanowar Elves',
+        'Lightnig Bolt': 'Lightning Bolt',
+        'Serra Angle': 'Serra Angel',
+        'Shivan Dragn': 'Shivan Dragon',
+        'Wrath of Gd': 'Wrath of God',
+        'Jace the Mind Sculpter': 'Jace, the Mind Sculptor',
+        'Birds of Paradice': 'Birds of Paradise',
+        'Counterspel': 'Counterspell',
+        'Forrest': 'Forest',
+        'Elspeth Sun Champion': "Elspeth, Sun's Champion",
+        'Sakura Tribe Elder': 'Sakura-Tribe Elder',
+        'Sword of Fire an Ice': 'Sword of Fire and Ice',
+        'Thoughtsieze': 'Thoughtseize',
+        'Ancestral Recal': 'Ancestral Recall',
+        'Baneslayer Angle': 'Baneslayer Angel',
+        'Cryptic Comand': 'Cryptic Command',
+        'Primeval Titian': 'Primeval Titan',
+        'Snapcaster Mage': 'Snapcaster Mage'
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        with open(MASTER_JSON, 'r') as f:
+            names = sorted(json.load(f))
+        cls.index = MgFuzzyIndex(names, buildGrams(names))
+
+    def test_accuracy(self):
+        '''Test that every misspelt name suggests the card meant'''
+        for misspelt, name in self.MISSPELT.items():
+            self.assertEqual(
+                self.index.closest(misspelt, FUZZY_SUGGEST)[0], name
+            )
+
+    def test_latency(self):
+        '''Test that a suggestion takes less than a millisecond on average'''
+        fastest = None
+        for _ in range(5):
+            start = time.perf_counter()
+            for misspelt in self.MISSPELT:
+                self.index.closest(misspelt)
+            elapsed = (time.perf_counter() - start) / len(self.MISSPELT)
+            fastest = elapsed if fastest is None else min(fastest, elapsed)
+
+        self.assertLess(fastest, 0.001)
+
+    def test_edit_distance(self):
+        '''Test that swapped characters count as a single edit'''
+        self.assertEqual(editDistance('elfs', 'elves'), 2)
+        self.assertEqual(editDistance('bolt', 'blot'), 1)
+        self.assertEqual(editDistance('', 'ape'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+'''Tests retrying, hedging and remembering failed downloads'''
+import os
+import time
+import shutil
+import tempfile
+import asyncio
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+from src.get_image import MgImageDataCheck, statusError
+from src.fetch_policy import MgFetchPolicy
+from src.image_source import MgSourceRouter, MgDirectorySource, createSource
+from src.constants import (MgNetworkException, MgTransientNetworkException,
+                           MgImageException, LATENCY_SAMPLES)
+
+
+class TestFetchPolicy(unittest.TestCase):
+    '''Test the MgFetchPolicy with fake downloads'''
+
+    def helperFlaky(self, failures, data=b'jpeg'):
+        '''Returns a download failing transiently the given number of times'''
+        calls = []
+
+        def fetch_func(timeout):
+            calls.append(timeout)
+            if len(calls) <= failures:
+                raise MgTransientNetworkException('503')
+            return data
+
+        return fetch_func, calls
+
+    def test_retries(self):
+        '''Test that transient failures are retried up to retries times'''
+        policy = MgFetchPolicy(retries=2, backoff=0)
+        fetch_func, calls = self.helperFlaky(2)
+        self.assertEqual(policy.fetch('a', fetch_func), b'jpeg')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(policy.retried, 2)
+
+        fetch_func, calls = self.helperFlaky(3)
+        with self.assertRaises(MgTransientNetworkException):
+            policy.fetch('b', fetch_func)
+
+        # Transient failures are not remembered
+        fetch_func, calls = self.helperFlaky(0)
+        self.assertEqual(policy.fetch('b', fetch_func), b'jpeg')
+
+    def test_negative_cache(self):
+        '''Test that permanent failures are remembered and not retried'''
+        policy = MgFetchPolicy(retries=2, backoff=0)
+        calls = []
+
+        def not_found(timeout):
+            calls.append(timeout)
+            raise MgNetworkException('404', status=404)
+
+        errors = []
+        for _ in range(3):
+            with self.assertRaises(MgNetworkException) as raised:
+                policy.fetch('dead', not_found)
+            errors.append(raised.exception)
+        self.assertEqual(len(calls), 1)
+
+        # Every hit raises a new exception with the same message and status
+        self.assertIsNot(errors[1], errors[2])
+        self.assertEqual(str(errors[2]), '404')
+        self.assertEqual(errors[2].status, 404)
+
+        policy = MgFetchPolicy(negative_ttl=0)
+        for _ in range(2):
+            with self.assertRaises(MgNetworkException):
+                policy.fetch('dead', not_found)
+        self.assertEqual(len(calls), 3)
+
+    def test_not_permanent(self):
+        '''Test that other client errors are neither retried nor remembered'''
+        policy = MgFetchPolicy(retries=2, backoff=0)
+        calls = []
+
+        def forbidden(timeout):
+            calls.append(timeout)
+            raise MgNetworkException('403', status=403)
+
+        for _ in range(2):
+            with self.assertRaises(MgNetworkException):
+                policy.fetch('mirror', forbidden)
+        self.assertEqual(len(calls), 2)
+
+        # Timeouts and rate limits of the server are retried
+        error = statusError(429, 'http://x/a.jpg')
+        self.assertIsInstance(error, MgTransientNetworkException)
+        self.assertEqual(error.status, 429)
+        self.assertNotIsInstance(
+            statusError(403, 'http://x/a.jpg'), MgTransientNetworkException
+        )
+
+    def test_negative_size(self):
+        '''Test that the oldest and expired failures are dropped'''
+        policy = MgFetchPolicy(negative_ttl=0.05, negative_size=2)
+        error = MgNetworkException('404', status=404)
+        for key in 'abc':
+            policy.addNegative(key, error)
+        self.assertEqual(list(policy._negative), ['b', 'c'])
+
+        time.sleep(0.1)
+        policy.addNegative('d', error)
+        self.assertEqual(list(policy._negative), ['d'])
+
+    def test_failed_latency(self):
+        '''Test that only successful downloads count towards the timeouts'''
+        policy = MgFetchPolicy(retries=1, backoff=0)
+        fetch_func, _ = self.helperFlaky(1)
+        policy.fetch('a', fetch_func)
+        self.assertEqual(len(policy.tracker._latencies), 1)
+
+    def test_hedge(self):
+        '''Test that a slow download is hedged and the faster one wins'''
+        policy = MgFetchPolicy(hedge=True)
+        for _ in range(LATENCY_SAMPLES):
+            policy.tracker.add(0.01)
+
+        calls = []
+
+        def fetch_func(timeout):
+            calls.append(timeout)
+            if len(calls) == 1:
+                time.sleep(0.5)
+                return b'slow'
+            return b'fast'
+
+        self.assertEqual(policy.fetch('a', fetch_func), b'fast')
+        self.assertEqual(policy.hedged_requests, 1)
+
+        executor = policy.executor()
+        policy.close()
+        self.assertRaises(RuntimeError, executor.submit, time.sleep, 0)
+        self.assertIsNot(policy.executor(), executor)
+        policy.close()
+
+    def test_adaptive_timeout(self):
+        '''Test that timeouts adapt, except on the last attempt'''
+        policy = MgFetchPolicy()
+        self.assertEqual(policy.tracker.timeout(0, 3), 5)
+
+        for _ in range(LATENCY_SAMPLES):
+            policy.tracker.add(0.1)
+        self.assertEqual(policy.tracker.timeout(0, 3), 1)
+        self.assertEqual(policy.tracker.timeout(2, 3), 5)
+
+
+class TestSourceRouter(unittest.TestCase):
+    '''Test that images are fetched from the best of several mirrors'''
+
+    def setUp(self):
+        '''Creates two mirrors, only the second has the M10 Forest'''
+        self.directory = tempfile.mkdtemp()
+        self.mirrors = []
+        mirror_images = (
+            ('a', ['lea/1.jpg']), ('b', ['lea/1.jpg', 'm10/2.jpg'])
+        )
+        for name, images in mirror_images:
+            for image in images:
+                file_path = os.path.join(self.directory, name, image)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'wb') as f:
+                    f.write(name.encode('ascii'))
+            self.mirrors.append(os.path.join(self.directory, name))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_failover(self):
+        '''Test that a missing image is fetched from the next mirror'''
+        router = MgSourceRouter(
+            [createSource(mirror) for mirror in self.mirrors], 'http://x'
+        )
+
+        self.assertEqual(router.fetch('http://x/lea/1.jpg', None, 1), b'a')
+        self.assertEqual(router.fetch('http://x/m10/2.jpg', None, 1), b'b')
+        with self.assertRaises(MgNetworkException):
+            router.fetch('http://x/m10/3.jpg', None, 1)
+
+    def test_corrupt_failover(self):
+        '''Test that data that is not an image fails over to the next mirror'''
+        jpeg = BytesIO()
+        Image.new('RGB', (10, 10)).save(jpeg, 'JPEG')
+        with open(os.path.join(self.mirrors[1], 'lea', '1.jpg'), 'wb') as f:
+            f.write(jpeg.getvalue())
+
+        sources = [createSource(mirror) for mirror in self.mirrors]
+        router = MgSourceRouter(sources, 'http://x')
+        self.assertEqual(
+            router.fetch('http://x/lea/1.jpg', None, 1, MgImageDataCheck),
+            jpeg.getvalue()
+        )
+        self.assertEqual(sources[0].failures, 1)
+
+        # Failing sources are tried last
+        self.assertEqual(asyncio.run(router.fetchAsync(
+            'http://x/lea/1.jpg', None, 1, MgImageDataCheck
+        )), jpeg.getvalue())
+        with self.assertRaises(MgImageException):
+            router.fetch('http://x/m10/2.jpg', None, 1, MgImageDataCheck)
+
+    def test_fastest(self):
+        '''Test that a faster mirror is preferred over the given order'''
+        sources = [MgDirectorySource(mirror) for mirror in self.mirrors]
+        router = MgSourceRouter(sources, 'http://x')
+        sources[0].record(0.5)
+        sources[1].record(0.1)
+        self.assertEqual(router.fetch('http://x/lea/1.jpg', None, 1), b'b')
+
+        # A failing mirror is avoided, even if it is the fastest
+        sources[1].record()
+        self.assertEqual(router.fetch('http://x/lea/1.jpg', None, 1), b'a')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+'''Tests the pool of persistent HTTP connections'''
+import os
+import unittest
+from unittest.mock import patch
+from threading import Thread, Lock
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from src.http_pool import MgConnectionPool
+
+
+class MgPoolHandler(BaseHTTPRequestHandler):
+    '''Answers with the path, see TestConnectionPool for the exceptions'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(MgPoolHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', self.server.redirect)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # Closes the connection without telling the client
+        self.close_connection = self.path.startswith('/close')
+
+    def log_message(self, *args):
+        pass
+
+
+class TestConnectionPool(unittest.TestCase):
+    '''Test MgConnectionPool against two local servers.
+
+    The servers redirect /redirect to the redirect attribute of the server,
+    and silently close the connection after answering /close.
+    '''
+
+    def setUp(self):
+        self.servers = []
+        for _ in range(2):
+            server = ThreadingHTTPServer(('127.0.0.1', 0), MgPoolHandler)
+            server.lock = Lock()
+            server.connections = 0
+            server.paths = []
+            server.redirect = None
+            server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+            Thread(target=server.serve_forever).start()
+            self.servers.append(server)
+        self.pool = MgConnectionPool(proxies={})
+
+    def tearDown(self):
+        self.pool.clear()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def helperGet(self, address):
+        '''Returns the body of a GET request to address'''
+        with self.pool.urlopen(address, 5) as response:
+            return response.read()
+
+    def test_reuse(self):
+        '''Test that consecutive requests share one connection'''
+        server = self.servers[0]
+        for path in ('/a.jpg', '/b.jpg', '/c.jpg'):
+            self.assertEqual(self.helperGet(server.url + path), path.encode())
+        self.assertEqual(server.connections, 1)
+
+    def test_stale(self):
+        '''Test that a request on a closed connection is sent again'''
+        server = self.servers[0]
+        self.assertEqual(self.helperGet(server.url + '/close'), b'/close')
+        self.assertEqual(self.helperGet(server.url + '/a.jpg'), b'/a.jpg')
+        self.assertEqual(server.connections, 2)
+
+    def test_redirect(self):
+        '''Test that redirects to another host are followed'''
+        first, second = self.servers
+        first.redirect = second.url + '/a.jpg'
+        self.assertEqual(self.helperGet(first.url + '/redirect'), b'/a.jpg')
+        self.assertEqual((first.paths, second.paths), (
+            ['/redirect'], ['/a.jpg']
+        ))
+
+        # Both connections are kept for later requests
+        self.assertEqual(sum(len(i) for i in self.pool._idle.values()), 2)
+
+    def test_release_on_error(self):
+        '''Test that a connection is closed if its response is abandoned'''
+        server = self.servers[0]
+        with self.assertRaises(ValueError):
+            with self.pool.urlopen(server.url + '/a.jpg', 5):
+                raise ValueError('abandoned')
+        self.assertEqual(sum(len(i) for i in self.pool._idle.values()), 0)
+
+        self.assertEqual(self.helperGet(server.url + '/b.jpg'), b'/b.jpg')
+        self.assertEqual(server.connections, 2)
+
+    def test_proxy(self):
+        '''Test that requests are sent to the proxy with the full URL'''
+        proxy = self.servers[0]
+        self.pool = MgConnectionPool(proxies={'http': proxy.url})
+        address = 'http://cards.invalid/m10/1.jpg?x=1'
+        self.assertEqual(self.helperGet(address), address.encode())
+        self.assertEqual(proxy.paths, [address])
+
+        # Hosts excluded by no_proxy are connected to directly
+        with patch.dict(os.environ, {'no_proxy': '127.0.0.1'}):
+            address = self.servers[1].url + '/a.jpg'
+            self.assertEqual(self.helperGet(address), b'/a.jpg')
+        self.assertEqual(len(proxy.paths), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+'''Tests opening and resizing of card images'''
+import unittest
+import os
+import tempfile
+from unittest import mock
+from io import BytesIO
+from multiprocessing.shared_memory import SharedMemory
+
+from PIL import Image
+
+from src.constants import (
+    RESIZE_TIERS, MgImageException, MgTransientNetworkException
+)
+from src.get_image import openAndValidateImage, streamData, MgImageParser
+from src.image_manip import resizeImage, tileSize, createCanvas
+from src.page_encoder import MgJpegEncoder, MgPngEncoder
+from src.tile_pool import MgTilePool
+
+
+class TestImageDecoding(unittest.TestCase):
+    '''Test that images are decoded at the right resolution'''
+
+    def setUp(self):
+        '''Creates a JPEG eight times the size of a 75 dpi card'''
+        self.dpi, self.wh = 75, (2.49, 3.48)
+        size = tileSize(self.dpi * 8, self.wh)
+
+        self.jpeg = BytesIO()
+        Image.new('RGB', size, 'green').save(self.jpeg, 'JPEG')
+
+    def test_full_decode(self):
+        '''Test that the image is decoded at full size by default'''
+        self.jpeg.seek(0)
+        image = openAndValidateImage(self.jpeg)
+
+        self.assertEqual(image.size, tileSize(self.dpi * 8, self.wh))
+
+    def test_draft_decode(self):
+        '''Test that a smaller target size decodes at a reduced scale'''
+        target = tileSize(self.dpi, self.wh)
+        self.jpeg.seek(0)
+        image = openAndValidateImage(self.jpeg, target)
+
+        # Draft mode never decodes below the target size
+        self.assertLess(image.size[0], tileSize(self.dpi * 8, self.wh)[0])
+        self.assertGreaterEqual(image.size[0], target[0])
+        self.assertGreaterEqual(image.size[1], target[1])
+        self.assertEqual(resizeImage(image, self.dpi, self.wh).size, target)
+
+    def test_resize_tiers(self):
+        '''Test that every resize tier creates tiles of the same size'''
+        target = tileSize(self.dpi, self.wh)
+        self.jpeg.seek(0)
+        image = openAndValidateImage(self.jpeg)
+
+        for tier in RESIZE_TIERS:
+            tile = resizeImage(image, self.dpi, self.wh, tier)
+            self.assertEqual(tile.size, target)
+            self.assertEqual(tile.mode, image.mode)
+
+
+class ChunkedStream(BytesIO):
+    '''A stream returning at most 1000 bytes per read1, like a socket'''
+
+    def read1(self, size=-1):
+        return super(ChunkedStream, self).read1(1000)
+
+
+class TestImageStreaming(unittest.TestCase):
+    '''Test that images are decoded from the chunks of their data'''
+
+    def setUp(self):
+        self.dpi, self.wh = 75, (2.49, 3.48)
+        image = Image.effect_noise(tileSize(self.dpi * 8, self.wh), 40)
+
+        jpeg = BytesIO()
+        image.convert('RGB').save(jpeg, 'JPEG', progressive=True)
+        self.data = jpeg.getvalue()
+
+    def helperStream(self, data, size=None, length=None):
+        '''Feeds data in small chunks, returns the image'''
+        return streamData(
+            ChunkedStream(data), MgImageParser(size), 'test', length
+        )
+
+    def test_stream(self):
+        '''Test that the image matches the image decoded at once'''
+        for size in (None, tileSize(self.dpi, self.wh)):
+            image = self.helperStream(self.data, size)
+            expected = openAndValidateImage(BytesIO(self.data), size)
+            self.assertEqual(image.size, expected.size)
+            self.assertEqual(image.tobytes(), expected.tobytes())
+
+    def test_collected(self):
+        '''Test that the data is only opened once all of it has been fed'''
+        parser = MgImageParser()
+        with mock.patch.object(Image, 'open', wraps=Image.open) as image_open:
+            for _ in range(1000):
+                parser.feed(b'x' * 100)
+            self.assertEqual(image_open.call_count, 0)
+            self.assertRaises(IOError, parser.close)
+        self.assertEqual(image_open.call_count, 1)
+
+    def test_errors(self):
+        '''Test that missing data raises the same errors as before'''
+        half = self.data[:len(self.data) // 2]
+        self.assertRaises(MgImageException, self.helperStream, half)
+        self.assertRaises(
+            MgImageException, self.helperStream, b'<html></html>'
+        )
+        self.assertRaises(
+            MgTransientNetworkException, self.helperStream, half, None,
+            len(self.data)
+        )
+
+
+class TestPageEncoding(unittest.TestCase):
+    '''Test that pages are encoded with the requested settings'''
+
+    def setUp(self):
+        self.canvas = createCanvas(10, (2.49, 3.48), (4, 2))
+
+    def helperDecode(self, data):
+        '''Opens encoded page data'''
+        return Image.open(BytesIO(data))
+
+    def test_jpeg_settings(self):
+        '''Test that jpeg options are passed to Pillow'''
+        encoder = MgJpegEncoder(quality=95, progressive=True)
+        page = self.helperDecode(encoder.encode(self.canvas))
+
+        self.assertEqual(page.format, 'JPEG')
+        self.assertEqual(page.size, self.canvas.size)
+        self.assertTrue(page.info.get('progressive'))
+        self.assertEqual(
+            encoder.describe(), 'jpeg (progressive=True, quality=95)'
+        )
+
+    def test_png_lossless(self):
+        '''Test that png pages are identical to the canvas'''
+        self.canvas.putpixel((3, 4), (1, 2, 3))
+        page = self.helperDecode(MgPngEncoder(1).encode(self.canvas))
+
+        self.assertEqual(page.format, 'PNG')
+        self.assertEqual(page.tobytes(), self.canvas.tobytes())
+
+
+
+class TestTilePool(unittest.TestCase):
+    '''Test that worker processes create the tiles the page thread would'''
+
+    def test_tiles(self):
+        '''Test tiles of image data and files against resizeImage'''
+        dpi, wh = 75, (2.49, 3.48)
+        scan = Image.merge('RGB', [
+            Image.effect_noise(tileSize(dpi * 4, wh), 64) for _ in range(3)
+        ])
+        jpeg = BytesIO()
+        scan.save(jpeg, 'JPEG')
+        descriptor, file_path = tempfile.mkstemp()
+        with os.fdopen(descriptor, 'wb') as f:
+            f.write(jpeg.getvalue())
+
+        pool = MgTilePool(1, dpi, wh, RESIZE_TIERS[1])
+        try:
+            pending = [pool.submit(jpeg.getvalue()), pool.submit(file_path)]
+            tiles = [tile.result() for tile in pending]
+            bad_tile = pool.submit(b'not an image')
+            self.assertRaises(MgImageException, bad_tile.result)
+        finally:
+            pool.shutdown()
+            os.remove(file_path)
+
+        jpeg.seek(0)
+        image = openAndValidateImage(jpeg, tileSize(dpi, wh))
+        expected = resizeImage(image, dpi, wh, RESIZE_TIERS[1])
+        for tile in tiles:
+            self.assertEqual(tile.size, expected.size)
+            self.assertEqual(tile.tobytes(), expected.tobytes())
+
+        # The shared memory is released once read, later results are copies
+        name = pending[0].future.result()[0]
+        self.assertRaises(FileNotFoundError, SharedMemory, name)
+        self.assertEqual(pending[0].result().tobytes(), expected.tobytes())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,6 @@
 '''Tests downloading and parsin of JSON files downloaded from mtgjson.com'''
 from src import get_mtg_json
+from src.json_stream import MgJsonFieldScanner
 import unittest
 import json
 
@@ -47,5 +48,37 @@ class GetAndParseMTGJson(unittest.TestCase):
             'Wrapper function does not equal individual functions'
         )
 
+
+class StreamSetFields(unittest.TestCase):
+
+    '''Tests extracting set fields from AllSets.json in chunks'''
+
+    def setUp(self):
+        '''Creates an AllSets like document from the local M10 set.'''
+        with open('test/files/M10.json', 'r') as f:
+            m10 = json.loads(f.read())
+
+        m10['magicCardsInfoCode'] = 'm10'
+        self.all_sets = json.dumps({
+            'M10': m10,
+            'X"Y': {'cards': [{'magicCardsInfoCode': 'no'}], 'name': 'x'},
+            'Z': {'releaseDate': '2000-01-01', 'magicCardsInfoCode': 'z\u00e9'}
+        }, indent=1)
+
+    def test_stream_fields(self):
+        '''Only second level fields are found, whatever the chunk size'''
+        expected = {
+            'M10': {'magicCardsInfoCode': 'm10', 'releaseDate': '2009-07-17'},
+            'Z': {'magicCardsInfoCode': 'z\u00e9', 'releaseDate': '2000-01-01'}
+        }
+
+        for chunk in (1, 7, 4096, len(self.all_sets)):
+            scanner = MgJsonFieldScanner(('magicCardsInfoCode', 'releaseDate'))
+            for i in range(0, len(self.all_sets), chunk):
+                scanner.feed(self.all_sets[i:i + chunk])
+
+            self.assertDictEqual(dict(scanner.results), expected)
+            self.assertEqual(list(scanner.results), ['M10', 'Z'])
+
 if __name__ == '__main__':
     unittest.main()
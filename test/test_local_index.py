@@ -0,0 +1,103 @@
+'''Tests resolving card names to the local images of a directory'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from src.local_index import MgLocalIndex, normalizeName
+
+
+class TestLocalIndex(unittest.TestCase):
+    '''Test the index of a directory of local images'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for file_name in (
+            'Swamp', 'aether vial.PNG', 'Fire - Ice.jpg', 'Forest [M10].jpg',
+            'LEA/Forest.jpg', '[M15]/Island.jpeg', 'notes.txt'
+        ):
+            self.createFile(file_name)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def createFile(self, file_name):
+        file_path = os.path.join(self.directory, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        open(file_path, 'wb').close()
+        return file_path
+
+    def helperResolve(self, index, card_name, set_name=None):
+        '''Returns the resolved path relative to the directory'''
+        path = index.resolve(card_name, set_name)
+        return path and os.path.relpath(path, self.directory)
+
+    def test_normalize(self):
+        '''Test that case, accents and punctuation are ignored'''
+        self.assertEqual(normalizeName('Æther Vial'), 'aether vial')
+        self.assertEqual(normalizeName('Fire // Ice'), 'fire ice')
+        self.assertEqual(normalizeName("Jötun Grunt"), 'jotun grunt')
+        self.assertEqual(normalizeName("Gaea's Cradle"), 'gaeas cradle')
+
+    def test_resolve(self):
+        '''Test that names resolve regardless of case and extension'''
+        index = MgLocalIndex(self.directory)
+        self.assertEqual(self.helperResolve(index, 'Swamp'), 'Swamp')
+        self.assertEqual(
+            self.helperResolve(index, 'Æther Vial'), 'aether vial.PNG'
+        )
+        self.assertEqual(
+            self.helperResolve(index, 'Fire // Ice'), 'Fire - Ice.jpg'
+        )
+        self.assertEqual(
+            self.helperResolve(index, 'island', 'M15'), '[M15]/Island.jpeg'
+        )
+        self.assertIsNone(index.resolve('Plains'))
+
+    def test_sets(self):
+        '''Test that the printing of the set is preferred'''
+        index = MgLocalIndex(self.directory)
+        self.assertEqual(
+            self.helperResolve(index, 'Forest', 'lea'), 'LEA/Forest.jpg'
+        )
+        self.assertEqual(
+            self.helperResolve(index, 'Forest', 'M10'), 'Forest [M10].jpg'
+        )
+        self.assertEqual(
+            self.helperResolve(index, 'Forest', '8ED'), 'Forest [M10].jpg'
+        )
+
+    def test_refresh(self):
+        '''Test that added files are found once the directory changed'''
+        index = MgLocalIndex(self.directory, check_interval=0)
+        self.assertIsNone(index.resolve('Plains'))
+
+        file_path = self.createFile('LEA/Plains.jpg')
+        # Make sure the change is seen on coarse mtime file systems
+        folder = os.path.dirname(file_path)
+        mtime = os.stat(folder).st_mtime_ns + 10 ** 9
+        os.utime(folder, ns=(mtime, mtime))
+        self.assertEqual(
+            self.helperResolve(index, 'Plains'), 'LEA/Plains.jpg'
+        )
+
+    def test_refresh_while_resolving(self):
+        '''Test that resolving more often than checked finds added files'''
+        index = MgLocalIndex(self.directory, check_interval=0.3)
+        self.assertIsNone(index.resolve('Plains'))
+
+        self.createFile('Plains.jpg')
+        mtime = os.stat(self.directory).st_mtime_ns + 10 ** 9
+        os.utime(self.directory, ns=(mtime, mtime))
+
+        deadline = time.monotonic() + 2
+        found = None
+        while found is None and time.monotonic() < deadline:
+            found = index.resolve('Plains')
+            time.sleep(0.05)
+        self.assertEqual(found, os.path.join(self.directory, 'Plains.jpg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
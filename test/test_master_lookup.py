@@ -0,0 +1,117 @@
+'''Tests recreating master.json with a stubbed magiccards.info'''
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import http.client
+from unittest import mock
+
+import master_lookup
+from src.constants import MASTER_JSON, MASTER_META
+
+# The cards of every set on the stubbed magiccards.info
+SET_INFO = {
+    'm10': (('Swamp', '/m10/238.jpg'), ('Forest', '/m10/246.jpg')),
+    'zen': (('Swamp', '/zen/238.jpg'),)
+}
+
+
+class TestMasterLookup(unittest.TestCase):
+    '''Test crawls of the sets listed in a local AllSets.json'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.crawled = []
+        self.failing = set()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def helperRun(self, codes, *args):
+        '''Runs master_lookup for the sets codes, returns the exit status'''
+        all_sets = {
+            code.upper(): {
+                'magicCardsInfoCode': code, 'releaseDate': '2009-07-%02d' % n
+            } for n, code in enumerate(codes)
+        }
+        with open('AllSets.json', 'w') as f:
+            json.dump(all_sets, f)
+
+        def getSetInfo(set_name):
+            self.crawled.append(set_name)
+            if set_name in self.failing:
+                raise http.client.HTTPException('503')
+            return SET_INFO[set_name]
+
+        with mock.patch.object(master_lookup, 'getSetInfo', getSetInfo):
+            return master_lookup.main(
+                ['--all_sets', 'AllSets.json', '--checkpoints', 'cp'] +
+                list(args)
+            )
+
+    def helperMaster(self):
+        '''Returns the master.json written by the run'''
+        with open(MASTER_JSON, 'r') as f:
+            return json.load(f)
+
+    def test_resume(self):
+        '''Test that a failed crawl resumes from its checkpoints'''
+        self.failing.add('zen')
+        self.assertEqual(self.helperRun(['m10', 'zen']), 1)
+        self.assertFalse(os.path.exists(MASTER_JSON))
+
+        self.failing.clear()
+        self.crawled = []
+        self.assertEqual(self.helperRun(['m10', 'zen']), 0)
+        self.assertEqual(self.crawled, ['zen'])
+        self.assertEqual(sorted(self.helperMaster()['Swamp']), ['M10', 'ZEN'])
+        self.assertFalse(os.path.exists('cp'))
+
+    def test_stale_checkpoints(self):
+        '''Test that checkpoints of a crawl of other sets are not resumed'''
+        self.failing.add('zen')
+        self.helperRun(['m10', 'zen'])
+
+        # AllSets.json has changed meanwhile
+        self.failing.clear()
+        self.crawled = []
+        self.assertEqual(self.helperRun(['zen', 'm10']), 0)
+        self.assertEqual(sorted(self.crawled), ['m10', 'zen'])
+
+    def test_incremental(self):
+        '''Test that only sets missing from master.json are crawled'''
+        self.assertEqual(self.helperRun(['m10']), 0)
+        self.crawled = []
+        self.assertEqual(self.helperRun(['m10', 'zen'], '--incremental'), 0)
+        self.assertEqual(self.crawled, ['zen'])
+
+        master = self.helperMaster()
+        self.assertEqual(master['Swamp']['M10'], ['/m10/238.jpg'])
+        self.assertEqual(master['Swamp']['ZEN'], ['/zen/238.jpg'])
+        with open(MASTER_META, 'r') as f:
+            self.assertEqual(list(json.load(f)['release_dates']), [
+                'M10', 'ZEN'
+            ])
+
+    def test_probe_errors(self):
+        '''Test that scans failing to be probed do not stop the others'''
+        def probeScanSize(url):
+            if url == '/m10/246.jpg':
+                raise OSError('cannot identify image file')
+            return [312, 445]
+
+        with mock.patch.object(master_lookup, 'probeScanSize', probeScanSize):
+            status = self.helperRun(['m10'], '--probe_scans')
+        self.assertEqual(status, 1)
+        with open(MASTER_META, 'r') as f:
+            self.assertEqual(json.load(f)['scan_sizes'], {
+                '/m10/238.jpg': [312, 445]
+            })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+'''Tests the PDF output of MgProxy'''
+import os
+import re
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+
+from PIL import Image
+
+from src.pdf_writer import MgPdfWriter
+
+
+class TestPdfWriter(unittest.TestCase):
+    '''Test that pages are embedded as is and listed in page order'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, 'deck.pdf')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def helperJpeg(self, size):
+        '''Returns the JPEG data of a white page of the given size'''
+        stream = BytesIO()
+        Image.new('RGB', size, 'white').save(stream, 'JPEG')
+        return stream.getvalue()
+
+    def test_page_order(self):
+        '''Test that pages added out of order are listed in page order'''
+        writer = MgPdfWriter(self.file_path, 72)
+        pages = {0: (10, 20), 1: (30, 40), 2: (50, 60)}
+        jpeg_data = {}
+
+        for page_number in (2, 0, 1):
+            jpeg_data[page_number] = self.helperJpeg(pages[page_number])
+            writer.addPage(
+                page_number, jpeg_data[page_number], pages[page_number]
+            )
+        writer.close()
+
+        with open(self.file_path, 'rb') as f:
+            document = f.read()
+
+        self.assertTrue(document.startswith(b'%PDF-1.4'))
+        self.assertTrue(document.endswith(b'%%EOF\n'))
+        for data in jpeg_data.values():
+            self.assertIn(data, document)
+
+        # At 72 dpi, a pixel is a point
+        kids = re.search(rb'/Kids \[([^\]]*)\]', document).group(1).split(b'R')
+        boxes = []
+        for kid in kids[:-1]:
+            number = int(kid.split()[0])
+            page = re.search(
+                rb'\n%d 0 obj\n[^\n]*/MediaBox \[0 0 ([\d.]+) ([\d.]+)\]' %
+                number, document
+            )
+            boxes.append((float(page.group(1)), float(page.group(2))))
+
+        self.assertEqual(boxes, [pages[n] for n in range(3)])
+
+        # Every cross reference entry points at its object
+        xref = int(re.search(rb'startxref\n(\d+)', document).group(1))
+        entries = document[xref:].split(b'\n')[3:3 + 2 + 3 * 3]
+        for number, entry in enumerate(entries, 1):
+            offset = int(entry.split()[0])
+            self.assertTrue(document[offset:].startswith(b'%d 0 obj' % number))
+
+    def test_no_pages(self):
+        '''Test that no file is created if no page has been added'''
+        writer = MgPdfWriter(self.file_path, 300)
+        writer.close()
+        self.assertFalse(os.path.exists(self.file_path))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+'''Tests creating decks sent to the local HTTP server'''
+import os
+import json
+import base64
+from io import BytesIO
+import shutil
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+from threading import Thread
+from unittest import mock
+
+from PIL import Image
+
+from src.constants import MgNetworkException
+from src.create_page import MgImageCreator
+from src.image_cache import MgTileCache
+from src.mg_proxy_creator import parseFile
+from src.render_server import MgRenderService, createServer
+
+
+class TestRenderServer(unittest.TestCase):
+    '''Test the server with a deck of local images'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Image.new('RGB', (10, 10), 'black').save(
+            os.path.join(self.directory, 'Swamp'), 'JPEG'
+        )
+
+        self.tiles = MgTileCache()
+        self.creator = MgImageCreator(
+            10, (1, 1), (2, 1), tile_cache=self.tiles
+        )
+        self.creator.start()
+        service = MgRenderService(self.creator, self.directory, parseFile)
+        self.server = createServer(service, 0)
+        Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.creator.close()
+        shutil.rmtree(self.directory)
+
+    def helperPost(self, path, text):
+        '''Posts text to path and returns the status and decoded JSON'''
+        url = 'http://%s:%d%s' % (self.server.server_address[:2] + (path,))
+        try:
+            with urllib.request.urlopen(url, text.encode('utf-8')) as answer:
+                return answer.status, json.load(answer)
+        except urllib.error.HTTPError as e:
+            return e.code, json.load(e)
+
+    def test_render(self):
+        '''Test that the pages and report of a deck are answered'''
+        for _ in range(2):
+            status, summary = self.helperPost(
+                '/render?name=swamps&local=' + self.directory,
+                '3 Swamp\nnot a card\n'
+            )
+            self.assertEqual(status, 200)
+            self.assertEqual(summary['cards'], 3)
+            self.assertEqual(summary['errors'], 1)
+            self.assertEqual(
+                [page['name'] for page in summary['files']],
+                ['swamps0.jpg', 'swamps1.jpg']
+            )
+            data = base64.b64decode(summary['files'][1]['data'])
+            self.assertEqual(Image.open(BytesIO(data)).format, 'JPEG')
+
+            # Only the Swamp is left in the directory
+            self.assertEqual(os.listdir(self.directory), ['Swamp'])
+
+        # The resized Swamp is kept for later decks
+        self.assertGreater(self.tiles.size, 0)
+
+        status, summary = self.helperPost('/render?name=../up', '1 Swamp')
+        self.assertEqual(status, 400)
+
+    def test_errors(self):
+        '''Test the status answered for the errors of a deck'''
+        for error, expected in (
+            (MgNetworkException('unreachable'), 502),
+            (OSError('No space left on device'), 500)
+        ):
+            with mock.patch.object(
+                self.creator, 'createDeck', side_effect=error
+            ):
+                status, summary = self.helperPost('/render', '1 Swamp')
+            self.assertEqual(status, expected)
+            self.assertEqual(summary['error'], str(error))
+
+        self.assertEqual(os.listdir(self.directory), ['Swamp'])
+
+
+if __name__ == '__main__':
+    unittest.main()
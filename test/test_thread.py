@@ -0,0 +1,427 @@
+'''Tests the building blocks of the thread based part of MgProxy'''
+import os
+import shutil
+import tempfile
+import unittest
+from queue import Queue
+from threading import Thread, Event
+
+from PIL import Image
+
+from src.mg_thread import (MgFetchCoalescer, MgImageCreateThread,
+                           MgSaveThread, MgQueueCar, MgReport, MgPageStore,
+                           MgFairQueue, MgJob)
+from src.memory_governor import MgMemoryGovernor, MgBudgetQueue
+from src.create_page import MgImageCreator
+from src.page_encoder import MgJpegEncoder
+from src.constants import MgNetworkException
+
+
+class FakeImage(object):
+    '''Stands in for a Pillow image, only copy is required'''
+
+    def __init__(self, original=None):
+        self.original = original
+
+    def copy(self):
+        return FakeImage(self)
+
+
+class TestFetchCoalescer(unittest.TestCase):
+    '''Test that identical card requests share one fetch'''
+
+    def test_duplicates_share_fetch(self):
+        '''Test that duplicate cards are fetched once and served copies'''
+        coalescer = MgFetchCoalescer()
+        cards = [
+            (None, 2, None, 'Swamp'), ('SB:', 1, None, 'Swamp'),
+            (None, 1, 'M10', 'Swamp')
+        ]
+        for card in cards:
+            coalescer.register(card)
+
+        fetched = []
+
+        def fetch():
+            fetched.append(1)
+            return FakeImage()
+
+        first = coalescer.fetch(cards[0], fetch)
+        second = coalescer.fetch(cards[1], fetch)
+        coalescer.fetch(cards[2], fetch)
+
+        # The set is part of the key, so the M10 Swamp is fetched separately
+        self.assertEqual(len(fetched), 2)
+        # The last car receives the original, the others copies
+        self.assertIs(first.original, second)
+        self.assertIsNone(second.original)
+
+    def test_in_flight(self):
+        '''Test that a request waits for an identical fetch in flight'''
+        coalescer = MgFetchCoalescer()
+        card = (None, 1, None, 'Forest')
+        coalescer.register(card)
+        coalescer.register(card)
+
+        started, release = Event(), Event()
+        results = []
+
+        def slow_fetch():
+            started.set()
+            release.wait()
+            return FakeImage()
+
+        def first_fetch():
+            results.append(coalescer.fetch(card, slow_fetch))
+
+        thread = Thread(target=first_fetch)
+        thread.start()
+        started.wait()
+
+        waiter = Thread(
+            target=lambda: results.append(
+                coalescer.fetch(card, self.fail)
+            )
+        )
+        waiter.start()
+        release.set()
+        thread.join()
+        waiter.join()
+
+        self.assertEqual(len(results), 2)
+
+    def test_errors_shared(self):
+        '''Test that every car sharing a failed fetch receives the error'''
+        coalescer = MgFetchCoalescer()
+        card = (None, 1, None, 'Forest')
+        coalescer.register(card)
+        coalescer.register(card)
+
+        def bad_fetch():
+            raise MgNetworkException('no network')
+
+        errors = []
+        for _ in range(2):
+            with self.assertRaises(MgNetworkException) as context:
+                coalescer.fetch(card, bad_fetch)
+            errors.append(context.exception)
+
+        # Every car raises an error of its own, chained to the shared one
+        self.assertIsNot(errors[0], errors[1])
+        self.assertIs(errors[0].__cause__, errors[1].__cause__)
+        self.assertEqual(str(errors[1]), 'no network')
+
+    def test_resized_shared(self):
+        '''Test that the image kept for other cars is the resized one'''
+        coalescer = MgFetchCoalescer(10, (1, 2))
+        card = (None, 1, None, 'Forest')
+        coalescer.register(card)
+        coalescer.register(card)
+
+        scan = Image.new('RGB', (100, 200), 'green')
+        first = coalescer.fetch(card, lambda: scan)
+        second = coalescer.fetch(card, self.fail)
+        self.assertEqual((first.size, second.size), ((10, 20), (10, 20)))
+        self.assertIsNot(first, second)
+
+        # A single car receives the image as it is
+        scan = Image.new('RGB', (100, 200), 'green')
+        coalescer.register(card)
+        self.assertIs(coalescer.fetch(card, lambda: scan), scan)
+
+
+class TestPageReuse(unittest.TestCase):
+    '''Test that identical pages are only encoded once'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def helperPages(self, page_store, reporter):
+        '''Creates the pages of a deck, returns the queue of its pages'''
+        image_queue, canvas_queue = Queue(), Queue()
+        page_thread = MgImageCreateThread(
+            image_queue, canvas_queue, 10, (1, 1), (2, 1), reporter,
+            page_store=page_store
+        )
+
+        cards = [
+            (None, 4, None, 'Swamp'), (None, 2, None, 'Forest'),
+            (None, 2, None, 'Swamp')
+        ]
+        for card in cards:
+            queue_car = MgQueueCar(card)
+            color = 'green' if card[3] == 'Forest' else 'black'
+            queue_car.image = Image.new('RGB', (10, 10), color)
+            image_queue.put(queue_car)
+        image_queue.put(MgQueueCar())
+        page_thread.run()
+
+        return canvas_queue
+
+    def test_identical_pages(self):
+        '''Test that pages with the same cards reuse the first of them'''
+        page_store = MgPageStore()
+        reporter = MgReport()
+        canvas_queue = self.helperPages(page_store, reporter)
+
+        # Duplicates are known before they are pasted
+        self.assertEqual(
+            [car.image is None for car in list(canvas_queue.queue)],
+            [False, True, False, True]
+        )
+
+        saver = MgSaveThread(
+            canvas_queue, self.directory, 'page', reporter,
+            page_store=page_store
+        )
+        canvas_queue.put(MgQueueCar())
+        saver.run()
+
+        self.assertEqual(reporter.pages, 4)
+        self.assertEqual(reporter.cards, 8)
+        self.assertEqual(reporter.reused_pages, 2)
+        self.assertEqual([e[0] for e in reporter.encodes], [0, 2])
+
+        def read(page_number):
+            file_name = 'page%d.jpg' % page_number
+            with open(os.path.join(self.directory, file_name), 'rb') as f:
+                return f.read()
+
+        self.assertEqual(read(0), read(1))
+        self.assertEqual(read(0), read(3))
+        self.assertNotEqual(read(0), read(2))
+
+    def test_spanning_car(self):
+        '''Test that a car filling several pages is pasted on each of them'''
+        image_queue, canvas_queue = Queue(), Queue()
+        page_thread = MgImageCreateThread(
+            image_queue, canvas_queue, 10, (1, 1), (2, 1), MgReport(),
+            page_store=MgPageStore()
+        )
+        for name, number, color in (
+            ('Swamp', 1, 'black'), ('Forest', 3, 'green')
+        ):
+            queue_car = MgQueueCar((None, number, None, name))
+            queue_car.image = Image.new('RGB', (10, 10), color)
+            image_queue.put(queue_car)
+        image_queue.put(MgQueueCar())
+        page_thread.run()
+
+        pages = [canvas_queue.get().image for _ in range(2)]
+        self.assertEqual(pages[0].getpixel((15, 5)), (0, 128, 0))
+        self.assertEqual(pages[1].getpixel((5, 5)), (0, 128, 0))
+
+    def test_encoder_error(self):
+        '''Test that pages waiting for a page that failed are released'''
+        class MgFailingEncoder(MgJpegEncoder):
+            def encode(self, canvas):
+                raise ValueError('unsupported setting')
+
+        page_store = MgPageStore()
+        reporter = MgReport()
+        canvas_queue = self.helperPages(page_store, reporter)
+
+        savers = [
+            MgSaveThread(
+                canvas_queue, self.directory, 'page', reporter,
+                encoder=MgFailingEncoder(), page_store=page_store
+            ) for _ in range(2)
+        ]
+        for saver in savers:
+            canvas_queue.put(MgQueueCar())
+            saver.start()
+        for saver in savers:
+            saver.join(5)
+            self.assertFalse(saver.is_alive())
+
+        self.assertEqual((reporter.pages, reporter.errors), (4, 4))
+        self.assertEqual((reporter.cards, reporter.reused_pages), (0, 0))
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestMemoryGovernor(unittest.TestCase):
+    '''Test that queues are bounded by the bytes of their images'''
+
+    def helperCar(self, size):
+        '''A queue car carrying an RGB image of the given size'''
+        queue_car = MgQueueCar((None, 1, None, 'Swamp'))
+        queue_car.image = Image.new('RGB', size)
+        return queue_car
+
+    def test_budget_blocks(self):
+        '''Test that a put waits until enough bytes have been released'''
+        governor = MgMemoryGovernor(1000)
+        image_queue = MgBudgetQueue(governor)
+        page_queue = MgBudgetQueue(governor)
+        image_queue.put(self.helperCar((10, 10)))
+
+        # An empty queue is always allowed one car, whatever its size
+        page_queue.put(self.helperCar((20, 20)))
+        self.assertEqual(governor.peak, 1500)
+
+        put = Thread(target=image_queue.put, args=(self.helperCar((5, 5)),))
+        put.start()
+        put.join(0.1)
+        self.assertTrue(put.is_alive())
+
+        page_queue.get()
+        put.join()
+        image_queue.get()
+        image_queue.get()
+        self.assertEqual(governor.peak, 1500)
+        self.assertGreater(governor.average, 0)
+
+
+class TestBatch(unittest.TestCase):
+    '''Test that several decks share the image getters of a batch'''
+
+    def setUp(self):
+        '''Creates two decks, each next to its own Swamp image'''
+        self.directory = tempfile.mkdtemp()
+        self.decks = []
+        for name, color, number in (('a', 'black', 3), ('b', 'white', 5)):
+            deck_dir = os.path.join(self.directory, name)
+            os.mkdir(deck_dir)
+            Image.new('RGB', (10, 10), color).save(
+                os.path.join(deck_dir, 'Swamp'), 'JPEG'
+            )
+            cards = [(None, number, None, 'Swamp')]
+            self.decks.append((cards, deck_dir, name))
+
+        # A deck without any cards
+        self.decks.append(([], self.directory, 'empty'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_separate_reports(self):
+        '''Test that every deck has its own report, files and images'''
+        creator = MgImageCreator(10, (1, 1), (2, 1))
+        reporters = list(creator.createBatch(True, iter(self.decks)))
+
+        self.assertEqual([r.cards for r in reporters], [3, 5, 0])
+        self.assertEqual([r.pages for r in reporters], [2, 3, 0])
+        self.assertEqual([r.errors for r in reporters], [0, 0, 0])
+
+        for name, color in (('a', 0), ('b', 255)):
+            file_path = os.path.join(self.directory, name, name + '0.jpg')
+            with Image.open(file_path) as page:
+                self.assertAlmostEqual(page.getpixel((5, 5))[0], color, -1)
+
+    def test_streamed_deck(self):
+        '''Test that pages are created while the deck is still being read'''
+        deck_dir = os.path.join(self.directory, 'a')
+        first_page = os.path.join(deck_dir, 'a0.jpg')
+        seen = []
+
+        def cards():
+            for _ in range(2):
+                yield (None, 1, None, 'Swamp')
+            # The first page is saved before the rest of the deck is read
+            for _ in range(100):
+                if os.path.isfile(first_page):
+                    break
+                Event().wait(0.05)
+            seen.append(os.path.isfile(first_page))
+            yield (None, 1, None, 'Swamp')
+
+        creator = MgImageCreator(10, (1, 1), (2, 1))
+        reporter = creator.create(True, cards(), deck_dir, 'a')
+        self.assertEqual(seen, [True])
+        self.assertEqual((reporter.cards, reporter.pages), (3, 2))
+
+    def test_fair_queue(self):
+        '''Test that cars of several jobs take turns, stop signals last'''
+        fair_queue = MgFairQueue()
+        jobs = [MgJob(Queue(), None, ''), MgJob(Queue(), None, '')]
+        for job, cards in zip(jobs, (3, 1)):
+            for number in range(cards):
+                queue_car = MgQueueCar((None, number, None, 'Swamp'))
+                queue_car.job = job
+                fair_queue.put(queue_car)
+        fair_queue.put(MgQueueCar())
+        queue_car = MgQueueCar((None, 3, None, 'Swamp'))
+        queue_car.job = jobs[1]
+        fair_queue.put(queue_car)
+
+        order = []
+        while not fair_queue.empty():
+            queue_car = fair_queue.get()
+            order.append(None if queue_car.end_thread else (
+                jobs.index(queue_car.job), queue_car.input_tupple[1]
+            ))
+        self.assertEqual(order, [(0, 0), (1, 0), (0, 1), (1, 3), (0, 2), None])
+
+
+class TestIncremental(unittest.TestCase):
+    '''Test that only the pages with changed cards are created again'''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for name, color in (('Swamp', 'black'), ('Forest', 'green'),
+                            ('Island', 'blue')):
+            Image.new('RGB', (10, 10), color).save(
+                os.path.join(self.directory, name), 'JPEG'
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def helperCreate(self, deck):
+        '''Creates the deck, returns the report and times pages were saved'''
+        creator = MgImageCreator(10, (1, 1), (2, 1))
+        reporter = creator.createIncremental(
+            True, [list(card) for card in deck], self.directory, 'page'
+        )
+        times = [
+            os.stat(os.path.join(self.directory, 'page%d.jpg' % n)).st_mtime_ns
+            for n in range(reporter.pages + reporter.unchanged_pages)
+        ]
+        return reporter, times
+
+    def test_changed_pages(self):
+        '''Test that pages are planned in deck order and kept if unchanged'''
+        deck = [(None, 3, None, 'Swamp'), (None, 2, None, 'Forest')]
+        reporter, times = self.helperCreate(deck)
+        self.assertEqual((reporter.pages, reporter.unchanged_pages), (3, 0))
+        with Image.open(os.path.join(self.directory, 'page1.jpg')) as page:
+            self.assertLess(page.getpixel((2, 2))[1], 50)
+            self.assertGreater(page.getpixel((12, 2))[1], 50)
+
+        # The last Forest became an Island, only the last page changes
+        deck[-1] = (None, 1, None, 'Forest')
+        deck.append((None, 1, None, 'Island'))
+        reporter, new_times = self.helperCreate(deck)
+        self.assertEqual((reporter.pages, reporter.unchanged_pages), (1, 2))
+        self.assertEqual(new_times[:2], times[:2])
+        self.assertEqual(reporter.cards, 1)
+
+        # A shorter deck removes the pages left over
+        reporter, _ = self.helperCreate(deck[:1])
+        self.assertEqual((reporter.pages, reporter.unchanged_pages), (1, 1))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, 'page2.jpg'))
+        )
+
+    def test_failed_page(self):
+        '''Test that a changed page without any card is removed'''
+        deck = [(None, 2, None, 'Swamp'), (None, 2, None, 'Forest')]
+        self.helperCreate(deck)
+        with open(os.path.join(self.directory, 'Plains'), 'wb') as f:
+            f.write(b'not an image')
+
+        deck[-1] = (None, 2, None, 'Plains')
+        reporter = MgImageCreator(10, (1, 1), (2, 1)).createIncremental(
+            True, [list(card) for card in deck], self.directory, 'page'
+        )
+        self.assertEqual((reporter.pages, reporter.unchanged_pages), (0, 1))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.directory, 'page1.jpg'))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()